@@ -4,9 +4,10 @@ import asyncio
 import discord
 from discord import app_commands
 from discord.ext import commands
-import upstash_redis
+from upstash_redis.asyncio import Redis as AsyncRedis
 from flask import Flask, send_file
-from threading import Thread
+from threading import Thread, Lock
+from collections import deque
 import time
 import csv
 from io import StringIO
@@ -50,15 +51,18 @@ def record_key_usage():
         if not uid or not key or not user_agent:
             return jsonify({"error": "缺少必要字段: uid, key, user_agent"}), 400
 
-        # 调用记录函数处理
-        record_claim_history(uid, key, user_agent)
-
-        # 异步检测可疑账号
-        suspicious = detect_suspicious_account(uid)
-        if suspicious["is_suspicious"]:
-            print(f"🚨 可疑账号检测（网站密钥验证）: UID {uid}")
-            for reason in suspicious.get('reasons', []):
-                print(f"   → {reason}")
+        # 调用记录函数处理（Flask 线程中，交给机器人事件循环执行）；
+        # 事件循环尚未就绪（启动中 / 重连中）时先暂存，就绪后补写，不丢记录
+        try:
+            suspicious = run_storage_sync(process_key_usage_report(uid, key, user_agent))
+        except StorageLoopNotReady:
+            defer_storage_call(lambda: process_key_usage_report(uid, key, user_agent))
+            return jsonify({
+                "success": True,
+                "queued": True,
+                "is_suspicious": False,
+                "reasons": []
+            }), 202
 
         return jsonify({
             "success": True,
@@ -82,7 +86,7 @@ def heartbeat():
     while True:
         time.sleep(60)
         try:
-            redis.ping()
+            run_storage_sync(redis.ping())
         except:
             pass
 
@@ -97,10 +101,70 @@ bot = commands.Bot(command_prefix="!", intents=intents)
 # ----------------------
 # Redis
 # ----------------------
-redis = upstash_redis.Redis(
+# 异步客户端：所有存储调用都在事件循环上 await，慢请求不会再卡住网关事件。
+redis = AsyncRedis(
     url=os.getenv("UPSTASH_REDIS_URL"),
     token=os.getenv("UPSTASH_REDIS_TOKEN")
 )
+STORAGE_SYNC_TIMEOUT_SEC = float(os.getenv("STORAGE_SYNC_TIMEOUT_SEC", "15"))
+STORAGE_DEFER_MAX = max(0, int(os.getenv("STORAGE_DEFER_MAX", "1000")))
+_STORAGE_LOOP = None
+_STORAGE_DEFERRED = deque()
+_STORAGE_DEFERRED_LOCK = Lock()
+
+
+class StorageLoopNotReady(RuntimeError):
+    """机器人事件循环尚未就绪（启动中或已停止），存储调用无法提交"""
+
+
+def bind_storage_loop(loop):
+    """记录机器人事件循环，供 Flask / 心跳线程提交存储调用；并补执行就绪前暂存的调用"""
+    global _STORAGE_LOOP
+    with _STORAGE_DEFERRED_LOCK:
+        _STORAGE_LOOP = loop
+        pending = list(_STORAGE_DEFERRED)
+        _STORAGE_DEFERRED.clear()
+    if pending:
+        print(f"🔁 补执行事件循环就绪前暂存的 {len(pending)} 个存储调用")
+        loop.create_task(_run_deferred_storage_calls(pending))
+
+
+def run_storage_sync(coro, timeout: Optional[float] = None):
+    """
+    在非事件循环线程（Flask 接口、心跳）中执行异步存储调用并等待结果。
+    事件循环尚未就绪时抛出 StorageLoopNotReady。
+    """
+    loop = _STORAGE_LOOP
+    if loop is None or not loop.is_running():
+        coro.close()
+        raise StorageLoopNotReady("存储事件循环尚未就绪")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    return future.result(timeout=STORAGE_SYNC_TIMEOUT_SEC if timeout is None else timeout)
+
+
+def defer_storage_call(factory):
+    """
+    事件循环未就绪时暂存一次存储调用（factory 返回协程），bind_storage_loop 时按顺序补执行。
+    暂存队列超过 STORAGE_DEFER_MAX 时丢弃最早的调用。
+    """
+    with _STORAGE_DEFERRED_LOCK:
+        loop = _STORAGE_LOOP
+        if loop is None or not loop.is_running():
+            if STORAGE_DEFER_MAX and len(_STORAGE_DEFERRED) >= STORAGE_DEFER_MAX:
+                _STORAGE_DEFERRED.popleft()
+                print(f"⚠️ 暂存的存储调用超过 {STORAGE_DEFER_MAX} 个，已丢弃最早的一个")
+            _STORAGE_DEFERRED.append(factory)
+            return
+    # 暂存期间事件循环已经就绪：直接提交，不等待结果
+    asyncio.run_coroutine_threadsafe(_run_deferred_storage_calls([factory]), loop)
+
+
+async def _run_deferred_storage_calls(factories: list):
+    for factory in factories:
+        try:
+            await factory()
+        except Exception as e:
+            print(f"❌ 补执行暂存的存储调用失败: {e}")
 
 # ----------------------
 # 工单管理器
@@ -117,7 +181,7 @@ class TicketManager:
     async def set_ticket_info(channel_id, member_id, ticket_type="support"):
         """设置工单信息"""
         ticket_key = TicketManager.get_ticket_key(channel_id)
-        redis.set(ticket_key, json.dumps({
+        await redis.set(ticket_key, json.dumps({
             "member_id": str(member_id),
             "type": ticket_type,
             "created_at": datetime.now().isoformat(),
@@ -126,10 +190,10 @@ class TicketManager:
         }), ex=86400)  # 24小时过期
 
     @staticmethod
-    def get_ticket_info(channel_id):
+    async def get_ticket_info(channel_id):
         """获取工单信息"""
         ticket_key = TicketManager.get_ticket_key(channel_id)
-        info = redis.get(ticket_key)
+        info = await redis.get(ticket_key)
         if info:
             if isinstance(info, bytes):
                 info = info.decode('utf-8')
@@ -208,14 +272,14 @@ class ProtectedAttachmentManager:
             "download_count": 0
         }
         key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-        redis.set(key, json.dumps(data))  # 长期存储，不过期
+        await redis.set(key, json.dumps(data))  # 长期存储，不过期
         return True
 
     @staticmethod
-    def get_attachments(thread_id):
+    async def get_attachments(thread_id):
         """获取帖子的保护附件信息"""
         key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-        data = redis.get(key)
+        data = await redis.get(key)
         if data:
             if isinstance(data, bytes):
                 data = data.decode('utf-8')
@@ -225,7 +289,7 @@ class ProtectedAttachmentManager:
     @staticmethod
     async def update_attachments(thread_id, new_attachments_data):
         """更新附件内容"""
-        existing = ProtectedAttachmentManager.get_attachments(thread_id)
+        existing = await ProtectedAttachmentManager.get_attachments(thread_id)
         if not existing:
             return False
 
@@ -233,32 +297,32 @@ class ProtectedAttachmentManager:
         existing["updated_at"] = datetime.now().isoformat()
 
         key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-        redis.set(key, json.dumps(existing))  # 长期存储
+        await redis.set(key, json.dumps(existing))  # 长期存储
         return True
 
     @staticmethod
-    def increment_download_count(thread_id):
+    async def increment_download_count(thread_id):
         """增加下载计数"""
-        existing = ProtectedAttachmentManager.get_attachments(thread_id)
+        existing = await ProtectedAttachmentManager.get_attachments(thread_id)
         if existing:
             existing["download_count"] = existing.get("download_count", 0) + 1
             key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-            redis.set(key, json.dumps(existing))  # 长期存储
+            await redis.set(key, json.dumps(existing))  # 长期存储
 
     @staticmethod
-    def record_user_access(thread_id, user_id):
+    async def record_user_access(thread_id, user_id):
         """记录用户已获取访问权限"""
         key = ProtectedAttachmentManager.get_user_access_key(thread_id, user_id)
-        redis.set(key, json.dumps({
+        await redis.set(key, json.dumps({
             "accessed_at": datetime.now().isoformat(),
             "downloads": 1
         }))  # 长期存储
 
     @staticmethod
-    def has_user_access(thread_id, user_id):
+    async def has_user_access(thread_id, user_id):
         """检查用户是否已有访问权限"""
         key = ProtectedAttachmentManager.get_user_access_key(thread_id, user_id)
-        return redis.get(key) is not None
+        return await redis.get(key) is not None
 
     @staticmethod
     async def check_user_engagement(thread: discord.Thread, user: discord.Member):
@@ -311,9 +375,9 @@ class ThreadBottomManager:
         return f"thread:bottom_notice:{thread_id}:{notice_type}"
 
     @staticmethod
-    def get_notice(thread_id, notice_type):
+    async def get_notice(thread_id, notice_type):
         key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
-        raw = redis.get(key)
+        raw = await redis.get(key)
         if not raw:
             return None
         try:
@@ -326,14 +390,14 @@ class ThreadBottomManager:
             return None
 
     @staticmethod
-    def set_notice(thread_id, notice_type, data):
+    async def set_notice(thread_id, notice_type, data):
         key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
-        redis.set(key, json.dumps(data, ensure_ascii=False))
+        await redis.set(key, json.dumps(data, ensure_ascii=False))
 
     @staticmethod
-    def delete_notice(thread_id, notice_type):
+    async def delete_notice(thread_id, notice_type):
         key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
-        redis.delete(key)
+        await redis.delete(key)
 
 
 def _now_text():
@@ -377,8 +441,8 @@ async def _delete_thread_message_if_exists(channel, message_id):
         print(f"⚠️ 删除旧置底消息失败: {e}")
 
 
-def _build_attachment_bottom_embed(thread: discord.Thread):
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+async def _build_attachment_bottom_embed(thread: discord.Thread):
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         return None
 
@@ -420,30 +484,30 @@ def _build_announcement_bottom_embed(channel, content: str):
 
 
 async def _repost_attachment_bottom_notice(thread: discord.Thread, config: dict):
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await _delete_thread_message_if_exists(thread, config.get("message_id"))
-        ThreadBottomManager.delete_notice(thread.id, "attachment")
+        await ThreadBottomManager.delete_notice(thread.id, "attachment")
         return
 
     await _delete_thread_message_if_exists(thread, config.get("message_id"))
 
-    embed = _build_attachment_bottom_embed(thread)
+    embed = await _build_attachment_bottom_embed(thread)
     if not embed:
-        ThreadBottomManager.delete_notice(thread.id, "attachment")
+        await ThreadBottomManager.delete_notice(thread.id, "attachment")
         return
 
     sent = await thread.send(embed=embed)
     config["message_id"] = str(sent.id)
     config["updated_at"] = _now_text()
-    ThreadBottomManager.set_notice(thread.id, "attachment", config)
+    await ThreadBottomManager.set_notice(thread.id, "attachment", config)
 
 
 async def _repost_announcement_bottom_notice(channel, config: dict):
     content = str(config.get("content", "")).strip()
     if not content:
         await _delete_thread_message_if_exists(channel, config.get("message_id"))
-        ThreadBottomManager.delete_notice(channel.id, "announcement")
+        await ThreadBottomManager.delete_notice(channel.id, "announcement")
         return
 
     await _delete_thread_message_if_exists(channel, config.get("message_id"))
@@ -452,7 +516,7 @@ async def _repost_announcement_bottom_notice(channel, config: dict):
     sent = await channel.send(embed=embed)
     config["message_id"] = str(sent.id)
     config["updated_at"] = _now_text()
-    ThreadBottomManager.set_notice(channel.id, "announcement", config)
+    await ThreadBottomManager.set_notice(channel.id, "announcement", config)
 
 
 async def refresh_thread_bottom_notices(channel):
@@ -462,7 +526,7 @@ async def refresh_thread_bottom_notices(channel):
 
     lock_key = f"thread:bottom_notice:lock:{channel.id}"
     try:
-        locked = redis.set(lock_key, "1", nx=True, ex=5)
+        locked = await redis.set(lock_key, "1", nx=True, ex=5)
     except Exception:
         locked = True
 
@@ -471,27 +535,27 @@ async def refresh_thread_bottom_notices(channel):
 
     try:
         if isinstance(channel, discord.Thread):
-            attachment_cfg = ThreadBottomManager.get_notice(channel.id, "attachment")
+            attachment_cfg = await ThreadBottomManager.get_notice(channel.id, "attachment")
             if attachment_cfg and attachment_cfg.get("enabled"):
                 await _repost_attachment_bottom_notice(channel, attachment_cfg)
 
-        announcement_cfg = ThreadBottomManager.get_notice(channel.id, "announcement")
+        announcement_cfg = await ThreadBottomManager.get_notice(channel.id, "announcement")
         if announcement_cfg and announcement_cfg.get("enabled"):
             await _repost_announcement_bottom_notice(channel, announcement_cfg)
     except Exception as e:
         print(f"⚠️ 刷新帖子置底消息失败: {e}")
     finally:
         try:
-            redis.delete(lock_key)
+            await redis.delete(lock_key)
         except Exception:
             pass
 
 # ----------------------
 # 工具函数
 # ----------------------
-def acquire_cmd_lock(interaction_id):
+async def acquire_cmd_lock(interaction_id):
     try:
-        return redis.set(f"cmd:lock:{interaction_id}", "1", nx=True, ex=10)
+        return await redis.set(f"cmd:lock:{interaction_id}", "1", nx=True, ex=10)
     except:
         return True
 
@@ -714,7 +778,7 @@ def generate_csv_report(keys_data):
 # ======================
 # 异常账号检测
 # ======================
-def detect_suspicious_account(uid: str) -> dict:
+async def detect_suspicious_account(uid: str) -> dict:
     """
     检测异常账号：基于密钥网站使用时的user_agent信息
 
@@ -735,7 +799,7 @@ def detect_suspicious_account(uid: str) -> dict:
     try:
         # 获取用户的密钥使用历史（网站验证时上报的数据）
         history_key = f"user:key_usage_history:{uid}"
-        history_data = redis.lrange(history_key, 0, -1) or []
+        history_data = await redis.lrange(history_key, 0, -1) or []
 
         if not history_data:
             return suspicious_info
@@ -841,7 +905,7 @@ def detect_suspicious_account(uid: str) -> dict:
 
         # 标记可疑账号到 Redis（30天内有效）
         if suspicious_info["is_suspicious"]:
-            redis.setex(
+            await redis.setex(
                 f"suspicious_account:{uid}",
                 2592000,  # 30天
                 json.dumps({
@@ -851,7 +915,7 @@ def detect_suspicious_account(uid: str) -> dict:
                 })
             )
             # 添加到可疑账号集合
-            redis.sadd("suspicious_accounts_set", uid)
+            await redis.sadd("suspicious_accounts_set", uid)
 
     except Exception as e:
         print(f"⚠️ 异常检测失败: {str(e)}")
@@ -965,7 +1029,7 @@ async def notify_admins_of_suspicious(interaction, uid: str, suspicious_info: di
     except Exception as e:
         print(f"通知管理员失败: {e}")
 
-def record_claim_history(uid: str, key: str, user_agent: str = "", device_info: dict = None):
+async def record_claim_history(uid: str, key: str, user_agent: str = "", device_info: dict = None):
     """
     记录用户的密钥使用历史（包含设备/浏览器/系统信息）
     用于异常检测
@@ -979,7 +1043,7 @@ def record_claim_history(uid: str, key: str, user_agent: str = "", device_info:
     try:
         # 获取现有的使用历史
         history_key = f"user:key_usage_history:{uid}"
-        history = redis.lrange(history_key, 0, -1) or []
+        history = await redis.lrange(history_key, 0, -1) or []
 
         # 将bytes转为list
         if history and isinstance(history[0], bytes):
@@ -1007,22 +1071,33 @@ def record_claim_history(uid: str, key: str, user_agent: str = "", device_info:
 
         # 保存到Redis（保留30天）
         # 使用字符串列表存储
-        redis.delete(history_key)
+        await redis.delete(history_key)
         for record in history:
-            redis.rpush(history_key, json.dumps(record))
-        redis.expire(history_key, 2592000)  # 30天过期
+            await redis.rpush(history_key, json.dumps(record))
+        await redis.expire(history_key, 2592000)  # 30天过期
 
         print(f"✅ 记录密钥使用: UID {uid} | 设备: {device_info.get('device', '未知')} | 浏览器: {device_info.get('browser', '未知')} | 系统: {device_info.get('os', '未知')}")
 
     except Exception as e:
         print(f"⚠️ 密钥使用历史记录失败: {str(e)}")
 
+
+async def process_key_usage_report(uid: str, key: str, user_agent: str) -> dict:
+    """处理网站上报的一次密钥验证：记录使用历史并检测可疑账号，返回检测结果"""
+    await record_claim_history(uid, key, user_agent)
+    suspicious = await detect_suspicious_account(uid)
+    if suspicious["is_suspicious"]:
+        print(f"🚨 可疑账号检测（网站密钥验证）: UID {uid}")
+        for reason in suspicious.get('reasons', []):
+            print(f"   → {reason}")
+    return suspicious
+
 # ======================
 # /领取密钥（限频道评论）
 # ======================
 @bot.tree.command(name="领取密钥", description="🔑领取密钥（需先评论'喵机1号'）")
 async def 领取密钥(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -1055,7 +1130,7 @@ async def 领取密钥(interaction: discord.Interaction):
             pass
 
     # 检查用户是否在10分钟内已领取过密钥
-    last_claim_time = redis.get(f"user:last_claim:{uid}")
+    last_claim_time = await redis.get(f"user:last_claim:{uid}")
     if last_claim_time:
         try:
             last_time = float(last_claim_time)
@@ -1077,7 +1152,7 @@ async def 领取密钥(interaction: discord.Interaction):
             pass
 
     # 更新最后领取时间
-    redis.set(f"user:last_claim:{uid}", str(time.time()), ex=600)
+    await redis.set(f"user:last_claim:{uid}", str(time.time()), ex=600)
 
     # 获取密钥，确保不是已使用过的
     key = None
@@ -1086,13 +1161,13 @@ async def 领取密钥(interaction: discord.Interaction):
 
     while attempt_count < max_attempts:
         attempt_count += 1
-        candidate = clean_key(redis.spop("keys:valid"))
+        candidate = clean_key(await redis.spop("keys:valid"))
 
         if not candidate:
             break  # 没有更多密钥了
 
         # 检查是否已被使用过
-        is_used = redis.get(f"key:used:{candidate}")
+        is_used = await redis.get(f"key:used:{candidate}")
         if is_used == "true" or is_used is True or is_used == 1:
             # 这个已使用过的密钥不应该在有效库中，记录日志并继续
             print(f"⚠️ 警告：已使用的密钥 {candidate} 仍在 keys:valid 中，已移除")
@@ -1102,7 +1177,7 @@ async def 领取密钥(interaction: discord.Interaction):
         break
 
     if not key:
-        redis.delete(f"user:got_key:{uid}")
+        await redis.delete(f"user:got_key:{uid}")
         await interaction.followup.send(
             "❌ **暂无可用密钥**\n"
             "当前密钥已全部发完，请联系管理员补充。",
@@ -1111,9 +1186,9 @@ async def 领取密钥(interaction: discord.Interaction):
         return
 
     try:
-        redis.sadd("keys:issued", key)
-        redis.lpush(f"user:keys:{uid}", key)
-        redis.set(f"key:owner:{key}", json.dumps({
+        await redis.sadd("keys:issued", key)
+        await redis.lpush(f"user:keys:{uid}", key)
+        await redis.set(f"key:owner:{key}", json.dumps({
             "uid": uid,
             "name": str(interaction.user),
             "issuedAt": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -1137,7 +1212,7 @@ async def 领取密钥(interaction: discord.Interaction):
 
         # 注：密钥使用的user_agent检测数据应由网站通过 /api/record_key_usage API上报
         # 检测异常账号（此时可能还无数据，等网站验证时才会有）
-        suspicious = detect_suspicious_account(uid)
+        suspicious = await detect_suspicious_account(uid)
         if suspicious["is_suspicious"]:
             print(f"🚨 可疑账号检测: {interaction.user} (ID: {uid})")
             for reason in suspicious.get('reasons', []):
@@ -1159,9 +1234,9 @@ async def 领取密钥(interaction: discord.Interaction):
         )
 
     except:
-        redis.srem("keys:issued", key)
-        redis.sadd("keys:valid", key)
-        redis.delete(f"user:got_key:{uid}")
+        await redis.srem("keys:issued", key)
+        await redis.sadd("keys:valid", key)
+        await redis.delete(f"user:got_key:{uid}")
         await interaction.followup.send(
             "❌ **无法发送私信**\n"
             "请先开启私信权限：\n"
@@ -1175,11 +1250,11 @@ async def 领取密钥(interaction: discord.Interaction):
 # ======================
 @bot.tree.command(name="剩余密钥", description="📦 查看当前可领取的密钥数量")
 async def 剩余密钥(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
-    cnt = redis.scard("keys:valid")
+    cnt = await redis.scard("keys:valid")
     await interaction.followup.send(f"📦 当前可领取密钥：**{cnt}** 个", ephemeral=True)
 
 # ======================
@@ -1192,11 +1267,11 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
-    keys = redis.lrange(f"user:keys:{member.id}", 0, -1)
+    keys = await redis.lrange(f"user:keys:{member.id}", 0, -1)
 
     if not keys:
         await interaction.followup.send(f"📭 {member.mention} 没有任何密钥记录", ephemeral=True)
@@ -1206,7 +1281,7 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
 
     # 检查是否为可疑账号
     uid = str(member.id)
-    suspicious_data = redis.get(f"suspicious_account:{uid}")
+    suspicious_data = await redis.get(f"suspicious_account:{uid}")
     if suspicious_data:
         try:
             if isinstance(suspicious_data, bytes):
@@ -1233,9 +1308,9 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
     for i, k in enumerate(keys, 1):
         k = clean_key(k)
         all_keys_text.append(k)
-        is_used = redis.get(f"key:used:{k}")
-        info = redis.get(f"key:info:{k}")
-        owner = redis.get(f"key:owner:{k}")
+        is_used = await redis.get(f"key:used:{k}")
+        info = await redis.get(f"key:info:{k}")
+        owner = await redis.get(f"key:owner:{k}")
 
         # 密钥信息（不含密钥本身，密钥单独发送）
         lines = []
@@ -1277,7 +1352,7 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
             except Exception as e:
                 lines.append("🔴 已使用（详情解析失败）")
         else:
-            in_issued = redis.sismember("keys:issued", k)
+            in_issued = await redis.sismember("keys:issued", k)
             if in_issued:
                 lines.append("🟡 已发出，等待用户验证使用")
             else:
@@ -1297,12 +1372,12 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
 # ======================
 @bot.tree.command(name="我的密钥", description="📋 查看自己所有的密钥记录及使用信息")
 async def 我的密钥(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
     uid = str(interaction.user.id)
-    keys = redis.lrange(f"user:keys:{uid}", 0, -1)
+    keys = await redis.lrange(f"user:keys:{uid}", 0, -1)
 
     if not keys:
         await interaction.followup.send(f"📭 你还没有任何密钥记录", ephemeral=True)
@@ -1317,9 +1392,9 @@ async def 我的密钥(interaction: discord.Interaction):
     for i, k in enumerate(keys, 1):
         k = clean_key(k)
         my_keys_text.append(k)
-        is_used = redis.get(f"key:used:{k}")
-        info = redis.get(f"key:info:{k}")
-        owner = redis.get(f"key:owner:{k}")
+        is_used = await redis.get(f"key:used:{k}")
+        info = await redis.get(f"key:info:{k}")
+        owner = await redis.get(f"key:owner:{k}")
 
         # 密钥信息（不含密钥本身）
         lines = []
@@ -1369,7 +1444,7 @@ async def 我的密钥(interaction: discord.Interaction):
                 lines.append("🔴 **使用信息**")
                 lines.append("详情解析失败")
         else:
-            in_issued = redis.sismember("keys:issued", k)
+            in_issued = await redis.sismember("keys:issued", k)
             if in_issued:
                 lines.append("🟡 **状态：已发出，等待使用**")
             else:
@@ -1398,7 +1473,7 @@ async def 工单面板(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
 
     embed = discord.Embed(
@@ -1428,7 +1503,7 @@ async def 关闭工单(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
 
     channel_name = interaction.channel.name
@@ -1446,7 +1521,7 @@ async def 关闭工单(interaction: discord.Interaction):
 # ======================
 @bot.tree.command(name="回顶", description="🔝 快速回到当前频道首楼")
 async def 回顶(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -1597,7 +1672,7 @@ async def 可疑账号(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -1616,7 +1691,7 @@ async def 可疑账号(interaction: discord.Interaction):
             return text[: limit - 3] + "..."
 
         # 1) 先取已有可疑集合
-        suspicious_uids = redis.smembers("suspicious_accounts_set") or []
+        suspicious_uids = await redis.smembers("suspicious_accounts_set") or []
         uid_set = set()
         for raw_uid in suspicious_uids:
             uid = _to_text(raw_uid)
@@ -1625,7 +1700,7 @@ async def 可疑账号(interaction: discord.Interaction):
 
         # 2) 兼容集合丢失的场景：从历史键重建一次检测
         try:
-            history_keys = redis.keys("user:key_usage_history:*") or []
+            history_keys = await redis.keys("user:key_usage_history:*") or []
             for hk in history_keys:
                 hk_text = _to_text(hk)
                 if hk_text.startswith("user:key_usage_history:"):
@@ -1641,10 +1716,10 @@ async def 可疑账号(interaction: discord.Interaction):
             if not uid:
                 continue
 
-            fresh = detect_suspicious_account(uid)
+            fresh = await detect_suspicious_account(uid)
             if not fresh.get("is_suspicious"):
-                redis.delete(f"suspicious_account:{uid}")
-                redis.srem("suspicious_accounts_set", uid)
+                await redis.delete(f"suspicious_account:{uid}")
+                await redis.srem("suspicious_accounts_set", uid)
                 removed_count += 1
                 continue
 
@@ -1652,7 +1727,7 @@ async def 可疑账号(interaction: discord.Interaction):
             details = fresh.get("details", {})
             reasons = fresh.get("reasons", [])
 
-            stored = redis.get(f"suspicious_account:{uid}")
+            stored = await redis.get(f"suspicious_account:{uid}")
             if stored:
                 try:
                     if isinstance(stored, bytes):
@@ -1799,7 +1874,7 @@ async def 上传保护附件(
     附件8: discord.Attachment = None,
     名称8: str = None
 ):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -1824,7 +1899,7 @@ async def 上传保护附件(
         return
 
     # 检查是否已有附件
-    existing = ProtectedAttachmentManager.get_attachments(thread.id)
+    existing = await ProtectedAttachmentManager.get_attachments(thread.id)
     if existing:
         await interaction.followup.send(
             "❌ **此帖子已有保护附件**\n"
@@ -1971,7 +2046,7 @@ async def 修改保护附件(
     附件8: discord.Attachment = None,
     名称8: str = None
 ):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -1994,7 +2069,7 @@ async def 修改保护附件(
         return
 
     # 检查是否有现有附件
-    existing = ProtectedAttachmentManager.get_attachments(thread.id)
+    existing = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not existing:
         await interaction.followup.send(
             "❌ **此帖子还没有保护附件**\n"
@@ -2087,7 +2162,7 @@ async def 修改保护附件(
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="领取保护附件", description="📥 下载保护附件（需先点赞+评论）")
 async def 领取保护附件(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -2104,7 +2179,7 @@ async def 领取保护附件(interaction: discord.Interaction):
     uid = str(interaction.user.id)
 
     # 检查帖子是否有保护附件
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await interaction.followup.send(
             "❌ **此帖子没有保护附件**\n"
@@ -2144,7 +2219,7 @@ async def 领取保护附件(interaction: discord.Interaction):
         return
 
     # 检查用户是否已有访问权限（之前验证通过）
-    has_access = ProtectedAttachmentManager.has_user_access(thread.id, uid)
+    has_access = await ProtectedAttachmentManager.has_user_access(thread.id, uid)
 
     if not has_access:
         # 检查用户是否满足条件（点赞 + 评论）
@@ -2169,10 +2244,10 @@ async def 领取保护附件(interaction: discord.Interaction):
             return
 
         # 记录用户访问权限
-        ProtectedAttachmentManager.record_user_access(thread.id, uid)
+        await ProtectedAttachmentManager.record_user_access(thread.id, uid)
 
     # 增加下载计数
-    ProtectedAttachmentManager.increment_download_count(thread.id)
+    await ProtectedAttachmentManager.increment_download_count(thread.id)
 
     # 发送附件下载链接（私信方式更安全）
     try:
@@ -2225,7 +2300,7 @@ async def 领取保护附件(interaction: discord.Interaction):
 @bot.tree.command(name="查看保护附件", description="📊 [帖主] 查看当前帖子保护附件的状态和统计")
 async def 查看保护附件(interaction: discord.Interaction):
 
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -2251,7 +2326,7 @@ async def 查看保护附件(interaction: discord.Interaction):
         return
 
     # 获取附件信息
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await interaction.followup.send(
             "❌ **此帖子没有保护附件**\n"
@@ -2307,7 +2382,7 @@ async def 查看保护附件(interaction: discord.Interaction):
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="保护附件置底", description="📌 [帖主/管理员] 让保护附件下载入口保持在帖子底部")
 async def 保护附件置底(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -2320,7 +2395,7 @@ async def 保护附件置底(interaction: discord.Interaction):
         await interaction.followup.send("❌ 只有帖主或管理员可以设置该帖置底消息。", ephemeral=True)
         return
 
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await interaction.followup.send(
             "❌ 此帖子还没有保护附件。\n请先使用 `/上传保护附件` 上传附件。",
@@ -2328,14 +2403,14 @@ async def 保护附件置底(interaction: discord.Interaction):
         )
         return
 
-    old_cfg = ThreadBottomManager.get_notice(thread.id, "attachment") or {}
+    old_cfg = await ThreadBottomManager.get_notice(thread.id, "attachment") or {}
     new_cfg = {
         "enabled": True,
         "message_id": old_cfg.get("message_id"),
         "updated_by": str(interaction.user.id),
         "updated_at": _now_text()
     }
-    ThreadBottomManager.set_notice(thread.id, "attachment", new_cfg)
+    await ThreadBottomManager.set_notice(thread.id, "attachment", new_cfg)
     await refresh_thread_bottom_notices(thread)
 
     await interaction.followup.send(
@@ -2350,7 +2425,7 @@ async def 保护附件置底(interaction: discord.Interaction):
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="删除保护附件置底", description="🗑️ [帖主/管理员] 删除保护附件下载置底消息")
 async def 删除保护附件置底(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -2363,13 +2438,13 @@ async def 删除保护附件置底(interaction: discord.Interaction):
         await interaction.followup.send("❌ 只有帖主或管理员可以删除该帖置底消息。", ephemeral=True)
         return
 
-    cfg = ThreadBottomManager.get_notice(thread.id, "attachment")
+    cfg = await ThreadBottomManager.get_notice(thread.id, "attachment")
     if not cfg:
         await interaction.followup.send("ℹ️ 当前帖子未启用保护附件置底。", ephemeral=True)
         return
 
     await _delete_thread_message_if_exists(thread, cfg.get("message_id"))
-    ThreadBottomManager.delete_notice(thread.id, "attachment")
+    await ThreadBottomManager.delete_notice(thread.id, "attachment")
 
     await interaction.followup.send("✅ 已删除保护附件下载置底消息。", ephemeral=True)
 
@@ -2381,7 +2456,7 @@ async def 删除保护附件置底(interaction: discord.Interaction):
 @bot.tree.command(name="公告置底", description="📢 [管理员/帖主] 设置并保持公告在帖子或文字频道底部")
 @app_commands.describe(内容="公告内容（重复执行本命令可编辑）")
 async def 公告置底(interaction: discord.Interaction, 内容: str):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -2402,7 +2477,7 @@ async def 公告置底(interaction: discord.Interaction, 内容: str):
         await interaction.followup.send("❌ 公告内容过长，请控制在 1800 字以内。", ephemeral=True)
         return
 
-    old_cfg = ThreadBottomManager.get_notice(channel.id, "announcement") or {}
+    old_cfg = await ThreadBottomManager.get_notice(channel.id, "announcement") or {}
     new_cfg = {
         "enabled": True,
         "content": content,
@@ -2410,7 +2485,7 @@ async def 公告置底(interaction: discord.Interaction, 内容: str):
         "updated_by": str(interaction.user.id),
         "updated_at": _now_text()
     }
-    ThreadBottomManager.set_notice(channel.id, "announcement", new_cfg)
+    await ThreadBottomManager.set_notice(channel.id, "announcement", new_cfg)
     await refresh_thread_bottom_notices(channel)
 
     await interaction.followup.send(
@@ -2425,7 +2500,7 @@ async def 公告置底(interaction: discord.Interaction, 内容: str):
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="删除公告置底", description="🗑️ [管理员/帖主] 删除帖子或文字频道公告置底消息")
 async def 删除公告置底(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -2438,13 +2513,13 @@ async def 删除公告置底(interaction: discord.Interaction):
         await interaction.followup.send("❌ 只有管理员，或帖子内的帖主，才能删除公告置底。", ephemeral=True)
         return
 
-    cfg = ThreadBottomManager.get_notice(channel.id, "announcement")
+    cfg = await ThreadBottomManager.get_notice(channel.id, "announcement")
     if not cfg:
         await interaction.followup.send("ℹ️ 当前频道未启用公告置底。", ephemeral=True)
         return
 
     await _delete_thread_message_if_exists(channel, cfg.get("message_id"))
-    ThreadBottomManager.delete_notice(channel.id, "announcement")
+    await ThreadBottomManager.delete_notice(channel.id, "announcement")
 
     await interaction.followup.send("✅ 已删除公告置底消息。", ephemeral=True)
 
@@ -2465,6 +2540,7 @@ async def on_message(message: discord.Message):
 
 @bot.event
 async def on_ready():
+    bind_storage_loop(asyncio.get_running_loop())
     bot.add_view(TicketView())
     bot.add_view(TicketControlView())  # 持久化注册工单按钮视图
     try:
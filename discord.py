@@ -3,20 +3,35 @@ import json
 import asyncio
 import re
 import base64
+import gzip
+import hashlib
+import math
+import fnmatch
 import random
-from urllib.parse import quote_plus, quote
+import zlib
+import multiprocessing
+from urllib.parse import quote_plus, quote, urlsplit
 import aiohttp
 import discord
 from discord import app_commands
 from discord.ext import commands
-import upstash_redis
+from upstash_redis.asyncio import Redis as AsyncRedis
 from flask import Flask, send_file
-from threading import Thread
+from threading import Thread, Lock
 import time
 import csv
 from io import StringIO
 from datetime import datetime
 from typing import Optional
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # ----------------------
 # 保活
@@ -55,15 +70,18 @@ def record_key_usage():
         if not uid or not key or not user_agent:
             return jsonify({"error": "缺少必要字段: uid, key, user_agent"}), 400
 
-        # 调用记录函数处理
-        record_claim_history(uid, key, user_agent)
-
-        # 异步检测可疑账号
-        suspicious = detect_suspicious_account(uid)
-        if suspicious["is_suspicious"]:
-            print(f"🚨 可疑账号检测（网站密钥验证）: UID {uid}")
-            for reason in suspicious.get('reasons', []):
-                print(f"   → {reason}")
+        # 调用记录函数处理（Flask 线程中，交给机器人事件循环执行）；
+        # 事件循环尚未就绪（启动中 / 重连中）时先暂存，就绪后补写，不丢记录
+        try:
+            suspicious = run_storage_sync(process_key_usage_report(uid, key, user_agent))
+        except StorageLoopNotReady:
+            defer_storage_call(lambda: process_key_usage_report(uid, key, user_agent))
+            return jsonify({
+                "success": True,
+                "queued": True,
+                "is_suspicious": False,
+                "reasons": []
+            }), 202
 
         return jsonify({
             "success": True,
@@ -87,7 +105,7 @@ def heartbeat():
     while True:
         time.sleep(60)
         try:
-            redis.ping()
+            run_storage_sync(redis.ping())
         except:
             pass
 
@@ -97,15 +115,493 @@ def heartbeat():
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+
+class OvoBot(commands.Bot):
+    async def close(self):
+        # 关闭共享 HTTP 连接池与存储客户端，避免退出时出现未关闭会话警告
+        try:
+            await close_http_session()
+        except Exception as e:
+            print(f"⚠️ 关闭 HTTP 连接池失败: {e}")
+        try:
+            await _REPO_CAT_FILE.close()
+        except Exception:
+            pass
+        shutdown_repo_cpu_pool()
+        try:
+            await redis.close()
+        except Exception as e:
+            print(f"⚠️ 关闭存储客户端失败: {e}")
+        await super().close()
+
+
+bot = OvoBot(command_prefix="!", intents=intents)
+
+# ----------------------
+# 本地存储后端（离线测试 / 压测）
+# ----------------------
+class MemoryPipeline:
+    """内存后端的 pipeline / multi：exec 时一次性执行，只计一次往返延迟"""
+
+    def __init__(self, store):
+        self._store = store
+        self._commands = []
+
+    def __getattr__(self, name):
+        impl = getattr(self._store, "_cmd_" + name, None)
+        if impl is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((impl, args, kwargs))
+            return self
+
+        return queue
+
+    async def exec(self):
+        await self._store._simulate_latency()
+        commands, self._commands = self._commands, []
+        return [impl(*args, **kwargs) for impl, args, kwargs in commands]
+
+
+class MemoryRedis:
+    """
+    进程内的 Redis 替身，接口与 upstash_redis.asyncio.Redis 的已用子集一致。
+    每次命令 / 每次 pipeline 执行注入一次模拟网络延迟（latency_ms ± jitter_ms），
+    用于在没有 Upstash 账号时跑通领取、历史、附件等流程并做压测。
+    Lua 脚本需通过 register_script 注册等价的 Python 实现。
+    """
+
+    _scripts = {}
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.latency_ms = max(0.0, float(latency_ms))
+        self.jitter_ms = max(0.0, float(jitter_ms))
+        self.command_count = 0
+        self._data = {}
+        self._expires = {}
+
+    @classmethod
+    def register_script(cls, script: str, handler):
+        """注册 Lua 脚本的 Python 等价实现：handler(store, keys, args)"""
+        cls._scripts[hashlib.sha1(script.encode("utf-8")).hexdigest()] = handler
+        return handler
+
+    async def _simulate_latency(self):
+        self.command_count += 1
+        delay = self.latency_ms
+        if self.jitter_ms:
+            delay += random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+        else:
+            await asyncio.sleep(0)
+
+    def __getattr__(self, name):
+        impl = getattr(type(self), "_cmd_" + name, None)
+        if impl is None:
+            raise AttributeError(name)
+
+        async def command(*args, **kwargs):
+            await self._simulate_latency()
+            return impl(self, *args, **kwargs)
+
+        return command
+
+    def pipeline(self):
+        return MemoryPipeline(self)
+
+    def multi(self):
+        return MemoryPipeline(self)
+
+    async def evalsha(self, sha1: str, keys: list = None, args: list = None):
+        await self._simulate_latency()
+        handler = self._scripts.get(sha1)
+        if handler is None:
+            raise RuntimeError("NOSCRIPT No matching script")
+        return handler(self, list(keys or []), [str(a) for a in (args or [])])
+
+    async def eval(self, script: str, keys: list = None, args: list = None):
+        sha1 = hashlib.sha1(script.encode("utf-8")).hexdigest()
+        if sha1 not in self._scripts:
+            raise NotImplementedError("内存存储后端未注册该 Lua 脚本")
+        return await self.evalsha(sha1, keys=keys, args=args)
+
+    async def close(self):
+        pass
+
+    # ---- 内部工具 ----
+    def _alive(self, key):
+        expire_at = self._expires.get(key)
+        if expire_at is not None and expire_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _get_typed(self, key, kind, create=False):
+        if self._alive(key):
+            value = self._data[key]
+            if not isinstance(value, kind):
+                raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+            return value
+        if not create:
+            return None
+        value = kind()
+        self._data[key] = value
+        return value
+
+    # ---- 通用 ----
+    def _cmd_ping(self):
+        return "PONG"
+
+    def _cmd_delete(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return removed
+
+    def _cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def _cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self._expires[key] = time.time() + int(seconds)
+        return True
+
+    def _cmd_keys(self, pattern):
+        return [key for key in list(self._data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]
+
+    def _cmd_scan(self, cursor, match=None, count=None, type=None):
+        keys = sorted(self._cmd_keys(match or "*"))
+        start = int(cursor or 0)
+        page = max(1, int(count or 10))
+        chunk = keys[start:start + page]
+        next_cursor = start + page if start + page < len(keys) else 0
+        return next_cursor, chunk
+
+    # ---- 字符串 ----
+    def _cmd_get(self, key):
+        return self._get_typed(key, str)
+
+    def _cmd_mget(self, *keys):
+        return [self._cmd_get(key) for key in keys]
+
+    def _cmd_set(self, key, value, nx=False, xx=False, ex=None, px=None, get=False):
+        exists = self._alive(key)
+        if (nx and exists) or (xx and not exists):
+            return False
+        self._data[key] = str(value)
+        self._expires.pop(key, None)
+        if ex:
+            self._expires[key] = time.time() + int(ex)
+        elif px:
+            self._expires[key] = time.time() + int(px) / 1000.0
+        return True
+
+    def _cmd_setex(self, key, seconds, value):
+        return self._cmd_set(key, value, ex=seconds)
+
+    def _cmd_incr(self, key):
+        value = int(self._cmd_get(key) or 0) + 1
+        ttl = self._expires.get(key)
+        self._data[key] = str(value)
+        if ttl is not None:
+            self._expires[key] = ttl
+        return value
+
+    # ---- 集合 ----
+    def _cmd_sadd(self, key, *members):
+        target = self._get_typed(key, set, create=True)
+        before = len(target)
+        target.update(str(m) for m in members)
+        return len(target) - before
+
+    def _cmd_srem(self, key, *members):
+        target = self._get_typed(key, set)
+        if not target:
+            return 0
+        removed = 0
+        for m in members:
+            if str(m) in target:
+                target.discard(str(m))
+                removed += 1
+        if not target:
+            self._cmd_delete(key)
+        return removed
+
+    def _cmd_smembers(self, key):
+        return list(self._get_typed(key, set) or [])
+
+    def _cmd_scard(self, key):
+        return len(self._get_typed(key, set) or [])
+
+    def _cmd_sismember(self, key, member):
+        return str(member) in (self._get_typed(key, set) or ())
+
+    def _cmd_smismember(self, key, *members):
+        target = self._get_typed(key, set) or ()
+        return [str(m) in target for m in members]
+
+    def _cmd_srandmember(self, key, count=None):
+        target = self._get_typed(key, set)
+        if not target:
+            return [] if count is not None else None
+        if count is None:
+            return random.choice(list(target))
+        return random.sample(list(target), min(int(count), len(target)))
+
+    def _cmd_spop(self, key, count=None):
+        target = self._get_typed(key, set)
+        if not target:
+            return [] if count else None
+        picked = random.sample(list(target), min(int(count or 1), len(target)))
+        target.difference_update(picked)
+        if not target:
+            self._cmd_delete(key)
+        return picked if count else picked[0]
+
+    # ---- 列表 ----
+    def _cmd_lpush(self, key, *elements):
+        target = self._get_typed(key, list, create=True)
+        for element in elements:
+            target.insert(0, str(element))
+        return len(target)
+
+    def _cmd_rpush(self, key, *elements):
+        target = self._get_typed(key, list, create=True)
+        target.extend(str(e) for e in elements)
+        return len(target)
+
+    @staticmethod
+    def _list_slice(length, start, stop):
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(0, length + start)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1)
+
+    def _cmd_lrange(self, key, start, stop):
+        target = self._get_typed(key, list) or []
+        lo, hi = self._list_slice(len(target), start, stop)
+        return target[lo:hi + 1] if lo <= hi else []
+
+    def _cmd_ltrim(self, key, start, stop):
+        target = self._get_typed(key, list)
+        if target is None:
+            return True
+        lo, hi = self._list_slice(len(target), start, stop)
+        target[:] = target[lo:hi + 1] if lo <= hi else []
+        if not target:
+            self._cmd_delete(key)
+        return True
+
+    def _cmd_lrem(self, key, count, element):
+        target = self._get_typed(key, list)
+        if not target:
+            return 0
+        count, element = int(count), str(element)
+        indexes = [i for i, v in enumerate(target) if v == element]
+        if count < 0:
+            indexes = indexes[::-1][:-count]
+        elif count > 0:
+            indexes = indexes[:count]
+        for i in sorted(indexes, reverse=True):
+            del target[i]
+        if not target:
+            self._cmd_delete(key)
+        return len(indexes)
+
+    # ---- 有序集合 ----
+    def _cmd_zadd(self, key, scores, nx=False, xx=False, gt=False, lt=False, ch=False, incr=False):
+        target = self._get_typed(key, dict, create=True)
+        added = 0
+        for member, score in scores.items():
+            member, score = str(member), float(score)
+            if member in target:
+                if nx or (gt and score <= target[member]) or (lt and score >= target[member]):
+                    continue
+            elif xx:
+                continue
+            else:
+                added += 1
+            target[member] = score
+        return added
+
+    def _cmd_zcard(self, key):
+        return len(self._get_typed(key, dict) or {})
+
+    def _cmd_zremrangebyscore(self, key, min_score, max_score):
+        target = self._get_typed(key, dict)
+        if not target:
+            return 0
+        lo, hi = float(str(min_score)), float(str(max_score))  # 支持 "-inf" / "+inf"
+        doomed = [m for m, s in target.items() if lo <= s <= hi]
+        for m in doomed:
+            del target[m]
+        if not target:
+            self._cmd_delete(key)
+        return len(doomed)
+
+    def _cmd_zrange(self, key, start, stop, sortby=None, rev=False, offset=None, count=None, withscores=False):
+        target = self._get_typed(key, dict) or {}
+        ordered = sorted(target.items(), key=lambda item: (item[1], item[0]), reverse=bool(rev))
+        lo, hi = self._list_slice(len(ordered), start, stop)
+        picked = ordered[lo:hi + 1] if lo <= hi else []
+        if withscores:
+            return [(m, s) for m, s in picked]
+        return [m for m, _ in picked]
+
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "upstash").strip().lower()
+MEMORY_REDIS_LATENCY_MS = float(os.getenv("MEMORY_REDIS_LATENCY_MS", "0"))
+MEMORY_REDIS_JITTER_MS = float(os.getenv("MEMORY_REDIS_JITTER_MS", "0"))
 
 # ----------------------
 # Redis
 # ----------------------
-redis = upstash_redis.Redis(
-    url=os.getenv("UPSTASH_REDIS_URL"),
-    token=os.getenv("UPSTASH_REDIS_TOKEN")
-)
+# 异步客户端：所有存储调用都在事件循环上 await，底层复用同一个 HTTP 连接池，
+# 慢请求不会再卡住网关事件和 AI 回复。
+# STORAGE_BACKEND=memory 时改用进程内替身（离线测试 / 压测，数据不持久化）。
+if STORAGE_BACKEND == "memory":
+    redis = MemoryRedis(latency_ms=MEMORY_REDIS_LATENCY_MS, jitter_ms=MEMORY_REDIS_JITTER_MS)
+    print(f"⚠️ 使用内存存储后端（延迟 {MEMORY_REDIS_LATENCY_MS}±{MEMORY_REDIS_JITTER_MS}ms），数据不会持久化")
+else:
+    redis = AsyncRedis(
+        url=os.getenv("UPSTASH_REDIS_URL"),
+        token=os.getenv("UPSTASH_REDIS_TOKEN")
+    )
+STORAGE_SYNC_TIMEOUT_SEC = float(os.getenv("STORAGE_SYNC_TIMEOUT_SEC", "15"))
+STORAGE_DEFER_MAX = max(0, int(os.getenv("STORAGE_DEFER_MAX", "1000")))
+_STORAGE_LOOP = None
+_STORAGE_DEFERRED = deque()
+_STORAGE_DEFERRED_LOCK = Lock()
+
+
+class StorageLoopNotReady(RuntimeError):
+    """机器人事件循环尚未就绪（启动中或已停止），存储调用无法提交"""
+
+
+def bind_storage_loop(loop):
+    """记录机器人事件循环，供 Flask / 心跳线程提交存储调用；并补执行就绪前暂存的调用"""
+    global _STORAGE_LOOP
+    with _STORAGE_DEFERRED_LOCK:
+        _STORAGE_LOOP = loop
+        pending = list(_STORAGE_DEFERRED)
+        _STORAGE_DEFERRED.clear()
+    if pending:
+        print(f"🔁 补执行事件循环就绪前暂存的 {len(pending)} 个存储调用")
+        loop.create_task(_run_deferred_storage_calls(pending))
+
+
+def run_storage_sync(coro, timeout: Optional[float] = None):
+    """
+    在非事件循环线程（Flask 接口、心跳）中执行异步存储调用并等待结果。
+    事件循环尚未就绪时抛出 StorageLoopNotReady。
+    """
+    loop = _STORAGE_LOOP
+    if loop is None or not loop.is_running():
+        coro.close()
+        raise StorageLoopNotReady("存储事件循环尚未就绪")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    return future.result(timeout=STORAGE_SYNC_TIMEOUT_SEC if timeout is None else timeout)
+
+
+def defer_storage_call(factory):
+    """
+    事件循环未就绪时暂存一次存储调用（factory 返回协程），bind_storage_loop 时按顺序补执行。
+    暂存队列超过 STORAGE_DEFER_MAX 时丢弃最早的调用。
+    """
+    with _STORAGE_DEFERRED_LOCK:
+        loop = _STORAGE_LOOP
+        if loop is None or not loop.is_running():
+            if STORAGE_DEFER_MAX and len(_STORAGE_DEFERRED) >= STORAGE_DEFER_MAX:
+                _STORAGE_DEFERRED.popleft()
+                print(f"⚠️ 暂存的存储调用超过 {STORAGE_DEFER_MAX} 个，已丢弃最早的一个")
+            _STORAGE_DEFERRED.append(factory)
+            return
+    # 暂存期间事件循环已经就绪：直接提交，不等待结果
+    asyncio.run_coroutine_threadsafe(_run_deferred_storage_calls([factory]), loop)
+
+
+async def _run_deferred_storage_calls(factories: list):
+    for factory in factories:
+        try:
+            await factory()
+        except Exception as e:
+            print(f"❌ 补执行暂存的存储调用失败: {e}")
+
+
+async def iter_scan_pages(pattern: str, cursor: int = 0, count: int = 500, time_budget: float = 10.0):
+    """
+    基于游标的 SCAN 分页迭代器：从 cursor 开始按页产出 (下一页游标, 本页键)，
+    超出 time_budget 秒后停止，避免 KEYS 一次性遍历整个键空间。
+    最后一页游标为 0 表示遍历完成，否则可用它从断点继续。
+    """
+    start_ts = time.time()
+    while True:
+        cursor, keys = await redis.scan(cursor, match=pattern, count=count)
+        cursor = int(cursor or 0)
+        yield cursor, keys or []
+        if cursor == 0:
+            break
+        if time_budget > 0 and time.time() - start_ts > time_budget:
+            print(f"⚠️ SCAN {pattern} 超出时间预算 {time_budget}s，已提前结束")
+            break
+
+
+async def eval_script(script: str, keys: list, args: list):
+    """执行 Lua 脚本：优先 EVALSHA，服务端未缓存时回退 EVAL（同样只需一次往返）"""
+    sha = hashlib.sha1(script.encode("utf-8")).hexdigest()
+    try:
+        return await redis.evalsha(sha, keys=keys, args=args)
+    except Exception as e:
+        if "NOSCRIPT" not in str(e).upper():
+            raise
+    return await redis.eval(script, keys=keys, args=args)
+
+# ----------------------
+# 出站 HTTP 连接池
+# ----------------------
+# 所有外部请求（AI 接口、GitHub API / raw）共用一个 ClientSession，
+# 按主机复用 keep-alive 连接并缓存 DNS，深度扫描时不再每个文件都重新握手。
+HTTP_POOL_LIMIT = max(1, int(os.getenv("HTTP_POOL_LIMIT", "100")))
+HTTP_POOL_LIMIT_PER_HOST = max(0, int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20")))
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "30"))
+HTTP_DNS_CACHE_TTL_SEC = int(os.getenv("HTTP_DNS_CACHE_TTL_SEC", "300"))
+_HTTP_SESSION = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """获取（必要时创建）全局共享的 aiohttp 会话；超时由每个请求单独传入"""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL_SEC,
+            keepalive_timeout=HTTP_KEEPALIVE_SEC
+        )
+        _HTTP_SESSION = aiohttp.ClientSession(connector=connector)
+    return _HTTP_SESSION
+
+
+@asynccontextmanager
+async def shared_http_session():
+    """以 async with 形式借用共享会话，退出时不关闭连接池"""
+    yield await get_http_session()
+
+
+async def close_http_session():
+    global _HTTP_SESSION
+    session, _HTTP_SESSION = _HTTP_SESSION, None
+    if session is not None and not session.closed:
+        await session.close()
 
 # ----------------------
 # AI 聊天与答疑配置
@@ -125,9 +621,14 @@ AI_CHANNEL_CONTEXT_MESSAGES = int(os.getenv("AI_CHANNEL_CONTEXT_MESSAGES", "6"))
 AI_CHANNEL_CONTEXT_MAX_CHARS = int(os.getenv("AI_CHANNEL_CONTEXT_MAX_CHARS", "160"))
 AI_REPLY_COOLDOWN_SEC = float(os.getenv("AI_REPLY_COOLDOWN_SEC", "0"))
 AI_MAX_CONCURRENCY = max(1, int(os.getenv("AI_MAX_CONCURRENCY", "3")))
-AI_STREAMING_ENABLED = False  # 强制统一为非流式回复
+AI_SCHED_WEIGHTS = os.getenv("AI_SCHED_WEIGHTS", "key_help:4,chat:3,qa:1").strip()
+AI_SCHED_MAX_QUEUE = max(0, int(os.getenv("AI_SCHED_MAX_QUEUE", "20")))
+AI_SCHED_QA_MAX_INFLIGHT = max(1, int(os.getenv("AI_SCHED_QA_MAX_INFLIGHT", str(max(1, AI_MAX_CONCURRENCY - 1)))))
+AI_STREAMING_ENABLED = os.getenv("AI_STREAMING_ENABLED", "false").lower() in ("1", "true", "yes", "y", "on")
 AI_STREAMING_UPDATE_INTERVAL_SEC = float(os.getenv("AI_STREAMING_UPDATE_INTERVAL_SEC", "1.2"))
 AI_STREAMING_MIN_CHARS = int(os.getenv("AI_STREAMING_MIN_CHARS", "30"))
+AI_STREAMING_EDITS_PER_WINDOW = max(1, int(os.getenv("AI_STREAMING_EDITS_PER_WINDOW", "4")))
+AI_STREAMING_EDIT_WINDOW_SEC = max(0.5, float(os.getenv("AI_STREAMING_EDIT_WINDOW_SEC", "5")))
 AI_API_RETRY_MAX = max(0, int(os.getenv("AI_API_RETRY_MAX", "2")))
 AI_API_RETRY_BACKOFF_SEC = float(os.getenv("AI_API_RETRY_BACKOFF_SEC", "1.5"))
 AI_QA_MAX_ITERATIONS = max(1, int(os.getenv("AI_QA_MAX_ITERATIONS", "2")))
@@ -154,12 +655,19 @@ AI_REPO_URL = os.getenv("AI_REPO_URL", "https://github.com/lolidoll/ovo").strip(
 AI_REPO_BRANCH = os.getenv("AI_REPO_BRANCH", "main").strip()
 AI_REPO_MAX_FILES = int(os.getenv("AI_REPO_MAX_FILES", "300"))
 AI_REPO_MAX_FILE_BYTES = int(os.getenv("AI_REPO_MAX_FILE_BYTES", "80000"))
+AI_REPO_CONTEXT_TOKEN_BUDGET = max(0, int(os.getenv("AI_REPO_CONTEXT_TOKEN_BUDGET", "6000")))
+AI_REPO_CONTEXT_MAX_CANDIDATES = max(1, int(os.getenv("AI_REPO_CONTEXT_MAX_CANDIDATES", "48")))
+AI_REPO_SNIPPET_DEDUPE_RATIO = min(1.0, max(0.0, float(os.getenv("AI_REPO_SNIPPET_DEDUPE_RATIO", "0.8"))))
 AI_REPO_SCAN_MAX_FILES = int(os.getenv("AI_REPO_SCAN_MAX_FILES", "800"))
 AI_REPO_DEEP_SCAN_MAX_FILES = int(os.getenv("AI_REPO_DEEP_SCAN_MAX_FILES", "24000"))
 AI_REPO_SCAN_CONCURRENCY = max(1, int(os.getenv("AI_REPO_SCAN_CONCURRENCY", "16")))
 AI_REPO_SCAN_MAX_SECONDS = float(os.getenv("AI_REPO_SCAN_MAX_SECONDS", "45"))
 AI_REPO_DEEP_SCAN_MAX_SECONDS = float(os.getenv("AI_REPO_DEEP_SCAN_MAX_SECONDS", "380"))
-AI_REPO_CONTENT_CACHE_TTL_SEC = int(os.getenv("AI_REPO_CONTENT_CACHE_TTL_SEC", "900"))
+AI_REPO_CACHE_DIR = os.getenv(
+    "AI_REPO_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".repo_cache")
+)
+AI_REPO_BLOB_CACHE_MAX_BYTES = int(os.getenv("AI_REPO_BLOB_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
 AI_REPO_SEARCH_MAX_QUERIES = int(os.getenv("AI_REPO_SEARCH_MAX_QUERIES", "5"))
 AI_REPO_RAW_URL_ENABLED = os.getenv("AI_REPO_RAW_URL_ENABLED", "true").lower() in ("1", "true", "yes", "y", "on")
 AI_REPO_FORCE_DEEP_SCAN = os.getenv("AI_REPO_FORCE_DEEP_SCAN", "true").lower() in ("1", "true", "yes", "y", "on")
@@ -167,8 +675,41 @@ AI_REPO_MAX_SNIPPET_LINES = int(os.getenv("AI_REPO_MAX_SNIPPET_LINES", "40"))
 AI_REPO_MAX_SNIPPET_CHARS = int(os.getenv("AI_REPO_MAX_SNIPPET_CHARS", "2000"))
 AI_REPO_CACHE_TTL_SEC = int(os.getenv("AI_REPO_CACHE_TTL_SEC", "0"))
 AI_REPO_TIMEOUT_SEC = float(os.getenv("AI_REPO_TIMEOUT_SEC", "12"))
+# 上下文并发收集：引用消息 / 楼层 / 对话历史各自的超时，以及仓库检索整体超时（0 为不限制）
+AI_CONTEXT_GATHER_TIMEOUT_SEC = float(os.getenv("AI_CONTEXT_GATHER_TIMEOUT_SEC", "6"))
+AI_REPO_CONTEXT_TIMEOUT_SEC = float(os.getenv("AI_REPO_CONTEXT_TIMEOUT_SEC", "420"))
+AI_ANSWER_CACHE_ENABLED = os.getenv("AI_ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes", "y", "on")
+AI_ANSWER_CACHE_TTL_SEC = max(0.0, float(os.getenv("AI_ANSWER_CACHE_TTL_SEC", "1800")))
+AI_ANSWER_CACHE_SIZE = max(0, int(os.getenv("AI_ANSWER_CACHE_SIZE", "512")))
+AI_SEMANTIC_CACHE_ENABLED = os.getenv("AI_SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes", "y", "on")
+AI_SEMANTIC_CACHE_THRESHOLD = min(1.0, max(0.0, float(os.getenv("AI_SEMANTIC_CACHE_THRESHOLD", "0.85"))))
+AI_SEMANTIC_CACHE_SIZE = max(0, int(os.getenv("AI_SEMANTIC_CACHE_SIZE", "1024")))
+AI_SEMANTIC_CACHE_DIM = max(64, int(os.getenv("AI_SEMANTIC_CACHE_DIM", "2048")))
 AI_GITHUB_TOKEN = os.getenv("AI_GITHUB_TOKEN", os.getenv("GITHUB_TOKEN", "")).strip()
 AI_GITHUB_SEARCH_ALLOW_NO_TOKEN = os.getenv("AI_GITHUB_SEARCH_ALLOW_NO_TOKEN", "true").lower() in ("1", "true", "yes", "y", "on")
+# 本地倒排索引：开关、单次构建时长上限、抓取失败后的最长重试退避
+AI_REPO_INDEX_ENABLED = os.getenv("AI_REPO_INDEX_ENABLED", "true").lower() in ("1", "true", "yes", "y", "on")
+AI_REPO_INDEX_BUILD_MAX_SECONDS = float(os.getenv("AI_REPO_INDEX_BUILD_MAX_SECONDS", "380"))
+AI_REPO_INDEX_RETRY_MAX_SEC = max(5.0, float(os.getenv("AI_REPO_INDEX_RETRY_MAX_SEC", "600")))
+# BM25F 排序：词频饱和参数；只保留得分不低于最高分该比例的文件，减少抓取与塞进提示词的低相关文件
+AI_REPO_BM25_K1 = float(os.getenv("AI_REPO_BM25_K1", "1.2"))
+AI_REPO_RANK_MIN_RATIO = min(1.0, max(0.0, float(os.getenv("AI_REPO_RANK_MIN_RATIO", "0.25"))))
+# AI_REPO_SOURCE=mirror：维护 AI_REPO_URL 的浅克隆裸仓库，后台定时 fetch，
+#   文件列表 / 内容读取都走本地对象库（git ls-tree / cat-file --batch）；
+# AI_REPO_SOURCE=local：直接读取 AI_REPO_LOCAL_DIR 目录（测试用）；
+# 默认 github：沿用 GitHub API / raw 在线读取。
+AI_REPO_SOURCE = os.getenv("AI_REPO_SOURCE", "github").strip().lower()
+AI_REPO_MIRROR_DIR = os.getenv("AI_REPO_MIRROR_DIR", os.path.join(AI_REPO_CACHE_DIR, "mirror.git"))
+AI_REPO_MIRROR_REFRESH_SEC = max(30.0, float(os.getenv("AI_REPO_MIRROR_REFRESH_SEC", "300")))
+AI_REPO_LOCAL_DIR = os.getenv("AI_REPO_LOCAL_DIR", "").strip()
+AI_REPO_GIT_TIMEOUT_SEC = float(os.getenv("AI_REPO_GIT_TIMEOUT_SEC", "120"))
+# 仓库检索 CPU 密集工作的进程池大小（0 为在事件循环线程内执行）
+AI_REPO_CPU_WORKERS = max(0, int(os.getenv("AI_REPO_CPU_WORKERS", str(min(4, os.cpu_count() or 1)))))
+# 仓库上下文后台预热：启动后预取文件列表并构建索引，之后按间隔刷新
+AI_REPO_PREWARM_ENABLED = os.getenv("AI_REPO_PREWARM_ENABLED", "true").lower() in ("1", "true", "yes", "y", "on")
+AI_REPO_PREWARM_INTERVAL_SEC = max(30.0, float(os.getenv("AI_REPO_PREWARM_INTERVAL_SEC", "600")))
+# 组装好的仓库上下文缓存条数（按树 SHA + 关键词集合，0 为关闭）
+AI_REPO_CONTEXT_CACHE_SIZE = max(0, int(os.getenv("AI_REPO_CONTEXT_CACHE_SIZE", "256")))
 
 # ----------------------
 # 身份组答题配置
@@ -204,7 +745,7 @@ class TicketManager:
     async def set_ticket_info(channel_id, member_id, ticket_type="support"):
         """设置工单信息"""
         ticket_key = TicketManager.get_ticket_key(channel_id)
-        redis.set(ticket_key, json.dumps({
+        await redis.set(ticket_key, json.dumps({
             "member_id": str(member_id),
             "type": ticket_type,
             "created_at": datetime.now().isoformat(),
@@ -213,10 +754,10 @@ class TicketManager:
         }), ex=86400)  # 24小时过期
 
     @staticmethod
-    def get_ticket_info(channel_id):
+    async def get_ticket_info(channel_id):
         """获取工单信息"""
         ticket_key = TicketManager.get_ticket_key(channel_id)
-        info = redis.get(ticket_key)
+        info = await redis.get(ticket_key)
         if info:
             if isinstance(info, bytes):
                 info = info.decode('utf-8')
@@ -295,14 +836,14 @@ class ProtectedAttachmentManager:
             "download_count": 0
         }
         key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-        redis.set(key, json.dumps(data))  # 长期存储，不过期
+        await redis.set(key, json.dumps(data))  # 长期存储，不过期
         return True
 
     @staticmethod
-    def get_attachments(thread_id):
+    async def get_attachments(thread_id):
         """获取帖子的保护附件信息"""
         key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-        data = redis.get(key)
+        data = await redis.get(key)
         if data:
             if isinstance(data, bytes):
                 data = data.decode('utf-8')
@@ -312,7 +853,7 @@ class ProtectedAttachmentManager:
     @staticmethod
     async def update_attachments(thread_id, new_attachments_data):
         """更新附件内容"""
-        existing = ProtectedAttachmentManager.get_attachments(thread_id)
+        existing = await ProtectedAttachmentManager.get_attachments(thread_id)
         if not existing:
             return False
 
@@ -320,32 +861,32 @@ class ProtectedAttachmentManager:
         existing["updated_at"] = datetime.now().isoformat()
 
         key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-        redis.set(key, json.dumps(existing))  # 长期存储
+        await redis.set(key, json.dumps(existing))  # 长期存储
         return True
 
     @staticmethod
-    def increment_download_count(thread_id):
+    async def increment_download_count(thread_id):
         """增加下载计数"""
-        existing = ProtectedAttachmentManager.get_attachments(thread_id)
+        existing = await ProtectedAttachmentManager.get_attachments(thread_id)
         if existing:
             existing["download_count"] = existing.get("download_count", 0) + 1
             key = ProtectedAttachmentManager.get_attachment_key(thread_id)
-            redis.set(key, json.dumps(existing))  # 长期存储
+            await redis.set(key, json.dumps(existing))  # 长期存储
 
     @staticmethod
-    def record_user_access(thread_id, user_id):
+    async def record_user_access(thread_id, user_id):
         """记录用户已获取访问权限"""
         key = ProtectedAttachmentManager.get_user_access_key(thread_id, user_id)
-        redis.set(key, json.dumps({
+        await redis.set(key, json.dumps({
             "accessed_at": datetime.now().isoformat(),
             "downloads": 1
         }))  # 长期存储
 
     @staticmethod
-    def has_user_access(thread_id, user_id):
+    async def has_user_access(thread_id, user_id):
         """检查用户是否已有访问权限"""
         key = ProtectedAttachmentManager.get_user_access_key(thread_id, user_id)
-        return redis.get(key) is not None
+        return await redis.get(key) is not None
 
     @staticmethod
     async def check_user_engagement(thread: discord.Thread, user: discord.Member):
@@ -390,17 +931,24 @@ class ProtectedAttachmentManager:
 # ----------------------
 # 帖子置底消息管理器
 # ----------------------
+THREAD_BOTTOM_CACHE_TTL_SEC = int(os.getenv("THREAD_BOTTOM_CACHE_TTL_SEC", "300"))
+THREAD_BOTTOM_CACHE_MAX = 5000
+THREAD_BOTTOM_NOTICE_TYPES = ("attachment", "announcement")
+
+
 class ThreadBottomManager:
     """处理论坛帖子置底消息（保护附件下载入口、公告）"""
 
+    # 进程内缓存：channel_id -> {"ts": 载入时间, "attachment": cfg|None, "announcement": cfg|None}
+    # 两项都为 None 即为负缓存，普通频道聊天不再访问 Redis
+    _cache = {}
+
     @staticmethod
     def get_notice_key(thread_id, notice_type):
         return f"thread:bottom_notice:{thread_id}:{notice_type}"
 
     @staticmethod
-    def get_notice(thread_id, notice_type):
-        key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
-        raw = redis.get(key)
+    def _parse_notice(raw):
         if not raw:
             return None
         try:
@@ -413,14 +961,58 @@ class ThreadBottomManager:
             return None
 
     @staticmethod
-    def set_notice(thread_id, notice_type, data):
+    def _cache_put(thread_id, notice_type, data):
+        cache = ThreadBottomManager._cache
+        entry = cache.get(str(thread_id))
+        if entry is None:
+            # 未整体载入过的频道只记一项会被误当成另一项"无配置"，直接跳过
+            return
+        entry[notice_type] = data
+
+    @staticmethod
+    async def get_channel_notices(thread_id):
+        """读取频道的全部置底配置（读穿缓存，一次 MGET 载入两种类型）"""
+        cache = ThreadBottomManager._cache
+        cache_key = str(thread_id)
+        now = time.time()
+        entry = cache.get(cache_key)
+        if entry and now - entry["ts"] < THREAD_BOTTOM_CACHE_TTL_SEC:
+            return entry
+
+        keys = [ThreadBottomManager.get_notice_key(thread_id, t) for t in THREAD_BOTTOM_NOTICE_TYPES]
+        raws = await redis.mget(*keys) or []
+        entry = {"ts": now}
+        for idx, notice_type in enumerate(THREAD_BOTTOM_NOTICE_TYPES):
+            raw = raws[idx] if idx < len(raws) else None
+            entry[notice_type] = ThreadBottomManager._parse_notice(raw)
+
+        if len(cache) >= THREAD_BOTTOM_CACHE_MAX:
+            expired = [k for k, v in cache.items() if now - v["ts"] >= THREAD_BOTTOM_CACHE_TTL_SEC]
+            for k in expired:
+                cache.pop(k, None)
+            if len(cache) >= THREAD_BOTTOM_CACHE_MAX:
+                cache.clear()
+        cache[cache_key] = entry
+        return entry
+
+    @staticmethod
+    async def get_notice(thread_id, notice_type):
+        key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
+        data = ThreadBottomManager._parse_notice(await redis.get(key))
+        ThreadBottomManager._cache_put(thread_id, notice_type, data)
+        return data
+
+    @staticmethod
+    async def set_notice(thread_id, notice_type, data):
         key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
-        redis.set(key, json.dumps(data, ensure_ascii=False))
+        await redis.set(key, json.dumps(data, ensure_ascii=False))
+        ThreadBottomManager._cache_put(thread_id, notice_type, data)
 
     @staticmethod
-    def delete_notice(thread_id, notice_type):
+    async def delete_notice(thread_id, notice_type):
         key = ThreadBottomManager.get_notice_key(thread_id, notice_type)
-        redis.delete(key)
+        await redis.delete(key)
+        ThreadBottomManager._cache_put(thread_id, notice_type, None)
 
 
 def _now_text():
@@ -464,8 +1056,8 @@ async def _delete_thread_message_if_exists(channel, message_id):
         print(f"⚠️ 删除旧置底消息失败: {e}")
 
 
-def _build_attachment_bottom_embed(thread: discord.Thread):
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+async def _build_attachment_bottom_embed(thread: discord.Thread):
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         return None
 
@@ -507,30 +1099,30 @@ def _build_announcement_bottom_embed(channel, content: str):
 
 
 async def _repost_attachment_bottom_notice(thread: discord.Thread, config: dict):
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await _delete_thread_message_if_exists(thread, config.get("message_id"))
-        ThreadBottomManager.delete_notice(thread.id, "attachment")
+        await ThreadBottomManager.delete_notice(thread.id, "attachment")
         return
 
     await _delete_thread_message_if_exists(thread, config.get("message_id"))
 
-    embed = _build_attachment_bottom_embed(thread)
+    embed = await _build_attachment_bottom_embed(thread)
     if not embed:
-        ThreadBottomManager.delete_notice(thread.id, "attachment")
+        await ThreadBottomManager.delete_notice(thread.id, "attachment")
         return
 
     sent = await thread.send(embed=embed)
     config["message_id"] = str(sent.id)
     config["updated_at"] = _now_text()
-    ThreadBottomManager.set_notice(thread.id, "attachment", config)
+    await ThreadBottomManager.set_notice(thread.id, "attachment", config)
 
 
 async def _repost_announcement_bottom_notice(channel, config: dict):
     content = str(config.get("content", "")).strip()
     if not content:
         await _delete_thread_message_if_exists(channel, config.get("message_id"))
-        ThreadBottomManager.delete_notice(channel.id, "announcement")
+        await ThreadBottomManager.delete_notice(channel.id, "announcement")
         return
 
     await _delete_thread_message_if_exists(channel, config.get("message_id"))
@@ -539,7 +1131,7 @@ async def _repost_announcement_bottom_notice(channel, config: dict):
     sent = await channel.send(embed=embed)
     config["message_id"] = str(sent.id)
     config["updated_at"] = _now_text()
-    ThreadBottomManager.set_notice(channel.id, "announcement", config)
+    await ThreadBottomManager.set_notice(channel.id, "announcement", config)
 
 
 async def refresh_thread_bottom_notices(channel):
@@ -547,9 +1139,22 @@ async def refresh_thread_bottom_notices(channel):
     if not _is_announcement_bottom_channel(channel):
         return
 
+    try:
+        notices = await ThreadBottomManager.get_channel_notices(channel.id)
+    except Exception as e:
+        print(f"⚠️ 读取置底配置失败: {e}")
+        return
+
+    attachment_cfg = notices.get("attachment") if isinstance(channel, discord.Thread) else None
+    announcement_cfg = notices.get("announcement")
+    attachment_on = bool(attachment_cfg and attachment_cfg.get("enabled"))
+    announcement_on = bool(announcement_cfg and announcement_cfg.get("enabled"))
+    if not attachment_on and not announcement_on:
+        return
+
     lock_key = f"thread:bottom_notice:lock:{channel.id}"
     try:
-        locked = redis.set(lock_key, "1", nx=True, ex=5)
+        locked = await redis.set(lock_key, "1", nx=True, ex=5)
     except Exception:
         locked = True
 
@@ -557,28 +1162,30 @@ async def refresh_thread_bottom_notices(channel):
         return
 
     try:
+        # 拿到锁后重新取一次（通常命中缓存），避免用到上一次重发前的 message_id
+        notices = await ThreadBottomManager.get_channel_notices(channel.id)
         if isinstance(channel, discord.Thread):
-            attachment_cfg = ThreadBottomManager.get_notice(channel.id, "attachment")
+            attachment_cfg = notices.get("attachment")
             if attachment_cfg and attachment_cfg.get("enabled"):
-                await _repost_attachment_bottom_notice(channel, attachment_cfg)
+                await _repost_attachment_bottom_notice(channel, dict(attachment_cfg))
 
-        announcement_cfg = ThreadBottomManager.get_notice(channel.id, "announcement")
+        announcement_cfg = notices.get("announcement")
         if announcement_cfg and announcement_cfg.get("enabled"):
-            await _repost_announcement_bottom_notice(channel, announcement_cfg)
+            await _repost_announcement_bottom_notice(channel, dict(announcement_cfg))
     except Exception as e:
         print(f"⚠️ 刷新帖子置底消息失败: {e}")
     finally:
         try:
-            redis.delete(lock_key)
+            await redis.delete(lock_key)
         except Exception:
             pass
 
 # ----------------------
 # 工具函数
 # ----------------------
-def acquire_cmd_lock(interaction_id):
+async def acquire_cmd_lock(interaction_id):
     try:
-        return redis.set(f"cmd:lock:{interaction_id}", "1", nx=True, ex=10)
+        return await redis.set(f"cmd:lock:{interaction_id}", "1", nx=True, ex=10)
     except:
         return True
 
@@ -641,7 +1248,7 @@ async def ensure_fish_quiz_panel():
         return
 
     key = _fish_quiz_panel_key(channel.id)
-    raw_msg_id = clean_key(redis.get(key))
+    raw_msg_id = clean_key(await redis.get(key))
     panel_message = None
 
     if raw_msg_id:
@@ -662,7 +1269,7 @@ async def ensure_fish_quiz_panel():
 
     try:
         sent = await channel.send(embed=embed, view=view)
-        redis.set(key, str(sent.id))
+        await redis.set(key, str(sent.id))
     except Exception as e:
         print(f"⚠️ 发送答题面板失败: {e}")
 
@@ -835,8 +1442,95 @@ def parse_user_agent(ua):
         "detail": detail
     }
 
+def _is_key_used_value(val) -> bool:
+    return val == "true" or val is True or val == 1
+
+
+def _parse_json_record(raw):
+    if raw is None:
+        return None
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    return raw if isinstance(raw, dict) else None
+
+
+async def load_user_key_records(uid) -> list:
+    """
+    批量读取用户的全部密钥记录。
+
+    一次 LRANGE 取出密钥列表，再用一个流水线请求（三个 MGET + 一个 SMISMEMBER）
+    取回 key:used / key:info / key:owner / keys:issued，往返次数不随密钥数量增长。
+    返回的每条记录同时包含 generate_csv_report 所需的字段。
+    """
+    raw_keys = await redis.lrange(f"user:keys:{uid}", 0, -1) or []
+    keys = [clean_key(k) for k in raw_keys]
+    if not keys:
+        return []
+
+    pipe = redis.pipeline()
+    pipe.mget(*[f"key:used:{k}" for k in keys])
+    pipe.mget(*[f"key:info:{k}" for k in keys])
+    pipe.mget(*[f"key:owner:{k}" for k in keys])
+    pipe.smismember("keys:issued", *keys)
+    used_values, info_values, owner_values, issued_flags = await pipe.exec()
+
+    used_values = used_values or []
+    info_values = info_values or []
+    owner_values = owner_values or []
+    issued_flags = issued_flags or []
+
+    records = []
+    for i, k in enumerate(keys):
+        used = _is_key_used_value(used_values[i] if i < len(used_values) else None)
+        issued = bool(issued_flags[i]) if i < len(issued_flags) else False
+
+        try:
+            owner = _parse_json_record(owner_values[i] if i < len(owner_values) else None)
+        except Exception:
+            owner = None
+
+        info = {}
+        info_ok = True
+        if used:
+            try:
+                info = _parse_json_record(info_values[i] if i < len(info_values) else None) or {}
+            except Exception:
+                info_ok = False
+
+        device_info = parse_user_agent(info.get("userAgent", "未知")) if used and info_ok else {}
+        if used:
+            status = "已使用"
+        elif issued:
+            status = "已发出"
+        else:
+            status = "未知"
+
+        records.append({
+            "key": k,
+            "uid": str(uid),
+            "owner": owner,
+            "info": info,
+            "info_ok": info_ok,
+            "used": used,
+            "issued": issued,
+            "owner_name": (owner or {}).get("name", ""),
+            "issued_at": (owner or {}).get("issuedAt", ""),
+            "method": (owner or {}).get("method", ""),
+            "status": status,
+            "used_at": str(info.get("usedAt", ""))[:19] if used else "",
+            "ip": info.get("ip", "") if used else "",
+            "device": device_info.get("device", ""),
+            "os": device_info.get("os", ""),
+            "browser": device_info.get("browser", ""),
+            "user_agent": info.get("userAgent", "") if used else ""
+        })
+    return records
+
+
 def generate_csv_report(keys_data):
-    """生成CSV格式的报表"""
+    """生成CSV格式的报表（keys_data 为 load_user_key_records 的返回值）"""
     output = StringIO()
     writer = csv.writer(output)
 
@@ -915,12 +1609,10 @@ FAQ_ITEMS = [
 
 _AI_LAST_REPLY_AT = {}
 _AI_LAST_NOTICE_AT = {}
-_AI_SEMAPHORE = asyncio.Semaphore(AI_MAX_CONCURRENCY)
 _AI_MISSING_KEY_LOGGED = False
 _AI_STICKER_LAST_SENT_AT = {}
 _COMMAND_CATALOG_CACHE = {"text": "", "ts": 0.0}
-_REPO_TREE_CACHE = {"ts": 0.0, "files": []}
-_REPO_FILE_CONTENT_CACHE = {}
+_REPO_TREE_CACHE = {"ts": 0.0, "files": [], "sha": "", "blobs": {}, "etag": "", "by_lower": {}}
 _REPO_DOC_EXTS = (".md", ".mdx", ".markdown")
 _REPO_CODE_EXTS = (".py", ".js", ".ts", ".tsx", ".jsx", ".json", ".html", ".css")
 _REPO_ALLOWED_EXTS = _REPO_CODE_EXTS + _REPO_DOC_EXTS
@@ -1017,25 +1709,378 @@ def _parse_github_repo(url: str) -> tuple:
     return owner, repo
 
 
-def _get_cached_repo_content(path: str) -> Optional[str]:
-    if not AI_REPO_CONTENT_CACHE_TTL_SEC:
-        return None
-    entry = _REPO_FILE_CONTENT_CACHE.get(path)
-    if not entry:
-        return None
-    ts = entry.get("ts", 0)
-    if time.time() - ts > AI_REPO_CONTENT_CACHE_TTL_SEC:
-        _REPO_FILE_CONTENT_CACHE.pop(path, None)
-        return None
-    return entry.get("content")
+def _git_blob_sha(data: bytes) -> str:
+    """与 git 相同的 blob SHA-1：sha1("blob <长度>\0" + 内容)"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class RepoBlobCache:
+    """
+    按 git blob SHA 寻址的磁盘缓存：<目录>/<sha前2位>/<sha>。
+    内容不可变，推送新提交后只有真正变化的文件会换 SHA 重新抓取；
+    总字节数超过上限时按最近使用时间（LRU）淘汰，重启后直接复用。
+    磁盘读写都放到线程里执行，事件循环只维护内存中的条目表。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self._entries = None
+        self._total_bytes = 0
+        self._load_lock = asyncio.Lock()
+        self._writing = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, sha: str) -> str:
+        return os.path.join(self.root, sha[:2], sha)
+
+    def _scan_entries(self) -> list:
+        found = []
+        if os.path.isdir(self.root):
+            for bucket in os.scandir(self.root):
+                if not bucket.is_dir():
+                    continue
+                for entry in os.scandir(bucket.path):
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        st = entry.stat()
+                        found.append((st.st_mtime, entry.name, st.st_size))
+        found.sort()
+        return found
+
+    async def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        async with self._load_lock:
+            if self._entries is not None:
+                return
+            found = await asyncio.to_thread(self._scan_entries)
+            self._entries = OrderedDict((name, size) for _, name, size in found)
+            self._total_bytes = sum(self._entries.values())
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{random.getrandbits(32):08x}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove_files(paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def get(self, sha: str) -> Optional[str]:
+        if not sha:
+            return None
+        await self._ensure_loaded()
+        if sha not in self._entries:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self._read_file, self._path(sha))
+        except OSError:
+            self._total_bytes -= self._entries.pop(sha, 0)
+            self.misses += 1
+            return None
+        if sha in self._entries:
+            self._entries.move_to_end(sha)
+        self.hits += 1
+        return data.decode("utf-8", errors="ignore")
+
+    async def put(self, sha: str, data: bytes):
+        if not sha or self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        await self._ensure_loaded()
+        if sha in self._entries:
+            self._entries.move_to_end(sha)
+            return
+        if sha in self._writing:
+            return
+        self._writing.add(sha)
+        try:
+            await asyncio.to_thread(self._write_file, self._path(sha), data)
+        except OSError as e:
+            print(f"⚠️ 仓库文件缓存写入失败: {e}")
+            return
+        finally:
+            self._writing.discard(sha)
+        self._entries[sha] = len(data)
+        self._total_bytes += len(data)
+        evicted = []
+        while self._total_bytes > self.max_bytes and self._entries:
+            old_sha, old_size = self._entries.popitem(last=False)
+            self._total_bytes -= old_size
+            evicted.append(self._path(old_sha))
+        if evicted:
+            await asyncio.to_thread(self._remove_files, evicted)
+
+
+_REPO_BLOB_CACHE = RepoBlobCache(os.path.join(AI_REPO_CACHE_DIR, "blobs"), AI_REPO_BLOB_CACHE_MAX_BYTES)
+
+
+def _repo_blob_sha(path: str) -> str:
+    return _REPO_TREE_CACHE.get("blobs", {}).get(path, "")
+
+
+async def _decode_repo_blob(data: bytes) -> str:
+    """按 blob SHA 写入磁盘缓存并解码为文本"""
+    await _REPO_BLOB_CACHE.put(_git_blob_sha(data), data)
+    return data.decode("utf-8", errors="ignore")
+
+
+# ----------------------
+# 仓库本地镜像 / 本地目录
+# ----------------------
+# 读取来源见配置区 AI_REPO_SOURCE（github / mirror / local）。
+
+
+def _repo_reads_locally() -> bool:
+    return AI_REPO_SOURCE in ("mirror", "local")
+
+
+def _git_auth_env() -> dict:
+    """
+    通过 GIT_CONFIG_* 环境变量注入 http.<主机>.extraHeader 认证头：
+    令牌不写进远端 URL（不会落盘到镜像的 config），也不出现在 git 进程的命令行里。
+    """
+    if not AI_GITHUB_TOKEN:
+        return {}
+    parts = urlsplit(AI_REPO_URL)
+    if parts.scheme != "https" or not parts.netloc:
+        return {}
+    credentials = base64.b64encode(f"x-access-token:{AI_GITHUB_TOKEN}".encode("utf-8")).decode("ascii")
+    return {
+        "GIT_CONFIG_COUNT": "1",
+        "GIT_CONFIG_KEY_0": f"http.https://{parts.netloc}/.extraHeader",
+        "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials}",
+    }
 
 
-def _set_cached_repo_content(path: str, content: str):
-    if not AI_REPO_CONTENT_CACHE_TTL_SEC:
+async def _run_git(*args, cwd: Optional[str] = None, auth: bool = False) -> bytes:
+    """执行 git 命令并返回 stdout；失败时抛出 RuntimeError（错误信息中隐去令牌）"""
+    env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+    if auth:
+        env.update(_git_auth_env())
+    proc = await asyncio.create_subprocess_exec(
+        "git", *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=AI_REPO_GIT_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise RuntimeError(f"git {args[0]} 超时")
+    if proc.returncode != 0:
+        message = stderr.decode("utf-8", errors="ignore").strip()
+        if AI_GITHUB_TOKEN:
+            message = message.replace(AI_GITHUB_TOKEN, "***")
+        raise RuntimeError(f"git {args[0]} 失败: {message[:300]}")
+    return stdout
+
+
+class GitCatFileBatch:
+    """常驻的 git cat-file --batch 进程，按 blob SHA 连续读取对象，避免每个文件起一个进程"""
+
+    def __init__(self, git_dir: str):
+        self.git_dir = git_dir
+        self._proc = None
+        self._lock = asyncio.Lock()
+
+    async def _ensure_proc(self):
+        if self._proc is None or self._proc.returncode is not None:
+            self._proc = await asyncio.create_subprocess_exec(
+                "git", "--git-dir", self.git_dir, "cat-file", "--batch",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        return self._proc
+
+    async def read(self, sha: str) -> Optional[bytes]:
+        async with self._lock:
+            proc = await self._ensure_proc()
+            try:
+                proc.stdin.write(sha.encode("ascii") + b"\n")
+                await proc.stdin.drain()
+                header = (await proc.stdout.readline()).decode("ascii", errors="ignore").split()
+                if len(header) < 3 or header[1] == "missing":
+                    return None
+                data = await proc.stdout.readexactly(int(header[2]))
+                await proc.stdout.readexactly(1)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                await self.close()
+                return None
+            return data if header[1] == "blob" else None
+
+    async def close(self):
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+
+_REPO_MIRROR_LOCK = asyncio.Lock()
+_REPO_MIRROR_STATE = {"fetched_at": 0.0, "task": None}
+_REPO_CAT_FILE = GitCatFileBatch(AI_REPO_MIRROR_DIR)
+
+
+async def _sync_repo_mirror(force: bool = False):
+    """首次浅克隆裸仓库，之后按 AI_REPO_MIRROR_REFRESH_SEC 间隔 fetch"""
+    async with _REPO_MIRROR_LOCK:
+        now = time.time()
+        has_mirror = _repo_mirror_exists()
+        if has_mirror and not force and now - _REPO_MIRROR_STATE["fetched_at"] < AI_REPO_MIRROR_REFRESH_SEC:
+            return
+        ref = f"+refs/heads/{AI_REPO_BRANCH}:refs/heads/{AI_REPO_BRANCH}"
+        if not has_mirror:
+            os.makedirs(os.path.dirname(AI_REPO_MIRROR_DIR) or ".", exist_ok=True)
+            await _run_git(
+                "clone", "--bare", "--depth", "1", "--single-branch", "--branch", AI_REPO_BRANCH,
+                AI_REPO_URL, AI_REPO_MIRROR_DIR,
+                auth=True
+            )
+            print(f"📦 已克隆仓库镜像: {AI_REPO_URL}@{AI_REPO_BRANCH}")
+        else:
+            # 旧版本曾把带令牌的 URL 写进镜像 config，这里统一改回不含令牌的地址
+            await _run_git("--git-dir", AI_REPO_MIRROR_DIR, "config", "remote.origin.url", AI_REPO_URL)
+            await _run_git(
+                "--git-dir", AI_REPO_MIRROR_DIR, "fetch", "--depth", "1", "--prune",
+                AI_REPO_URL, ref,
+                auth=True
+            )
+        _REPO_MIRROR_STATE["fetched_at"] = time.time()
+
+
+def _repo_mirror_exists() -> bool:
+    return os.path.isdir(os.path.join(AI_REPO_MIRROR_DIR, "objects"))
+
+
+async def _ensure_repo_mirror():
+    """请求路径只在镜像不存在时克隆；已有镜像直接读取当前引用，fetch 交给后台同步任务"""
+    if _repo_mirror_exists():
         return
-    if not path or content is None:
+    await _sync_repo_mirror()
+
+
+async def _repo_mirror_refresh_loop():
+    while True:
+        try:
+            await _sync_repo_mirror(force=True)
+        except Exception as e:
+            print(f"⚠️ 仓库镜像同步失败: {e}")
+        await asyncio.sleep(AI_REPO_MIRROR_REFRESH_SEC)
+
+
+def start_repo_mirror_refresh():
+    """镜像模式下启动后台同步任务（重复调用只启动一次）"""
+    if AI_REPO_SOURCE != "mirror" or not AI_REPO_READ_ENABLED:
         return
-    _REPO_FILE_CONTENT_CACHE[path] = {"ts": time.time(), "content": content}
+    task = _REPO_MIRROR_STATE["task"]
+    if task is None or task.done():
+        _REPO_MIRROR_STATE["task"] = asyncio.create_task(_repo_mirror_refresh_loop())
+
+
+async def _list_mirror_tree(known_sha: str = "") -> tuple:
+    """返回 (树 SHA, [(路径, 大小, blob SHA)])；树 SHA 与 known_sha 相同时列表为 None"""
+    await _ensure_repo_mirror()
+    git_dir = AI_REPO_MIRROR_DIR
+    tree_sha = (await _run_git("--git-dir", git_dir, "rev-parse", f"refs/heads/{AI_REPO_BRANCH}^{{tree}}")).decode().strip()
+    if known_sha and tree_sha == known_sha:
+        return tree_sha, None
+    raw = await _run_git("--git-dir", git_dir, "ls-tree", "-r", "-l", "-z", tree_sha)
+    entries = []
+    for record in raw.split(b"\0"):
+        if not record or b"\t" not in record:
+            continue
+        meta, path = record.split(b"\t", 1)
+        parts = meta.split()
+        if len(parts) < 4 or parts[1] != b"blob":
+            continue
+        size = int(parts[3]) if parts[3].isdigit() else 0
+        entries.append((path.decode("utf-8", errors="ignore"), size, parts[2].decode("ascii")))
+    return tree_sha, entries
+
+
+# 本地目录模式的 blob SHA 缓存：路径 -> (mtime_ns, 大小, blob SHA)，文件未变化时不重新读取哈希
+_REPO_LOCAL_SHA_CACHE = {}
+
+
+def _list_local_dir_tree() -> tuple:
+    """本地目录模式：遍历 AI_REPO_LOCAL_DIR，按 git 规则计算 blob SHA（按修改时间与大小缓存）"""
+    global _REPO_LOCAL_SHA_CACHE
+    root = os.path.abspath(AI_REPO_LOCAL_DIR)
+    previous = _REPO_LOCAL_SHA_CACHE
+    sha_cache = {}
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != ".git"]
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(full_path, root).replace(os.sep, "/")
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            cached = previous.get(rel_path)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                sha = cached[2]
+            else:
+                try:
+                    with open(full_path, "rb") as f:
+                        data = f.read()
+                except OSError:
+                    continue
+                sha = _git_blob_sha(data)
+            sha_cache[rel_path] = (st.st_mtime_ns, st.st_size, sha)
+            entries.append((rel_path, st.st_size, sha))
+    _REPO_LOCAL_SHA_CACHE = sha_cache
+    entries.sort()
+    tree_sha = hashlib.sha1("\n".join(f"{p} {s}" for p, _, s in entries).encode("utf-8")).hexdigest()
+    return tree_sha, entries
+
+
+def _read_local_file_bytes(full_path: str) -> bytes:
+    with open(full_path, "rb") as f:
+        return f.read(AI_REPO_MAX_FILE_BYTES + 1 if AI_REPO_MAX_FILE_BYTES > 0 else -1)
+
+
+async def _read_local_repo_file(path: str) -> Optional[str]:
+    """读取失败返回 None（与内容为空区分），超出大小限制返回空字符串"""
+    if AI_REPO_SOURCE == "local":
+        root = os.path.abspath(AI_REPO_LOCAL_DIR)
+        full_path = os.path.abspath(os.path.join(root, path))
+        if not full_path.startswith(root + os.sep):
+            return ""
+        try:
+            data = await asyncio.to_thread(_read_local_file_bytes, full_path)
+        except OSError:
+            return None
+    else:
+        sha = _repo_blob_sha(path)
+        if not sha:
+            return ""
+        data = await _REPO_CAT_FILE.read(sha)
+        if data is None:
+            return None
+    if AI_REPO_MAX_FILE_BYTES > 0 and len(data) > AI_REPO_MAX_FILE_BYTES:
+        return ""
+    return data.decode("utf-8", errors="ignore")
 
 
 def _extract_cn_phrases(text: str) -> list:
@@ -1045,13 +2090,6 @@ def _extract_cn_phrases(text: str) -> list:
     return list(dict.fromkeys(phrases))
 
 
-def _tokenize_repo_path(path: str) -> list:
-    if not path:
-        return []
-    tokens = re.split(r"[^a-z0-9]+", path.lower())
-    return [t for t in tokens if t]
-
-
 def _is_doc_path(path_lower: str) -> bool:
     return path_lower.endswith(_REPO_DOC_EXTS)
 
@@ -1073,32 +2111,6 @@ def _prefer_code_paths(paths: list) -> list:
     return ordered
 
 
-def _score_repo_path(path_lower: str, keywords: list) -> int:
-    if not path_lower or not keywords:
-        return 0
-    tokens = _tokenize_repo_path(path_lower)
-    filename = path_lower.rsplit("/", 1)[-1]
-    score = 0
-    for raw in keywords:
-        if not raw:
-            continue
-        key = str(raw).lower()
-        if len(key) < 2:
-            continue
-        if key in path_lower:
-            score += 2
-        if key in tokens:
-            score += 3
-        if key in filename:
-            score += 2
-    score -= min(len(path_lower) // 80, 3)
-    if _is_doc_path(path_lower):
-        score -= 2
-    else:
-        score += 1
-    return score
-
-
 def _should_read_repo_code(text: str) -> bool:
     if not text:
         return False
@@ -1145,18 +2157,16 @@ def _extract_repo_keywords(text: str) -> list:
 def _select_repo_files(file_list: list, path_candidates: list, keywords: list) -> list:
     if not file_list:
         return []
-    path_to_size = {f["path"].lower(): f.get("size", 0) for f in file_list}
-    normalized_paths = [f["path"] for f in file_list]
+    table = _repo_file_table(file_list)
 
     if path_candidates:
         matched = []
         for candidate in path_candidates:
             cand_lower = candidate.lower()
-            for path in normalized_paths:
-                path_lower = path.lower()
+            for path_lower, item in table.items():
                 if path_lower == cand_lower or path_lower.endswith("/" + cand_lower):
-                    if path_to_size.get(path_lower, 0) <= AI_REPO_MAX_FILE_BYTES:
-                        matched.append(path)
+                    if item.get("size", 0) <= AI_REPO_MAX_FILE_BYTES:
+                        matched.append(item["path"])
         if matched:
             matched = _prefer_code_paths(matched)
             return matched[:AI_REPO_MAX_FILES]
@@ -1164,20 +2174,9 @@ def _select_repo_files(file_list: list, path_candidates: list, keywords: list) -
     if not keywords:
         return []
 
-    scored = []
-    for path in normalized_paths:
-        path_lower = path.lower()
-        if not path_lower.endswith(_REPO_ALLOWED_EXTS):
-            continue
-        if path_to_size.get(path_lower, 0) > AI_REPO_MAX_FILE_BYTES:
-            continue
-        score = _score_repo_path(path_lower, keywords)
-        if score > 0:
-            scored.append((score, path))
-
-    scored.sort(key=lambda x: (-x[0], len(x[1])))
-    paths = [p for _, p in scored]
-    paths = _prefer_code_paths(paths)
+    # 路径 + 文件名两个字段的 BM25F 排序
+    hits = _get_repo_path_index(file_list).search(keywords, AI_REPO_MAX_FILES, fields=("path", "name"))
+    paths = _prefer_code_paths([p for _, p in hits])
     return paths[:AI_REPO_MAX_FILES]
 
 
@@ -1185,8 +2184,7 @@ def _select_repo_fallback_files(file_list: list) -> list:
     if not file_list:
         return []
 
-    path_to_size = {f["path"].lower(): f.get("size", 0) for f in file_list}
-    lower_to_path = {f["path"].lower(): f["path"] for f in file_list}
+    table = _repo_file_table(file_list)
 
     code_candidates = [
         f for f in file_list
@@ -1212,12 +2210,12 @@ def _select_repo_fallback_files(file_list: list) -> list:
     selected = []
     for pref in preferred:
         pref_lower = pref.lower()
-        real_path = lower_to_path.get(pref_lower)
-        if not real_path:
+        item = table.get(pref_lower)
+        if not item:
             continue
-        if path_to_size.get(pref_lower, 0) > AI_REPO_MAX_FILE_BYTES:
+        if item.get("size", 0) > AI_REPO_MAX_FILE_BYTES:
             continue
-        selected.append(real_path)
+        selected.append(item["path"])
         if len(selected) >= AI_REPO_MAX_FILES:
             return selected
 
@@ -1239,42 +2237,34 @@ def _select_repo_fallback_files(file_list: list) -> list:
     return [f["path"] for f in ext_candidates[:AI_REPO_MAX_FILES]]
 
 
-def _extract_repo_snippet(content: str, keywords: list) -> str:
-    if not content:
-        return ""
-    lines = content.splitlines()
-    max_lines = min(AI_REPO_MAX_SNIPPET_LINES, len(lines))
-    if not keywords:
-        snippet = "\n".join(f"{i + 1}: {lines[i]}" for i in range(max_lines))
-        if AI_REPO_MAX_SNIPPET_CHARS > 0 and len(snippet) > AI_REPO_MAX_SNIPPET_CHARS:
-            trimmed = snippet[:AI_REPO_MAX_SNIPPET_CHARS]
-            if "\n" in trimmed:
-                trimmed = trimmed.rsplit("\n", 1)[0]
-            snippet = trimmed.rstrip() + "\n..."
-        return snippet
-
-    lowered = [k.lower() for k in keywords]
-    indexes = []
-    for i, line in enumerate(lines):
-        lline = line.lower()
-        if any(k in lline for k in lowered):
-            start = max(0, i - 2)
-            end = min(len(lines), i + 3)
-            indexes.extend(range(start, end))
-        if len(indexes) >= max_lines:
-            break
+class RepoKeywordMatcher:
+    """
+    每次提问编译一次的多关键词匹配器：所有关键词合并为一个忽略大小写的正则（长词优先），
+    单遍扫描文件即可得到命中的关键词集合和命中行号，供打分与摘要窗口共用。
+    """
 
-    if not indexes:
-        snippet = "\n".join(f"{i + 1}: {lines[i]}" for i in range(max_lines))
-        if AI_REPO_MAX_SNIPPET_CHARS > 0 and len(snippet) > AI_REPO_MAX_SNIPPET_CHARS:
-            trimmed = snippet[:AI_REPO_MAX_SNIPPET_CHARS]
-            if "\n" in trimmed:
-                trimmed = trimmed.rsplit("\n", 1)[0]
-            snippet = trimmed.rstrip() + "\n..."
-        return snippet
+    def __init__(self, keywords: list):
+        terms = sorted({str(k).lower() for k in (keywords or []) if k}, key=len, reverse=True)
+        self.pattern = re.compile("|".join(map(re.escape, terms)), re.IGNORECASE) if terms else None
 
-    unique_indexes = sorted(set(indexes))[:max_lines]
-    snippet = "\n".join(f"{i + 1}: {lines[i]}" for i in unique_indexes)
+    def scan(self, content: str) -> tuple:
+        """返回 (命中的关键词集合, 按顺序去重的命中行号列表)"""
+        found = set()
+        lines = []
+        if not self.pattern or not content:
+            return found, lines
+        line_no = 0
+        pos = 0
+        for match in self.pattern.finditer(content):
+            line_no += content.count("\n", pos, match.start())
+            pos = match.start()
+            found.add(match.group(0).lower())
+            if not lines or lines[-1] != line_no:
+                lines.append(line_no)
+        return found, lines
+
+
+def _trim_repo_snippet(snippet: str) -> str:
     if AI_REPO_MAX_SNIPPET_CHARS > 0 and len(snippet) > AI_REPO_MAX_SNIPPET_CHARS:
         trimmed = snippet[:AI_REPO_MAX_SNIPPET_CHARS]
         if "\n" in trimmed:
@@ -1283,13 +2273,129 @@ def _extract_repo_snippet(content: str, keywords: list) -> str:
     return snippet
 
 
-async def _fetch_repo_tree() -> list:
+def _extract_repo_snippet(
+    content: str,
+    keywords: list,
+    matcher: Optional[RepoKeywordMatcher] = None,
+    hit_lines: Optional[list] = None
+) -> str:
+    """
+    截取命中行前后各2行的摘要。hit_lines 为扫描阶段已得到的命中行号，
+    未提供时用 matcher（或按 keywords 新建）单遍扫描得到。
+    """
+    if not content:
+        return ""
+    lines = content.splitlines()
+    max_lines = min(AI_REPO_MAX_SNIPPET_LINES, len(lines))
+
+    if hit_lines is None and keywords:
+        _, hit_lines = (matcher or RepoKeywordMatcher(keywords)).scan(content)
+
+    indexes = []
+    for i in hit_lines or []:
+        if i >= len(lines):
+            break
+        start = max(0, i - 2)
+        end = min(len(lines), i + 3)
+        indexes.extend(range(start, end))
+        if len(indexes) >= max_lines:
+            break
+
+    if not indexes:
+        return _trim_repo_snippet("\n".join(f"{i + 1}: {lines[i]}" for i in range(max_lines)))
+
+    unique_indexes = sorted(set(indexes))[:max_lines]
+    return _trim_repo_snippet("\n".join(f"{i + 1}: {lines[i]}" for i in unique_indexes))
+
+
+# ----------------------
+# 仓库扫描 CPU 进程池
+# ----------------------
+# 分词、关键词匹配、摘要截取等 CPU 密集工作按批提交到工作进程，事件循环只负责 I/O 与合并结果。
+# 进程池必须在 Flask / 心跳线程启动之前创建（见 start_repo_cpu_pool）：在多线程进程里 fork
+# 可能继承其它线程持有的锁而死锁；之后进程池损坏也不再重建，直接回退为本地执行。
+_REPO_CPU_POOL = None
+
+
+def _repo_cpu_warmup() -> int:
+    return os.getpid()
+
+
+def start_repo_cpu_pool():
+    """在启动其它线程之前创建进程池并立即拉起全部工作进程；未启用 AI 仓库读取时不创建"""
+    global _REPO_CPU_POOL
+    if not (AI_ENABLED and AI_REPO_READ_ENABLED):
+        return
+    if AI_REPO_CPU_WORKERS <= 0 or _REPO_CPU_POOL is not None:
+        return
+    try:
+        # fork 上下文下首次提交任务时一次性创建全部工作进程；不支持 fork 的平台使用 spawn
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        pool = ProcessPoolExecutor(
+            max_workers=AI_REPO_CPU_WORKERS,
+            mp_context=multiprocessing.get_context(method)
+        )
+        pool.submit(_repo_cpu_warmup).result(timeout=60)
+    except Exception as e:
+        print(f"⚠️ 仓库扫描进程池启动失败，将在本地执行: {e}")
+        return
+    _REPO_CPU_POOL = pool
+    print(f"✅ 仓库扫描进程池已启动（{AI_REPO_CPU_WORKERS} 个进程，{method}）")
+
+
+def _get_repo_cpu_pool() -> Optional[ProcessPoolExecutor]:
+    return _REPO_CPU_POOL
+
+
+def shutdown_repo_cpu_pool():
+    global _REPO_CPU_POOL
+    pool, _REPO_CPU_POOL = _REPO_CPU_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _run_repo_cpu(func, *args):
+    """在进程池中执行 func(*args)；未启用进程池或进程池损坏时在当前线程执行"""
+    pool = _get_repo_cpu_pool()
+    if pool is None:
+        return func(*args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        print("⚠️ 仓库扫描进程池异常，已回退为本地执行")
+        shutdown_repo_cpu_pool()
+        return func(*args)
+
+
+def _analyze_repo_texts(items: list, keywords: list) -> list:
+    """（工作进程）一批 (路径, 内容) -> [(路径, 词频表, 命中行号)]"""
+    matcher = RepoKeywordMatcher(keywords) if keywords else None
+    results = []
+    for path, content in items:
+        lines = matcher.scan(content)[1] if matcher else []
+        results.append((path, _tokenize_repo_index_text(content), lines))
+    return results
+
+
+def _build_repo_snippets(items: list, keywords: list) -> list:
+    """（工作进程）一批 (路径, 内容, 命中行号或 None) -> [(路径, 摘要)]"""
+    matcher = RepoKeywordMatcher(keywords)
+    return [
+        (path, _extract_repo_snippet(content, keywords, matcher=matcher, hit_lines=lines))
+        for path, content, lines in items
+    ]
+
+
+async def _fetch_repo_tree() -> list:
     if not AI_REPO_READ_ENABLED:
         return []
     now = time.time()
     if AI_REPO_CACHE_TTL_SEC > 0 and _REPO_TREE_CACHE["files"] and now - _REPO_TREE_CACHE["ts"] < AI_REPO_CACHE_TTL_SEC:
         return _REPO_TREE_CACHE["files"]
 
+    if _repo_reads_locally():
+        return await _fetch_local_repo_tree(now)
+
     owner, repo = _parse_github_repo(AI_REPO_URL)
     if not owner or not repo:
         return []
@@ -1303,34 +2409,84 @@ async def _fetch_repo_tree() -> list:
         headers["Authorization"] = f"Bearer {AI_GITHUB_TOKEN}"
     timeout = aiohttp.ClientTimeout(total=AI_REPO_TIMEOUT_SEC)
 
+    # 条件请求：树未变化时 GitHub 返回 304（不计入限流），直接复用已解析的文件表
+    cached_files = _REPO_TREE_CACHE["files"]
+    if cached_files and _REPO_TREE_CACHE["etag"]:
+        headers["If-None-Match"] = _REPO_TREE_CACHE["etag"]
+
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, headers=headers) as resp:
+        async with shared_http_session() as session:
+            async with session.get(url, headers=headers, timeout=timeout) as resp:
+                if resp.status == 304 and cached_files:
+                    _REPO_TREE_CACHE["ts"] = now
+                    return cached_files
                 if resp.status != 200:
-                    return []
+                    # 限流 / 服务端错误时沿用上一次成功的文件表，避免仓库上下文整体变空
+                    print(f"⚠️ 仓库文件列表获取失败: HTTP {resp.status}，沿用缓存")
+                    return cached_files or []
+                etag = resp.headers.get("ETag", "")
                 data = await resp.json()
-    except Exception:
-        return []
+    except Exception as e:
+        print(f"⚠️ 仓库文件列表获取异常: {e}，沿用缓存")
+        return cached_files or []
+    if not isinstance(data, dict):
+        return cached_files or []
 
     tree = data.get("tree", [])
-    files = []
+    entries = []
     for item in tree:
         if item.get("type") != "blob":
             continue
         path = item.get("path")
         if not path:
             continue
-        files.append({"path": path, "size": item.get("size", 0)})
+        entries.append((path, item.get("size", 0), item.get("sha", "")))
+
+    return _store_repo_tree(str(data.get("sha", "")), entries, etag, now)
+
 
-    if AI_REPO_CACHE_TTL_SEC > 0:
-        _REPO_TREE_CACHE["files"] = files
+async def _fetch_local_repo_tree(now: float) -> list:
+    """镜像 / 本地目录模式下的文件列表；树 SHA 未变化时直接复用已解析的文件表"""
+    cached_files = _REPO_TREE_CACHE["files"]
+    try:
+        if AI_REPO_SOURCE == "local":
+            tree_sha, entries = await asyncio.to_thread(_list_local_dir_tree)
+        else:
+            tree_sha, entries = await _list_mirror_tree(_REPO_TREE_CACHE["sha"] if cached_files else "")
+    except Exception as e:
+        print(f"⚠️ 读取本地仓库文件列表失败: {e}")
+        return cached_files or []
+
+    if cached_files and (entries is None or tree_sha == _REPO_TREE_CACHE["sha"]):
         _REPO_TREE_CACHE["ts"] = now
-    else:
-        _REPO_TREE_CACHE["files"] = []
-        _REPO_TREE_CACHE["ts"] = 0.0
+        return cached_files
+    return _store_repo_tree(tree_sha, entries or [], "", now)
+
+
+def _store_repo_tree(tree_sha: str, entries: list, etag: str, now: float) -> list:
+    """把 (路径, 大小, blob SHA) 列表整理成预解析的文件表并写入缓存"""
+    files = [
+        {"path": path, "path_lower": path.lower(), "size": size, "sha": sha}
+        for path, size, sha in entries
+    ]
+    _REPO_TREE_CACHE["files"] = files
+    _REPO_TREE_CACHE["ts"] = now
+    _REPO_TREE_CACHE["etag"] = etag
+    _REPO_TREE_CACHE["sha"] = tree_sha
+    _REPO_TREE_CACHE["blobs"] = {f["path"]: f["sha"] for f in files if f["sha"]}
+    _REPO_TREE_CACHE["by_lower"] = {f["path_lower"]: f for f in files}
+    # 预先分词路径 / 文件名字段，后续问题直接复用
+    _get_repo_path_index(files)
     return files
 
 
+def _repo_file_table(file_list: list) -> dict:
+    """小写路径 -> 文件项；file_list 为当前缓存的树时直接复用预构建的表"""
+    if file_list is _REPO_TREE_CACHE["files"] and _REPO_TREE_CACHE["by_lower"]:
+        return _REPO_TREE_CACHE["by_lower"]
+    return {f.get("path_lower") or f["path"].lower(): f for f in file_list}
+
+
 def _rank_repo_search_terms(keywords: list) -> list:
     if not keywords:
         return []
@@ -1355,6 +2511,9 @@ def _rank_repo_search_terms(keywords: list) -> list:
 async def _search_repo_files(keywords: list) -> list:
     if not keywords:
         return []
+    if _repo_reads_locally():
+        # 本地模式下由倒排索引负责关键词检索，不再调用 GitHub 搜索接口
+        return []
     if not AI_GITHUB_TOKEN and not AI_GITHUB_SEARCH_ALLOW_NO_TOKEN:
         return []
     owner, repo = _parse_github_repo(AI_REPO_URL)
@@ -1392,8 +2551,8 @@ async def _search_repo_files(keywords: list) -> list:
         query = f"{quote_plus(query_terms)}+repo:{owner}/{repo}"
         url = f"https://api.github.com/search/code?q={query}&per_page={per_page}"
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url, headers=headers) as resp:
+            async with shared_http_session() as session:
+                async with session.get(url, headers=headers, timeout=timeout) as resp:
                     if resp.status != 200:
                         continue
                     data = await resp.json()
@@ -1417,78 +2576,87 @@ async def _scan_repo_files_by_content(
     file_list: list,
     keywords: list,
     max_files: Optional[int] = None,
-    time_budget: Optional[float] = None
+    time_budget: Optional[float] = None,
+    hit_lines: Optional[dict] = None
 ) -> list:
+    """
+    下载候选文件做内容扫描并按 BM25F 排序。分词与关键词匹配按批交给进程池，
+    下载下一批的同时处理上一批；命中行号写入 hit_lines（路径 -> 行号列表），供生成摘要复用。
+    """
     if not keywords or not file_list:
         return []
 
     max_files = max_files or AI_REPO_SCAN_MAX_FILES
     time_budget = AI_REPO_SCAN_MAX_SECONDS if time_budget is None else time_budget
 
-    candidates = []
-    for item in file_list:
-        path = item.get("path", "")
-        path_lower = path.lower()
-        if not path_lower.endswith(_REPO_ALLOWED_EXTS):
-            continue
-        if item.get("size", 0) > AI_REPO_MAX_FILE_BYTES:
-            continue
-        score = _score_repo_path(path_lower, keywords)
-        candidates.append((score, item.get("size", 0), path))
-
+    # 先按路径相关度决定抓取顺序，其余文件按体积从小到大补齐
+    candidates = [item for item in file_list if _is_repo_indexable(item)]
     if not candidates:
         return []
-
-    candidates.sort(key=lambda x: (-x[0], x[1], len(x[2])))
-    if candidates and candidates[0][0] <= 0:
-        candidates.sort(key=lambda x: (x[1], len(x[2])))
-
-    scan_paths = [p for _, _, p in candidates[:max_files]]
-    results = []
+    path_hits = _get_repo_path_index(file_list).search(keywords, len(candidates), fields=("path", "name"))
+    path_rank = {path: i for i, (_, path) in enumerate(path_hits)}
+    candidates.sort(key=lambda item: (
+        path_rank.get(item["path"], len(path_rank)),
+        item.get("size", 0),
+        len(item["path"])
+    ))
+
+    scan_paths = [item["path"] for item in candidates[:max_files]]
+    sha_by_path = {item["path"]: item.get("sha", "") for item in candidates}
+    scanned = RepoIndex()
+    hit_count = 0
     start_ts = time.time()
     batch_size = max(1, AI_REPO_SCAN_CONCURRENCY)
-
-    async def _score_path(path: str):
-        content = await _fetch_repo_file_content(path)
-        if not content:
-            return None
-        lower = content.lower()
-        hit = 0
-        for key in keywords:
-            if not key:
-                continue
-            key_text = str(key).lower()
-            if len(key_text) < 2:
-                continue
-            if key_text in lower:
-                hit += 1
-        if hit > 0:
-            return (hit, path)
-        return None
+    max_pending = max(1, AI_REPO_CPU_WORKERS)
+    pending = []
+
+    def _merge(results):
+        nonlocal hit_count
+        for path, term_freqs, lines in results:
+            scanned.add_doc(path, sha_by_path.get(path, ""), term_freqs)
+            if lines:
+                hit_count += 1
+                if hit_lines is not None:
+                    hit_lines[path] = lines
 
     for i in range(0, len(scan_paths), batch_size):
         if time_budget > 0 and time.time() - start_ts > time_budget:
             break
         batch = scan_paths[i:i + batch_size]
-        batch_results = await asyncio.gather(
-            *[_score_path(path) for path in batch],
+        contents = await asyncio.gather(
+            *[_fetch_repo_file_content(path) for path in batch],
             return_exceptions=True
         )
-        for item in batch_results:
-            if isinstance(item, tuple):
-                results.append(item)
-        if len(results) >= AI_REPO_MAX_FILES:
+        items = [
+            (path, content) for path, content in zip(batch, contents)
+            if isinstance(content, str) and content
+        ]
+        if items:
+            pending.append(asyncio.ensure_future(_run_repo_cpu(_analyze_repo_texts, items, keywords)))
+        while len(pending) > max_pending:
+            _merge(await pending.pop(0))
+        if hit_count >= AI_REPO_MAX_FILES:
             break
 
-    results.sort(key=lambda x: (-x[0], len(x[1])))
-    return [p for _, p in results[:AI_REPO_MAX_FILES]]
+    for task in pending:
+        _merge(await task)
+
+    # 对已下载的文件做 BM25F 排序（正文 + 路径 + 文件名）
+    hits = scanned.search(keywords, AI_REPO_MAX_FILES)
+    return [path for _, path in hits]
 
 
-async def _fetch_repo_file_content(path: str) -> str:
+async def _fetch_repo_file_content(path: str) -> Optional[str]:
+    """
+    读取仓库文件文本。文件不存在、不是文件或超出大小限制时返回空字符串；
+    限流、超时、解码失败等临时错误返回 None，调用方不应把它当作空文件缓存或索引。
+    """
+    if _repo_reads_locally():
+        return await _read_local_repo_file(path)
     owner, repo = _parse_github_repo(AI_REPO_URL)
     if not owner or not repo or not path:
         return ""
-    cached = _get_cached_repo_content(path)
+    cached = await _REPO_BLOB_CACHE.get(_repo_blob_sha(path))
     if cached is not None:
         return cached
 
@@ -1497,14 +2665,13 @@ async def _fetch_repo_file_content(path: str) -> str:
         raw_path = quote(path, safe="/")
         raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{AI_REPO_BRANCH}/{raw_path}"
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(raw_url) as resp:
+            async with shared_http_session() as session:
+                async with session.get(raw_url, timeout=timeout) as resp:
                     if resp.status == 200:
-                        text = await resp.text()
-                        if AI_REPO_MAX_FILE_BYTES > 0 and len(text.encode("utf-8")) > AI_REPO_MAX_FILE_BYTES:
+                        data = await resp.read()
+                        if AI_REPO_MAX_FILE_BYTES > 0 and len(data) > AI_REPO_MAX_FILE_BYTES:
                             return ""
-                        _set_cached_repo_content(path, text)
-                        return text
+                        return await _decode_repo_blob(data)
         except Exception:
             pass
 
@@ -1517,16 +2684,18 @@ async def _fetch_repo_file_content(path: str) -> str:
 
     api_url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}?ref={AI_REPO_BRANCH}"
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(api_url, headers=headers) as resp:
-                if resp.status != 200:
+        async with shared_http_session() as session:
+            async with session.get(api_url, headers=headers, timeout=timeout) as resp:
+                if resp.status == 404:
                     return ""
+                if resp.status != 200:
+                    return None
                 data = await resp.json()
     except Exception:
-        return ""
+        return None
 
     if not isinstance(data, dict):
-        return ""
+        return None
     if data.get("type") != "file":
         return ""
     size = int(data.get("size", 0) or 0)
@@ -1539,15 +2708,452 @@ async def _fetch_repo_file_content(path: str) -> str:
         return ""
     if encoding == "base64":
         try:
-            decoded = base64.b64decode(content).decode("utf-8", errors="ignore")
-            _set_cached_repo_content(path, decoded)
-            return decoded
+            return await _decode_repo_blob(base64.b64decode(content))
         except Exception:
-            return ""
+            return None
 
-    text = str(content)
-    _set_cached_repo_content(path, text)
-    return text
+    return await _decode_repo_blob(str(content).encode("utf-8"))
+
+
+# ----------------------
+# 仓库本地倒排索引
+# ----------------------
+# 以 token / 中文二元组为词项，记录每个文件的词频；按 blob SHA 增量更新并持久化到磁盘，
+# 回答问题时直接在内存里排序候选文件，只抓取排名靠前的文件内容。
+_REPO_INDEX_TOKEN_RE = re.compile(r"[a-z0-9]{2,}|[\u4e00-\u9fff]+")
+
+
+def _tokenize_repo_index_text(text: str) -> dict:
+    """切分为词频表：英文/数字按非字母数字切分，中文连续段切为二元组（单字保留）"""
+    counts = {}
+    if not text:
+        return counts
+    for token in _REPO_INDEX_TOKEN_RE.findall(text.lower()):
+        if "\u4e00" <= token[0] <= "\u9fff":
+            if len(token) == 1:
+                counts[token] = counts.get(token, 0) + 1
+                continue
+            for i in range(len(token) - 1):
+                gram = token[i:i + 2]
+                counts[gram] = counts.get(gram, 0) + 1
+        else:
+            counts[token] = counts.get(token, 0) + 1
+    return counts
+
+
+def _repo_index_query_terms(keywords: list) -> list:
+    terms = []
+    for keyword in keywords or []:
+        terms.extend(_tokenize_repo_index_text(str(keyword)).keys())
+    return list(dict.fromkeys(terms))
+
+
+# BM25F 字段：(权重, 长度归一化 b)
+_REPO_BM25F_FIELDS = {
+    "content": (1.0, 0.75),
+    "path": (2.0, 0.3),
+    "name": (3.0, 0.3),
+}
+
+
+def _repo_path_fields(path: str) -> dict:
+    """路径字段与文件名字段的词频表"""
+    filename = path.rsplit("/", 1)[-1]
+    return {
+        "path": _tokenize_repo_index_text(path),
+        "name": _tokenize_repo_index_text(filename),
+    }
+
+
+class RepoIndex:
+    """
+    仓库倒排索引（BM25F）：每个字段一份 postings（词项 -> {路径: 词频}），
+    docs 记录 blob SHA、正文词频表与各字段长度；平均长度在索引变化后懒计算。
+    """
+
+    def __init__(self, repo_id: str = ""):
+        self.repo_id = repo_id
+        self.tree_sha = ""
+        self.docs = {}
+        self.fields = {name: {} for name in _REPO_BM25F_FIELDS}
+        self._avg_lengths = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add_doc(self, path: str, sha: str, term_freqs: dict):
+        self.remove_doc(path)
+        field_freqs = _repo_path_fields(path)
+        field_freqs["content"] = term_freqs
+        self.docs[path] = {
+            "sha": sha,
+            "tf": term_freqs,
+            "len": {name: sum(freqs.values()) for name, freqs in field_freqs.items()},
+        }
+        for name, freqs in field_freqs.items():
+            postings = self.fields[name]
+            for term, freq in freqs.items():
+                postings.setdefault(term, {})[path] = freq
+        self._avg_lengths = None
+
+    def remove_doc(self, path: str):
+        doc = self.docs.pop(path, None)
+        if not doc:
+            return
+        field_freqs = _repo_path_fields(path)
+        field_freqs["content"] = doc["tf"]
+        for name, freqs in field_freqs.items():
+            postings = self.fields[name]
+            for term in freqs:
+                posting = postings.get(term)
+                if posting is None:
+                    continue
+                posting.pop(path, None)
+                if not posting:
+                    postings.pop(term, None)
+        self._avg_lengths = None
+
+    def _field_avg_lengths(self) -> dict:
+        if self._avg_lengths is None:
+            total = max(1, len(self.docs))
+            self._avg_lengths = {
+                name: max(1.0, sum(doc["len"][name] for doc in self.docs.values()) / total)
+                for name in _REPO_BM25F_FIELDS
+            }
+        return self._avg_lengths
+
+    def search(self, keywords: list, limit: int, fields: Optional[tuple] = None) -> list:
+        """BM25F 排序，返回 [(得分, 路径)]；fields 限定参与打分的字段"""
+        total = len(self.docs)
+        if not total:
+            return []
+        use_fields = fields or tuple(_REPO_BM25F_FIELDS)
+        avg_lengths = self._field_avg_lengths()
+        k1 = AI_REPO_BM25_K1
+        scores = {}
+        for term in _repo_index_query_terms(keywords):
+            field_postings = [(name, self.fields[name].get(term)) for name in use_fields]
+            field_postings = [(name, posting) for name, posting in field_postings if posting]
+            if not field_postings:
+                continue
+            matched = set()
+            for _, posting in field_postings:
+                matched.update(posting)
+            idf = math.log(1 + (total - len(matched) + 0.5) / (len(matched) + 0.5))
+            for path in matched:
+                doc_len = self.docs[path]["len"]
+                weighted_tf = 0.0
+                for name, posting in field_postings:
+                    freq = posting.get(path)
+                    if not freq:
+                        continue
+                    weight, b = _REPO_BM25F_FIELDS[name]
+                    norm = 1 - b + b * doc_len[name] / avg_lengths[name]
+                    weighted_tf += weight * freq / norm
+                scores[path] = scores.get(path, 0.0) + idf * weighted_tf / (k1 + weighted_tf)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], len(item[0]), item[0]))
+        if ranked and AI_REPO_RANK_MIN_RATIO > 0:
+            cutoff = ranked[0][1] * AI_REPO_RANK_MIN_RATIO
+            ranked = [item for item in ranked if item[1] >= cutoff]
+        return [(score, path) for path, score in ranked[:limit]]
+
+    def to_dict(self) -> dict:
+        return {
+            "repo": self.repo_id,
+            "tree_sha": self.tree_sha,
+            "docs": {path: {"sha": doc["sha"], "tf": doc["tf"]} for path, doc in self.docs.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RepoIndex":
+        index = cls(str(data.get("repo", "")))
+        index.tree_sha = str(data.get("tree_sha", ""))
+        for path, doc in (data.get("docs") or {}).items():
+            if isinstance(doc, dict) and isinstance(doc.get("tf"), dict):
+                index.add_doc(path, str(doc.get("sha", "")), doc["tf"])
+        return index
+
+
+_REPO_PATH_INDEX = {"key": None, "index": None}
+
+
+def _get_repo_path_index(file_list: list) -> RepoIndex:
+    """只含路径 / 文件名字段的 BM25F 索引，按文件列表缓存（树不变时复用）"""
+    key = _REPO_TREE_CACHE.get("sha") or id(file_list)
+    if _REPO_PATH_INDEX["key"] != key or _REPO_PATH_INDEX["index"] is None:
+        index = RepoIndex()
+        for item in file_list:
+            if _is_repo_indexable(item):
+                index.add_doc(item["path"], item.get("sha", ""), {})
+        _REPO_PATH_INDEX["key"] = key
+        _REPO_PATH_INDEX["index"] = index
+    return _REPO_PATH_INDEX["index"]
+
+
+_REPO_INDEX = None
+_REPO_INDEX_LOCK = asyncio.Lock()
+# 抓取失败后的重试退避：连续失败次数与下次允许重试的时间
+_REPO_INDEX_RETRY = {"failures": 0, "retry_at": 0.0}
+
+
+def _repo_index_id() -> str:
+    if AI_REPO_SOURCE == "local":
+        return "local:" + os.path.abspath(AI_REPO_LOCAL_DIR)
+    return f"{AI_REPO_URL}@{AI_REPO_BRANCH}"
+
+
+def _repo_index_file() -> str:
+    digest = hashlib.sha1(_repo_index_id().encode("utf-8")).hexdigest()[:16]
+    return os.path.join(AI_REPO_CACHE_DIR, f"index-{digest}.json.gz")
+
+
+def _load_repo_index_file() -> Optional[RepoIndex]:
+    path = _repo_index_file()
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            index = RepoIndex.from_dict(json.load(f))
+    except Exception as e:
+        print(f"⚠️ 仓库索引读取失败，将重新构建: {e}")
+        return None
+    return index if index.repo_id == _repo_index_id() else None
+
+
+def _save_repo_index_file(data: dict):
+    path = _repo_index_file()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _is_repo_indexable(item: dict) -> bool:
+    path = item.get("path", "")
+    if not path.lower().endswith(_REPO_ALLOWED_EXTS):
+        return False
+    return item.get("size", 0) <= AI_REPO_MAX_FILE_BYTES
+
+
+async def _ensure_repo_index(file_list: list, tree_sha: str) -> Optional[RepoIndex]:
+    """
+    保证索引与当前仓库树一致：只重新抓取 blob SHA 变化的文件，删除已不存在的文件。
+    构建超出时间预算时保留已完成部分，下次调用继续补齐。
+    """
+    global _REPO_INDEX
+    if not AI_REPO_INDEX_ENABLED or not file_list:
+        return None
+
+    async with _REPO_INDEX_LOCK:
+        if _REPO_INDEX is None:
+            _REPO_INDEX = await asyncio.to_thread(_load_repo_index_file) or RepoIndex(_repo_index_id())
+        index = _REPO_INDEX
+        if tree_sha and index.tree_sha == tree_sha:
+            return index
+
+        wanted = {item["path"]: item.get("sha", "") for item in file_list if _is_repo_indexable(item)}
+        for path in [p for p in index.docs if p not in wanted]:
+            index.remove_doc(path)
+        pending = [
+            path for path, sha in wanted.items()
+            if not sha or index.docs.get(path, {}).get("sha") != sha
+        ]
+
+        start_ts = time.time()
+        batch_size = max(1, AI_REPO_SCAN_CONCURRENCY)
+        completed = True
+        failed = 0
+        added = 0
+        for i in range(0, len(pending), batch_size):
+            if AI_REPO_INDEX_BUILD_MAX_SECONDS > 0 and time.time() - start_ts > AI_REPO_INDEX_BUILD_MAX_SECONDS:
+                completed = False
+                break
+            batch = pending[i:i + batch_size]
+            contents = await asyncio.gather(
+                *[_fetch_repo_file_content(path) for path in batch],
+                return_exceptions=True
+            )
+            items = []
+            for path, content in zip(batch, contents):
+                if not isinstance(content, str):
+                    # 临时抓取失败：不写入索引、不标记完成，下次调用重试
+                    failed += 1
+                    completed = False
+                    continue
+                items.append((path, content))
+            for path, term_freqs, _ in await _run_repo_cpu(_analyze_repo_texts, items, []):
+                index.add_doc(path, wanted[path], term_freqs)
+                added += 1
+
+        if completed:
+            index.tree_sha = tree_sha
+        if failed:
+            # 指数退避：5s、10s、20s…… 最长 AI_REPO_INDEX_RETRY_MAX_SEC
+            _REPO_INDEX_RETRY["failures"] += 1
+            backoff = min(AI_REPO_INDEX_RETRY_MAX_SEC, 5.0 * 2 ** (_REPO_INDEX_RETRY["failures"] - 1))
+            _REPO_INDEX_RETRY["retry_at"] = time.time() + backoff
+        else:
+            _REPO_INDEX_RETRY.update(failures=0, retry_at=0.0)
+        # 只在构建完成或确实新增了文件时落盘，避免失败重试时反复重写整个索引
+        if completed or added:
+            try:
+                await asyncio.to_thread(_save_repo_index_file, index.to_dict())
+            except Exception as e:
+                print(f"⚠️ 仓库索引保存失败: {e}")
+        if pending:
+            if completed:
+                state = "完成"
+            elif failed:
+                state = f"部分完成（{failed} 个文件抓取失败，稍后重试）"
+            else:
+                state = "部分完成（超出时间预算）"
+            print(f"📚 仓库索引更新{state}: 处理 {len(pending)} 个文件，共 {len(index)} 个文件")
+        return index
+
+
+_REPO_INDEX_BUILD = {"task": None}
+
+
+def _start_repo_index_build(file_list: list, tree_sha: str):
+    """在后台补建 / 更新索引（已有构建在进行或处于失败退避期时不重复启动）"""
+    task = _REPO_INDEX_BUILD["task"]
+    if _REPO_INDEX_LOCK.locked() or (task is not None and not task.done()):
+        return
+    if time.time() < _REPO_INDEX_RETRY["retry_at"]:
+        return
+    _REPO_INDEX_BUILD["task"] = asyncio.create_task(_ensure_repo_index(file_list, tree_sha))
+
+
+async def _search_repo_index(file_list: list, keywords: list) -> Optional[list]:
+    """
+    用本地索引排序候选文件。请求路径上不等待索引构建：索引还没有完整构建过时
+    在后台启动构建并立即返回 None，由在线扫描先回答；树有更新时先用上一版索引。
+    """
+    if not keywords:
+        return []
+    if not AI_REPO_INDEX_ENABLED or not file_list:
+        return None
+    index = _REPO_INDEX
+    tree_sha = _REPO_TREE_CACHE.get("sha", "")
+    if index is None or not tree_sha or index.tree_sha != tree_sha:
+        _start_repo_index_build(file_list, tree_sha)
+    if index is None or not index.tree_sha or not len(index):
+        return None
+    hits = index.search(keywords, AI_REPO_MAX_FILES)
+    return [path for _, path in hits]
+
+
+# ----------------------
+# 仓库上下文后台预热
+# ----------------------
+_REPO_WARM_STATE = {
+    "ready": False,
+    "tree_sha": "",
+    "files": 0,
+    "last_run": 0.0,
+    "last_duration": 0.0,
+    "last_error": "",
+    "task": None,
+}
+
+
+def repo_context_ready() -> bool:
+    """仓库树与索引（或文件内容缓存）是否已针对当前树预热完成"""
+    return _REPO_WARM_STATE["ready"] and _REPO_WARM_STATE["tree_sha"] == _REPO_TREE_CACHE.get("sha", "")
+
+
+async def _prewarm_repo_context():
+    """拉取仓库树并增量更新索引；未启用索引时把可读文件预先拉进内容缓存"""
+    start_ts = time.time()
+    file_list = await _fetch_repo_tree()
+    if not file_list:
+        raise RuntimeError("仓库文件列表为空")
+    tree_sha = _REPO_TREE_CACHE.get("sha", "")
+
+    ready = True
+    index = await _ensure_repo_index(file_list, tree_sha)
+    if index is not None:
+        ready = bool(tree_sha) and index.tree_sha == tree_sha
+    else:
+        paths = [item["path"] for item in file_list if _is_repo_indexable(item)]
+        batch_size = max(1, AI_REPO_SCAN_CONCURRENCY)
+        for i in range(0, len(paths), batch_size):
+            await asyncio.gather(
+                *[_fetch_repo_file_content(path) for path in paths[i:i + batch_size]],
+                return_exceptions=True
+            )
+
+    _REPO_WARM_STATE.update(
+        ready=ready,
+        tree_sha=tree_sha,
+        files=len(file_list),
+        last_run=time.time(),
+        last_duration=time.time() - start_ts,
+        last_error=""
+    )
+
+
+async def _repo_prewarm_loop():
+    while True:
+        delay = AI_REPO_PREWARM_INTERVAL_SEC
+        try:
+            was_ready = repo_context_ready()
+            await _prewarm_repo_context()
+            if repo_context_ready():
+                if not was_ready:
+                    print(
+                        f"🔥 仓库上下文预热完成: {_REPO_WARM_STATE['files']} 个文件，"
+                        f"耗时 {_REPO_WARM_STATE['last_duration']:.1f}s"
+                    )
+            else:
+                # 索引构建超出单次时间预算时稍后继续补齐；抓取失败时按退避时间重试
+                delay = min(AI_REPO_PREWARM_INTERVAL_SEC, max(5.0, _REPO_INDEX_RETRY["retry_at"] - time.time()))
+        except Exception as e:
+            _REPO_WARM_STATE["last_error"] = str(e)[:200]
+            print(f"⚠️ 仓库上下文预热失败: {e}")
+        await asyncio.sleep(delay)
+
+
+def start_repo_prewarm():
+    """启动后台预热 / 定时增量刷新任务（重复调用只启动一次）"""
+    if not (AI_ENABLED and AI_REPO_READ_ENABLED and AI_REPO_PREWARM_ENABLED):
+        return
+    task = _REPO_WARM_STATE["task"]
+    if task is None or task.done():
+        _REPO_WARM_STATE["task"] = asyncio.create_task(_repo_prewarm_loop())
+
+
+# 仓库上下文结果缓存：键为 树 SHA + 规范化关键词集合 + 路径候选 + 检索模式，LRU 淘汰
+_REPO_CONTEXT_CACHE = OrderedDict()
+_REPO_CONTEXT_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+def _should_deep_scan_repo(user_text: str, force_read: bool) -> bool:
+    return AI_REPO_FORCE_DEEP_SCAN or force_read or _looks_like_question(user_text) or any(
+        zh in user_text for zh in _REPO_KEYWORD_MAP.keys()
+    )
+
+
+def _repo_context_cache_key(user_text: str, force_read: bool) -> tuple:
+    keywords = sorted({str(k).lower() for k in _extract_repo_keywords(user_text) if k})
+    path_candidates = sorted({p.lower() for p in _extract_repo_path_candidates(user_text)})
+    return (
+        _REPO_TREE_CACHE.get("sha", ""),
+        tuple(keywords),
+        tuple(path_candidates),
+        bool(force_read),
+        _should_deep_scan_repo(user_text, force_read)
+    )
+
+
+def repo_context_cache_stats() -> dict:
+    total = _REPO_CONTEXT_CACHE_STATS["hits"] + _REPO_CONTEXT_CACHE_STATS["misses"]
+    return {
+        **_REPO_CONTEXT_CACHE_STATS,
+        "size": len(_REPO_CONTEXT_CACHE),
+        "hit_rate": _REPO_CONTEXT_CACHE_STATS["hits"] / total if total else 0.0
+    }
 
 
 async def _build_repo_context(user_text: str, force_read: bool = False) -> str:
@@ -1558,24 +3164,51 @@ async def _build_repo_context(user_text: str, force_read: bool = False) -> str:
     if not file_list:
         return ""
 
+    cache_key = _repo_context_cache_key(user_text, force_read)
+    if AI_REPO_CONTEXT_CACHE_SIZE > 0 and cache_key[0] and (cache_key[1] or cache_key[2]):
+        cached = _REPO_CONTEXT_CACHE.get(cache_key)
+        if cached is not None:
+            _REPO_CONTEXT_CACHE.move_to_end(cache_key)
+            _REPO_CONTEXT_CACHE_STATS["hits"] += 1
+            return cached
+        _REPO_CONTEXT_CACHE_STATS["misses"] += 1
+    else:
+        cache_key = None
+
+    context = await _assemble_repo_context(user_text, force_read, file_list)
+    # 只缓存非空结果，避免把临时的抓取失败固定下来；
+    # 索引尚未针对该树 SHA 构建完成（预热中 / 部分完成）时的结果也不缓存，否则索引补齐后仍会返回旧结果
+    tree_sha = cache_key[0] if cache_key is not None else ""
+    index_ready = not AI_REPO_INDEX_ENABLED or (_REPO_INDEX is not None and _REPO_INDEX.tree_sha == tree_sha)
+    if cache_key is not None and context and index_ready and _REPO_TREE_CACHE.get("sha", "") == tree_sha:
+        _REPO_CONTEXT_CACHE[cache_key] = context
+        while len(_REPO_CONTEXT_CACHE) > AI_REPO_CONTEXT_CACHE_SIZE:
+            _REPO_CONTEXT_CACHE.popitem(last=False)
+    return context
+
+
+async def _assemble_repo_context(user_text: str, force_read: bool, file_list: list) -> str:
     path_candidates = _extract_repo_path_candidates(user_text)
     keywords = _extract_repo_keywords(user_text)
     selected = _select_repo_files(file_list, path_candidates, keywords)
+    hit_lines = {}
     used_fallback = False
     if not selected and keywords:
         selected = await _search_repo_files(keywords)
-    should_deep_scan = AI_REPO_FORCE_DEEP_SCAN or force_read or _looks_like_question(user_text) or any(
-        zh in user_text for zh in _REPO_KEYWORD_MAP.keys()
-    )
+    should_deep_scan = _should_deep_scan_repo(user_text, force_read)
     if keywords:
-        scan_limit = AI_REPO_DEEP_SCAN_MAX_FILES if should_deep_scan else AI_REPO_SCAN_MAX_FILES
-        scan_time = AI_REPO_DEEP_SCAN_MAX_SECONDS if should_deep_scan else AI_REPO_SCAN_MAX_SECONDS
-        scan_selected = await _scan_repo_files_by_content(
-            file_list,
-            keywords,
-            max_files=scan_limit,
-            time_budget=scan_time
-        )
+        # 优先查本地倒排索引，索引不可用时才逐个下载文件做内容扫描
+        scan_selected = await _search_repo_index(file_list, keywords)
+        if scan_selected is None:
+            scan_limit = AI_REPO_DEEP_SCAN_MAX_FILES if should_deep_scan else AI_REPO_SCAN_MAX_FILES
+            scan_time = AI_REPO_DEEP_SCAN_MAX_SECONDS if should_deep_scan else AI_REPO_SCAN_MAX_SECONDS
+            scan_selected = await _scan_repo_files_by_content(
+                file_list,
+                keywords,
+                max_files=scan_limit,
+                time_budget=scan_time,
+                hit_lines=hit_lines
+            )
         if scan_selected:
             selected = scan_selected + [p for p in selected if p not in scan_selected]
     should_fallback = force_read or should_deep_scan
@@ -1587,14 +3220,40 @@ async def _build_repo_context(user_text: str, force_read: bool = False) -> str:
     if not selected:
         return ""
     async def _build_parts(paths: list) -> list:
+        # 按相关度顺序分批抓取并截取摘要，装满 token 预算后不再继续抓取后面的文件
+        # 被去重 / 超预算跳过的片段不会计入已用预算，所以另外按候选片段的估算 token 总量和
+        # 已抓取文件数截止，避免已选内容一直不满时把所有候选文件都抓一遍
         parts = []
-        for path in paths:
-            content = await _fetch_repo_file_content(path)
-            if not content:
+        candidate_tokens = 0
+        fetched = 0
+        batch_size = max(1, AI_REPO_SCAN_CONCURRENCY)
+        for i in range(0, len(paths), batch_size):
+            if AI_REPO_CONTEXT_TOKEN_BUDGET > 0 and (
+                candidate_tokens >= AI_REPO_CONTEXT_TOKEN_BUDGET * 2
+                or fetched >= AI_REPO_CONTEXT_MAX_CANDIDATES
+            ):
+                break
+            batch = paths[i:i + batch_size]
+            contents = await asyncio.gather(
+                *[_fetch_repo_file_content(path) for path in batch],
+                return_exceptions=True
+            )
+            fetched += len(batch)
+            items = [
+                (path, content, hit_lines.get(path))
+                for path, content in zip(batch, contents)
+                if isinstance(content, str) and content
+            ]
+            if not items:
                 continue
-            snippet = _extract_repo_snippet(content, keywords)
-            if snippet:
-                parts.append(f"[{path}]\n{snippet}")
+            # 摘要截取整批交给进程池
+            snippets = await _run_repo_cpu(_build_repo_snippets, items, keywords)
+            new_parts = [f"[{path}]\n{snippet}" for path, snippet in snippets if snippet]
+            candidate_tokens += sum(_estimate_tokens(part) for part in new_parts)
+            parts.extend(new_parts)
+            parts = _pack_repo_parts(parts)
+            if _repo_parts_fill_budget(parts):
+                break
         return parts
 
     parts = await _build_parts(selected)
@@ -1612,6 +3271,99 @@ async def _build_repo_context(user_text: str, force_read: bool = False) -> str:
     return header + "\n\n".join(parts)
 
 
+_REPO_SNIPPET_LINE_RE = re.compile(r"^(\d+): (.*)$")
+# 去重只比较有实际内容的行：过短或只有标点的行（如 "}"、");"、"end"）在各文件里都会出现
+_REPO_DEDUPE_MIN_LINE_CHARS = 8
+_REPO_DEDUPE_WORD_RE = re.compile(r"\w")
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个，其余按 4 个字符 1 个"""
+    if not text:
+        return 0
+    cjk = len(re.findall(r"[\u3000-\u9fff\uff00-\uffef]", text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _parse_repo_part(part: str) -> tuple:
+    """'[路径]\n行号: 内容...' -> (路径, {行号: 内容})"""
+    head, _, body = part.partition("\n")
+    path = head[1:-1] if head.startswith("[") and head.endswith("]") else head
+    lines = {}
+    for line in body.splitlines():
+        match = _REPO_SNIPPET_LINE_RE.match(line)
+        if match:
+            lines[int(match.group(1))] = match.group(2)
+    return path, lines
+
+
+def _render_repo_part(path: str, lines: dict) -> str:
+    return f"[{path}]\n" + "\n".join(f"{no}: {lines[no]}" for no in sorted(lines))
+
+
+def _pack_repo_parts(parts: list, budget: Optional[int] = None) -> list:
+    """
+    按相关度顺序装箱：同一文件的多个摘要窗口合并去重，
+    与已选内容重复行占比超过 AI_REPO_SNIPPET_DEDUPE_RATIO 的片段跳过，
+    总 token 不超过预算（0 为不限制；首个片段超预算时按行截断）。
+    """
+    budget = AI_REPO_CONTEXT_TOKEN_BUDGET if budget is None else budget
+    merged = OrderedDict()
+    for part in parts:
+        path, lines = _parse_repo_part(part)
+        if not lines:
+            merged.setdefault(path, {"raw": part, "lines": {}})
+            continue
+        entry = merged.setdefault(path, {"raw": None, "lines": {}})
+        entry["lines"].update(lines)
+
+    packed = []
+    seen_lines = set()
+    used = 0
+    for path, entry in merged.items():
+        if entry["lines"]:
+            texts = [t.strip() for t in entry["lines"].values()]
+            texts = [
+                t for t in texts
+                if len(t) >= _REPO_DEDUPE_MIN_LINE_CHARS and _REPO_DEDUPE_WORD_RE.search(t)
+            ]
+            if texts and seen_lines:
+                overlap = sum(1 for t in texts if t in seen_lines) / len(texts)
+                if overlap >= AI_REPO_SNIPPET_DEDUPE_RATIO:
+                    continue
+            text = _render_repo_part(path, entry["lines"])
+        else:
+            texts = []
+            text = entry["raw"]
+
+        cost = _estimate_tokens(text)
+        if budget > 0 and used + cost > budget:
+            if packed or not entry["lines"]:
+                continue
+            kept = {}
+            for no in sorted(entry["lines"]):
+                kept[no] = entry["lines"][no]
+                if _estimate_tokens(_render_repo_part(path, kept)) > budget:
+                    kept.pop(no)
+                    break
+            if not kept:
+                continue
+            text = _render_repo_part(path, kept)
+            cost = _estimate_tokens(text)
+
+        packed.append(text)
+        seen_lines.update(texts)
+        used += cost
+    return packed
+
+
+def _repo_parts_fill_budget(parts: list) -> bool:
+    if AI_REPO_CONTEXT_TOKEN_BUDGET <= 0:
+        return False
+    used = sum(_estimate_tokens(p) for p in parts)
+    return used >= AI_REPO_CONTEXT_TOKEN_BUDGET * 0.9
+
+
 def _split_repo_context(context: str) -> tuple:
     if not context:
         return "", []
@@ -1638,35 +3390,44 @@ async def _build_repo_context_iterative(
     user_text: str,
     force_read: bool = False,
     extra_texts: Optional[list] = None,
-    max_rounds: int = 1
+    max_rounds: int = 1,
+    extra_texts_loader=None
 ) -> str:
+    """
+    多轮仓库检索。extra_texts_loader 为可选的异步函数，返回补充检索文本列表；
+    只有第一轮（仅用用户原文）之后仍需继续检索时才会调用，
+    以便与引用消息 / 楼层 / 历史的收集并发进行。
+    """
     if max_rounds <= 1:
         return await _build_repo_context(user_text, force_read=force_read)
 
-    queries = []
-    if user_text:
-        queries.append(user_text)
+    async def _iter_queries():
+        if user_text:
+            yield user_text
 
-    merged_extra = "\n".join([str(t).strip() for t in (extra_texts or []) if str(t).strip()])
-    if merged_extra:
-        queries.append((user_text + "\n" + merged_extra).strip())
-
-    keywords = _extract_repo_keywords(user_text)
-    if keywords:
-        queries.append((user_text + "\n" + " ".join(keywords)).strip())
+        texts = list(extra_texts or [])
+        if extra_texts_loader is not None:
+            try:
+                texts.extend(await extra_texts_loader() or [])
+            except Exception as e:
+                print(f"⚠️ 仓库检索补充上下文获取失败: {e}")
+        merged_extra = "\n".join([str(t).strip() for t in texts if str(t).strip()])
+        if merged_extra:
+            yield (user_text + "\n" + merged_extra).strip()
 
-    deduped = []
-    seen = set()
-    for q in queries:
-        if q and q not in seen:
-            seen.add(q)
-            deduped.append(q)
-        if len(deduped) >= max_rounds:
-            break
+        keywords = _extract_repo_keywords(user_text)
+        if keywords:
+            yield (user_text + "\n" + " ".join(keywords)).strip()
 
     merged_header = ""
     merged_parts = []
-    for query in deduped:
+    seen = set()
+    async for query in _iter_queries():
+        if not query or query in seen:
+            continue
+        if len(seen) >= max_rounds:
+            break
+        seen.add(query)
         context = await _build_repo_context(query, force_read=force_read)
         if not context:
             continue
@@ -1681,7 +3442,8 @@ async def _build_repo_context_iterative(
     if not merged_parts:
         return ""
 
-    merged_parts = merged_parts[:AI_REPO_MAX_FILES]
+    # 多轮结果合并后重新装箱：同一文件不同轮次的窗口合并，整体仍受 token 预算约束
+    merged_parts = _pack_repo_parts(merged_parts)[:AI_REPO_MAX_FILES]
     header_text = merged_header or "仓库代码参考："
     return header_text + "\n" + "\n\n".join(merged_parts)
 
@@ -2161,10 +3923,10 @@ def _build_context_key(message: discord.Message) -> str:
     return f"ai:conv:{guild_id}:{user_id}"
 
 
-def _load_ai_history(context_key: str) -> list:
+async def _load_ai_history(context_key: str) -> list:
     items = []
     try:
-        raw = redis.lrange(context_key, -AI_MAX_CONTEXT_MESSAGES * 2, -1) or []
+        raw = await redis.lrange(context_key, -AI_MAX_CONTEXT_MESSAGES * 2, -1) or []
         for entry in raw:
             try:
                 if isinstance(entry, bytes):
@@ -2181,19 +3943,41 @@ def _load_ai_history(context_key: str) -> list:
     return items
 
 
-def _append_ai_history(context_key: str, role: str, content: str):
-    if role not in ("user", "assistant"):
-        return
-    text = str(content or "").strip()
-    if not text:
+async def _append_ai_history(context_key: str, turns: list):
+    """
+    一次写入整轮对话（user + assistant）：
+    RPUSH 多条 + LTRIM + EXPIRE 放在同一个事务里，只需一次网络往返
+    """
+    payloads = []
+    for role, content in turns:
+        if role not in ("user", "assistant"):
+            continue
+        text = str(content or "").strip()
+        if not text:
+            continue
+        payloads.append(json.dumps({"role": role, "content": text}, ensure_ascii=False))
+    if not payloads:
         return
-    payload = json.dumps({"role": role, "content": text}, ensure_ascii=False)
     try:
-        redis.rpush(context_key, payload)
-        redis.ltrim(context_key, -AI_MAX_CONTEXT_MESSAGES * 2, -1)
-        redis.expire(context_key, AI_CONTEXT_TTL_SEC)
-    except Exception:
-        pass
+        pipe = redis.multi()
+        pipe.rpush(context_key, *payloads)
+        pipe.ltrim(context_key, -AI_MAX_CONTEXT_MESSAGES * 2, -1)
+        pipe.expire(context_key, AI_CONTEXT_TTL_SEC)
+        await pipe.exec()
+    except Exception as e:
+        print(f"⚠️ AI 对话历史写入失败: {e}")
+
+
+_AI_HISTORY_WRITE_TASKS = set()
+
+
+def _schedule_ai_history_write(context_key: str, user_text: str, reply_text: str):
+    """后台写入对话历史，不阻塞回复发送；保留任务引用防止被回收"""
+    task = asyncio.create_task(
+        _append_ai_history(context_key, [("user", user_text), ("assistant", reply_text)])
+    )
+    _AI_HISTORY_WRITE_TASKS.add(task)
+    task.add_done_callback(_AI_HISTORY_WRITE_TASKS.discard)
 
 
 def _is_rate_limited(user_id: int) -> bool:
@@ -2301,6 +4085,15 @@ def _extract_stream_delta(data: dict) -> str:
     return ""
 
 
+def _extract_stream_finish_reason(data: dict) -> str:
+    if not isinstance(data, dict):
+        return ""
+    choices = data.get("choices") or []
+    if not choices or not isinstance(choices[0], dict):
+        return ""
+    return str(choices[0].get("finish_reason") or "").strip().lower()
+
+
 def _normalize_openai_message_content(content) -> str:
     if isinstance(content, str):
         return content
@@ -2372,8 +4165,8 @@ async def _call_openai_compatible(messages: list, model: str) -> tuple:
         payload = _build_openai_payload(request_messages, model, stream=False)
 
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(url, headers=headers, json=payload) as resp:
+            async with shared_http_session() as session:
+                async with session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
                     raw = await resp.text()
                     if resp.status != 200:
                         print(f"❌ AI 请求失败: {resp.status} | {raw[:300]}")
@@ -2402,153 +4195,825 @@ async def _call_openai_compatible(messages: list, model: str) -> tuple:
         if finish_reason != "length":
             break
 
-        if round_idx >= max_rounds - 1 or not content:
-            break
+        if round_idx >= max_rounds - 1 or not content:
+            break
+
+        # 当模型因为 token 上限被截断时，自动续写，避免只返回前半段。
+        request_messages.append({"role": "assistant", "content": content})
+        request_messages.append({"role": "user", "content": "请从上次中断处继续输出，不要重复前文。"})
+
+    merged = "\n".join([s for s in segments if s]).strip()
+    if merged:
+        return merged, ""
+    return "", "空响应"
+
+
+async def _call_openai_streaming(messages: list, model: str, on_delta=None) -> tuple:
+    url = f"{AI_API_BASE}/chat/completions"
+    headers = {
+        "Authorization": f"Bearer {AI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    timeout = aiohttp.ClientTimeout(total=60)
+    request_messages = list(messages)
+    full_text = ""
+    max_rounds = max(1, AI_NONSTREAM_CONTINUE_MAX_ROUNDS + 1)
+
+    for round_idx in range(max_rounds):
+        payload = _build_openai_payload(request_messages, model, stream=True)
+        prefix = full_text + "\n" if full_text else ""
+        segment = ""
+        finish_reason = ""
+        try:
+            async with shared_http_session() as session:
+                async with session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
+                    if resp.status != 200:
+                        raw = await resp.text()
+                        print(f"❌ AI 流式请求失败: {resp.status} | {raw[:300]}")
+                        return full_text, f"HTTP {resp.status}"
+                    async for raw_line in resp.content:
+                        if not raw_line:
+                            continue
+                        try:
+                            line = raw_line.decode("utf-8", errors="ignore").strip()
+                        except Exception:
+                            continue
+                        if not line:
+                            continue
+                        for piece in line.splitlines():
+                            if not piece.startswith("data:"):
+                                continue
+                            data_str = piece[5:].strip()
+                            if not data_str or data_str == "[DONE]":
+                                continue
+                            try:
+                                data = json.loads(data_str)
+                            except Exception:
+                                continue
+                            finish_reason = _extract_stream_finish_reason(data) or finish_reason
+                            delta = _extract_stream_delta(data)
+                            if delta:
+                                segment += delta
+                                if on_delta:
+                                    await on_delta(prefix + segment, False)
+        except Exception as e:
+            print(f"❌ AI 流式请求异常: {e}")
+            return (prefix + segment).strip(), str(e)
+
+        if segment:
+            full_text = prefix + segment
+
+        if finish_reason != "length" or not segment or round_idx >= max_rounds - 1:
+            break
+
+        # 与非流式一致：因 token 上限截断时继续流式续写
+        request_messages.append({"role": "assistant", "content": segment})
+        request_messages.append({"role": "user", "content": "请从上次中断处继续输出，不要重复前文。"})
+
+    full_text = full_text.strip()
+    if on_delta:
+        await on_delta(full_text, True)
+    return full_text, ""
+
+
+async def _call_openai_with_retry(messages: list, model: str, stream: bool = False, on_delta=None) -> tuple:
+    last_error = ""
+    partial_text = ""
+    attempts = AI_API_RETRY_MAX + 1
+    if stream:
+        # 流式失败后至少保留一次非流式重试
+        attempts = max(attempts, 2)
+    for attempt in range(attempts):
+        # 只有首次尝试走流式；流式失败或中途断开时，按正常退避间隔改用非流式重取完整回复
+        if stream and attempt == 0:
+            text, error = await _call_openai_streaming(messages, model, on_delta=on_delta)
+            if text and not error:
+                return text, ""
+            partial_text = text
+        else:
+            text, error = await _call_openai_compatible(messages, model)
+            if text:
+                return text, error
+
+        last_error = error or "空响应"
+        if attempt < attempts - 1:
+            delay = AI_API_RETRY_BACKOFF_SEC * (attempt + 1)
+            await asyncio.sleep(delay)
+
+    if partial_text:
+        # 重试全部失败时退回流式阶段已收到的部分内容
+        return partial_text, last_error
+    return "", last_error
+
+
+_DISCORD_EDIT_TIMES = {}
+_STREAM_SENTENCE_ENDS = ("。", "！", "？", "\n", ". ", "! ", "? ")
+
+
+async def _wait_discord_edit_slot(channel_id: str):
+    """按频道限速：AI_STREAMING_EDIT_WINDOW_SEC 内最多 AI_STREAMING_EDITS_PER_WINDOW 次发送/编辑"""
+    times = _DISCORD_EDIT_TIMES.setdefault(channel_id, deque())
+    while True:
+        now = time.monotonic()
+        while times and now - times[0] >= AI_STREAMING_EDIT_WINDOW_SEC:
+            times.popleft()
+        if len(times) < AI_STREAMING_EDITS_PER_WINDOW:
+            times.append(now)
+            return
+        await asyncio.sleep(AI_STREAMING_EDIT_WINDOW_SEC - (now - times[0]))
+
+
+class StreamEditCoalescer:
+    """
+    流式回复合并编辑：on_delta 只记录最新全文，后台任务按频道限速把最新内容刷到 Discord，
+    中间产生的增量直接合并；超过单条长度时按 _split_discord_text 的切分点续发新消息。
+    """
+
+    def __init__(
+        self,
+        base_message: Optional[discord.Message],
+        channel: discord.abc.Messageable,
+        reply_to: Optional[discord.Message] = None,
+        limit: int = 1800
+    ):
+        self.channel = channel
+        self.channel_id = str(getattr(channel, "id", ""))
+        self.reply_to = reply_to
+        self.limit = limit
+        self.messages = [base_message] if base_message else []
+        self.rendered = [None] * len(self.messages)
+        self._text = ""
+        self._shown = False
+        self._event = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def update(self, full_text: str, final: bool = False):
+        if final:
+            return
+        self._text = full_text or ""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._event.set()
+
+    def _ready(self, text: str) -> bool:
+        # 首次刷新等到一句话或 AI_STREAMING_MIN_CHARS 个字符，之后有新内容就刷
+        if self._shown:
+            return True
+        return len(text) >= AI_STREAMING_MIN_CHARS or any(end in text for end in _STREAM_SENTENCE_ENDS)
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            text = self._text.strip()
+            if not text or not self._ready(text):
+                continue
+            # shield：finish() 取消本任务时正在进行的编辑照常完成，避免消息状态错乱
+            await asyncio.shield(self._render(text, final=False))
+            await asyncio.sleep(AI_STREAMING_UPDATE_INTERVAL_SEC)
+
+    async def _render(self, text: str, final: bool) -> bool:
+        async with self._lock:
+            chunks = _split_discord_text(text, limit=self.limit)
+            for idx, chunk in enumerate(chunks):
+                if idx < len(self.messages):
+                    if self.rendered[idx] == chunk:
+                        continue
+                    await _wait_discord_edit_slot(self.channel_id)
+                    try:
+                        await self.messages[idx].edit(content=chunk)
+                    except Exception as e:
+                        print(f"⚠️ 流式回复编辑失败: {e}")
+                        return False
+                    self.rendered[idx] = chunk
+                    continue
+                await _wait_discord_edit_slot(self.channel_id)
+                try:
+                    if not self.messages and self.reply_to:
+                        new_msg = await self.reply_to.reply(chunk, mention_author=False)
+                    else:
+                        new_msg = await self.channel.send(chunk)
+                except Exception as e:
+                    print(f"⚠️ 流式回复发送失败: {e}")
+                    return False
+                self.messages.append(new_msg)
+                self.rendered.append(chunk)
+            if final:
+                # 回退到非流式后最终内容可能更短，删掉多出来的消息
+                while len(self.messages) > max(1, len(chunks)):
+                    extra = self.messages.pop()
+                    self.rendered.pop()
+                    try:
+                        await extra.delete()
+                    except Exception:
+                        pass
+            self._shown = self._shown or bool(chunks)
+            return True
+
+    def cancel(self):
+        """停止后台刷新任务（已在进行中的那次编辑会完成，之后不再编辑）"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    async def finish(self, text: str) -> bool:
+        """停止后台刷新并写入最终全文，返回是否全部显示成功"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        return await self._render((text or "").strip(), final=True)
+
+
+def _truncate_input(text: str) -> str:
+    if not text:
+        return ""
+    if len(text) <= AI_MAX_INPUT_CHARS:
+        return text
+    return text[:AI_MAX_INPUT_CHARS].rstrip() + "..."
+
+
+async def _gather_context(coro, timeout: float, default, label: str):
+    """带超时的上下文收集：超时或出错时返回 default，不影响其余收集与回复"""
+    try:
+        if timeout and timeout > 0:
+            return await asyncio.wait_for(coro, timeout=timeout)
+        return await coro
+    except asyncio.TimeoutError:
+        print(f"⚠️ AI 上下文收集超时（{label}，{timeout}s），已跳过")
+    except Exception as e:
+        print(f"⚠️ AI 上下文收集失败（{label}）: {e}")
+    return default
+
+
+async def _resolved_context(default):
+    return default
+
+
+# ----------------------
+# AI 回答缓存
+# ----------------------
+# 键 = 频道模式 + 仓库树 SHA + 归一化问题文本；带图、回复引用、@ 他人或涉及个人账号信息的提问不缓存。
+# 可缓存的问题按与提问者无关的提示词作答（不带身份、频道楼层和对话历史，见 handle_ai_reply），
+# 依赖上文才能理解的追问（“然后呢”“还是不行”）走完整上下文，既不查也不写缓存。
+# 缓存的回答里提问者的 @提及 替换成占位符，命中时换成当前提问者；回答里出现提问者昵称的不缓存
+#（昵称可能与普通词重合，如“密钥”“登录”，不能整词替换）。
+_ANSWER_CACHE = OrderedDict()
+_ANSWER_CACHE_STATS = {"hits": 0, "misses": 0, "skipped": 0, "stores": 0, "expired": 0}
+_ANSWER_PERSONAL_RE = re.compile(r"<[@#][!&]?\d+>|\d{6,}|sk-[A-Za-z0-9]|我的|我这|我账号|我号")
+_ANSWER_FOLLOWUP_RE = re.compile(
+    r"然后|接着|继续|还是不|还不行|还是没|没用|不管用|刚才|刚刚|上面|上述|之前|前面|你说|你刚|"
+    r"这个|那个|这样|那样|这种|那种|同样|它|他|她"
+)
+_ANSWER_MENTION_MARK = "\x00mention\x00"
+
+
+def _normalize_question(text: str) -> str:
+    return re.sub(r"[\W_]+", "", (text or "").lower())
+
+
+def _answer_cache_key(message: discord.Message, user_text: str, image_urls: list, mode: str) -> Optional[str]:
+    """可缓存时返回缓存键，否则返回 None"""
+    if not AI_ANSWER_CACHE_ENABLED or AI_ANSWER_CACHE_SIZE <= 0 or mode == "chat":
+        return None
+    if image_urls or message.attachments or message.reference or _ANSWER_PERSONAL_RE.search(user_text or ""):
+        _ANSWER_CACHE_STATS["skipped"] += 1
+        return None
+    question = _normalize_question(user_text)
+    if len(question) < 2 or len(question) > AI_MAX_INPUT_CHARS:
+        _ANSWER_CACHE_STATS["skipped"] += 1
+        return None
+    tree_sha = "" if mode == "key_help" else _REPO_TREE_CACHE.get("sha", "")
+    return hashlib.sha1(f"{mode}\n{tree_sha}\n{question}".encode("utf-8")).hexdigest()
+
+
+def _question_needs_context(text: str) -> bool:
+    """追问 / 指代上文的提问，或短到离开上文就没法理解的提问"""
+    question = _normalize_question(text)
+    return len(question) <= 3 or bool(_ANSWER_FOLLOWUP_RE.search(question))
+
+
+def _answer_user_names(user) -> list:
+    names = {
+        _safe_display_name(user),
+        str(getattr(user, "name", "") or "").strip(),
+        str(getattr(user, "global_name", "") or "").strip(),
+    }
+    return sorted([n for n in names if len(n) >= 2], key=len, reverse=True)
+
+
+def _get_cached_answer(key: str, message: discord.Message) -> Optional[str]:
+    entry = _ANSWER_CACHE.get(key)
+    if entry is None:
+        _ANSWER_CACHE_STATS["misses"] += 1
+        return None
+    ts, template = entry
+    if AI_ANSWER_CACHE_TTL_SEC and time.time() - ts > AI_ANSWER_CACHE_TTL_SEC:
+        _ANSWER_CACHE.pop(key, None)
+        _ANSWER_CACHE_STATS["expired"] += 1
+        _ANSWER_CACHE_STATS["misses"] += 1
+        return None
+    _ANSWER_CACHE.move_to_end(key)
+    _ANSWER_CACHE_STATS["hits"] += 1
+    return _render_answer_template(template, message.author)
+
+
+def _answer_template(answer: str, author) -> Optional[str]:
+    """把回答里提问者的 @提及 换成占位符；含提问者昵称或用户 ID 的回答视为个性化内容，返回 None 不缓存"""
+    template = (answer or "").replace(f"<@!{author.id}>", _ANSWER_MENTION_MARK).replace(f"<@{author.id}>", _ANSWER_MENTION_MARK)
+    if not template.strip() or str(author.id) in template:
+        return None
+    lowered = template.lower()
+    if any(name.lower() in lowered for name in _answer_user_names(author)):
+        return None
+    return template
+
+
+def _render_answer_template(template: str, author) -> str:
+    return template.replace(_ANSWER_MENTION_MARK, f"<@{author.id}>")
+
+
+def _store_cached_answer(key: str, answer: str, message: discord.Message):
+    template = _answer_template(answer, message.author)
+    if template is None:
+        return
+    _ANSWER_CACHE[key] = (time.time(), template)
+    _ANSWER_CACHE.move_to_end(key)
+    _ANSWER_CACHE_STATS["stores"] += 1
+    while len(_ANSWER_CACHE) > AI_ANSWER_CACHE_SIZE:
+        _ANSWER_CACHE.popitem(last=False)
+
+
+def answer_cache_stats() -> dict:
+    total = _ANSWER_CACHE_STATS["hits"] + _ANSWER_CACHE_STATS["misses"]
+    return {
+        **_ANSWER_CACHE_STATS,
+        "size": len(_ANSWER_CACHE),
+        "hit_rate": _ANSWER_CACHE_STATS["hits"] / total if total else 0.0
+    }
+
+
+# ----------------------
+# AI 相似问题缓存
+# ----------------------
+# 精确缓存只认字面相同的问题；这里先把问题规范化（同义写法、语气词、请问/一下 等），再切成
+# 字符一元/二元组哈希到固定维度向量，与已答问题做余弦相似度检索，超过 AI_SEMANTIC_CACHE_THRESHOLD
+# 才复用回答。相似度分不出意思相反的问句（“可以登录”/“不可以登录”、“白屏”/“黑屏”、
+# “领取”/“撤销”），所以两句的否定词个数或动作 / 状态词不一致时一律不复用。
+# 默认阈值 0.85 按一组常见提问的同义改写 / 反义改写校准：规范化后同义改写大多在 0.86 以上，
+# 通过否定词和动作词检查的非同义问句都在 0.85 以下。仓库树更新后同频道模式的旧条目整体淘汰。
+# 有 numpy 时向量存在一个矩阵里整体做一次矩阵乘法；没有则退回稀疏向量逐条点积。
+_QUESTION_SYNONYMS = (
+    (re.compile(r"^(请问|请教|问一下|问下|想问下?)"), ""),
+    (re.compile(r"一下|一直|总是|老是|功能(?=怎么)"), ""),
+    (re.compile(r"为什么会|为啥|为何"), "为什么"),
+    (re.compile(r"之后"), "后"),
+    (re.compile(r"去哪"), "在哪"),
+    (re.compile(r"页面"), "页"),
+    (re.compile(r"登陆"), "登录"),
+    (re.compile(r"如何|怎样|咋|怎么样才能|怎么才能"), "怎么"),
+    (re.compile(r"(该|要|应该|需要)怎么"), "怎么"),
+    (re.compile(r"了(?=怎么|吗|呢|为什么)"), ""),
+    (re.compile(r"哪里|哪儿"), "哪"),
+    (re.compile(r"使用"), "用"),
+    (re.compile(r"怎么(解决|处理)"), "怎么办"),
+    (re.compile(r"(领|拿|收|找)不到"), r"\1不了"),
+    (re.compile(r"没有"), "没"),
+    (re.compile(r"删掉|去掉"), "删除"),
+    (re.compile(r"打开|启用"), "开启"),
+    (re.compile(r"新增|增加"), "添加"),
+    (re.compile(r"获取|获得|拿到"), "领取"),
+    (re.compile(r"^怎么用(.+)$"), r"\1怎么用"),
+    (re.compile(r"[了啊呢吗吧呀哦嘛啦哈]+$"), ""),
+)
+# 会被误当作否定的固定搭配
+_QUESTION_NEGATION_NOISE_RE = re.compile(r"非常|无论|不过|不用谢|没事")
+_QUESTION_NEGATION_RE = re.compile(r"[不没无未别非莫勿否]")
+# 动作 / 状态词与常见反义单字：两句里出现的集合不同就视为不同的问题
+_QUESTION_POLARITY_RE = re.compile(
+    r"领取|撤销|删除|注销|取消|归还|退还|添加|创建|修改|编辑|更改|重置|开启|关闭|启用|禁用|"
+    r"上传|下载|导入|导出|登录|注册|退出|登出|绑定|解绑|显示|隐藏|置顶|置底|成功|失败|"
+    r"白屏|黑屏|花屏|蓝屏|卡住|卡顿|闪退|崩溃|过期|有效|无效|发送|接收|加入|离开|购买|退款|"
+    r"安卓|苹果|电脑|手机|网页|客户端|[快慢大小多少高低长短开关对错新旧早晚次]"
+)
+
+
+def _canonical_question(text: str) -> str:
+    question = _normalize_question(text)
+    for pattern, repl in _QUESTION_SYNONYMS:
+        question = pattern.sub(repl, question)
+    return question
+
+
+def _question_polarity(question: str) -> tuple:
+    """（规范化后的问题）-> (否定词个数, 动作 / 状态词集合)"""
+    stripped = _QUESTION_NEGATION_NOISE_RE.sub("", question)
+    return len(_QUESTION_NEGATION_RE.findall(stripped)), frozenset(_QUESTION_POLARITY_RE.findall(question))
+
+
+def _embed_question(text: str, dim: int = AI_SEMANTIC_CACHE_DIM) -> dict:
+    """字符一元/二元组哈希向量（次线性词频，L2 归一化），返回 {维度: 权重}"""
+    question = _canonical_question(text)
+    counts = {}
+    # 三元组对短中文问句太敏感，换个说法就几乎不重合，只用一元和二元组
+    for n in (1, 2):
+        for i in range(len(question) - n + 1):
+            gram = question[i:i + n]
+            idx = zlib.crc32(gram.encode("utf-8")) % dim
+            counts[idx] = counts.get(idx, 0) + 1
+    vec = {idx: 1.0 + math.log(c) for idx, c in counts.items()}
+    norm = math.sqrt(sum(w * w for w in vec.values()))
+    if not norm:
+        return {}
+    return {idx: w / norm for idx, w in vec.items()}
+
+
+class SemanticAnswerCache:
+    def __init__(self, capacity: int, dim: int, threshold: float, ttl: float):
+        self.capacity = max(1, capacity)
+        self.dim = dim
+        self.threshold = threshold
+        self.ttl = ttl
+        self._order = OrderedDict()  # slot -> None，按最近使用排序
+        self._entries = {}  # slot -> {"group", "ts", "template", "vec", "polarity"}
+        self._groups = {}
+        self._next_group = 0
+        self._free = list(range(self.capacity - 1, -1, -1))
+        if np is not None:
+            self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+            self._slot_group = np.full(self.capacity, -1, dtype=np.int32)
+        self.stats = {"lookups": 0, "hits": 0, "stores": 0, "expired": 0, "latency_total_ms": 0.0,
+                      "latencies": deque(maxlen=200)}
+
+    def _group_id(self, group: tuple) -> int:
+        if group not in self._groups:
+            self._groups[group] = self._next_group
+            self._next_group += 1
+        return self._groups[group]
+
+    def _evict_stale_groups(self, group: tuple):
+        """同一频道模式下仓库树已更新：丢掉旧树 SHA 分组的全部条目"""
+        stale = {gid for g, gid in self._groups.items() if g[0] == group[0] and g != group}
+        if not stale:
+            return
+        for slot in [slot for slot, entry in self._entries.items() if entry["group"] in stale]:
+            self._drop(slot)
+        self._groups = {g: gid for g, gid in self._groups.items() if gid not in stale}
+
+    def _drop(self, slot: int):
+        self._order.pop(slot, None)
+        self._entries.pop(slot, None)
+        if np is not None:
+            self._slot_group[slot] = -1
+            self._matrix[slot] = 0.0
+        self._free.append(slot)
+
+    def _best_match(self, vec: dict, group_id: int) -> tuple:
+        if np is not None:
+            query = np.zeros(self.dim, dtype=np.float32)
+            for idx, w in vec.items():
+                query[idx] = w
+            scores = self._matrix @ query
+            scores[self._slot_group != group_id] = -1.0
+            slot = int(np.argmax(scores))
+            return slot, float(scores[slot])
+        best_slot, best_score = -1, -1.0
+        for slot, entry in self._entries.items():
+            if entry["group"] != group_id:
+                continue
+            other = entry["vec"]
+            score = sum(w * other.get(idx, 0.0) for idx, w in vec.items())
+            if score > best_score:
+                best_slot, best_score = slot, score
+        return best_slot, best_score
+
+    def lookup(self, question: str, group: tuple) -> Optional[str]:
+        """返回命中的回答模板；未命中返回 None"""
+        started = time.perf_counter()
+        self.stats["lookups"] += 1
+        try:
+            vec = _embed_question(question, self.dim)
+            if not vec or not self._entries or group not in self._groups:
+                return None
+            slot, score = self._best_match(vec, self._groups[group])
+            entry = self._entries.get(slot)
+            if entry is None or score < self.threshold:
+                return None
+            if _question_polarity(_canonical_question(question)) != entry["polarity"]:
+                return None
+            if self.ttl and time.time() - entry["ts"] > self.ttl:
+                self._drop(slot)
+                self.stats["expired"] += 1
+                return None
+            self._order.move_to_end(slot)
+            self.stats["hits"] += 1
+            return entry["template"]
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.stats["latency_total_ms"] += elapsed
+            self.stats["latencies"].append(elapsed)
+
+    def store(self, question: str, group: tuple, template: str):
+        vec = _embed_question(question, self.dim)
+        if not vec:
+            return
+        self._evict_stale_groups(group)
+        group_id = self._group_id(group)
+        # 与已有问题几乎相同则覆盖该条，避免同一问题占多个位置
+        slot, score = self._best_match(vec, group_id) if self._entries else (-1, -1.0)
+        if slot not in self._entries or score < 0.98:
+            if not self._free:
+                self._drop(next(iter(self._order)))
+            slot = self._free.pop()
+        self._entries[slot] = {
+            "group": group_id, "ts": time.time(), "template": template, "vec": vec,
+            "polarity": _question_polarity(_canonical_question(question))
+        }
+        self._order[slot] = None
+        self._order.move_to_end(slot)
+        if np is not None:
+            self._matrix[slot] = 0.0
+            for idx, w in vec.items():
+                self._matrix[slot, idx] = w
+            self._slot_group[slot] = group_id
+        self.stats["stores"] += 1
+
+    def snapshot(self) -> dict:
+        stats = self.stats
+        latencies = sorted(stats["latencies"])
+        lookups = stats["lookups"]
+        return {
+            "size": len(self._entries),
+            "lookups": lookups,
+            "hits": stats["hits"],
+            "stores": stats["stores"],
+            "expired": stats["expired"],
+            "hit_rate": stats["hits"] / lookups if lookups else 0.0,
+            "latency_avg_ms": stats["latency_total_ms"] / lookups if lookups else 0.0,
+            "latency_p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+            "backend": "numpy" if np is not None else "python",
+        }
+
+
+_SEMANTIC_ANSWER_CACHE = SemanticAnswerCache(
+    AI_SEMANTIC_CACHE_SIZE, AI_SEMANTIC_CACHE_DIM, AI_SEMANTIC_CACHE_THRESHOLD, AI_ANSWER_CACHE_TTL_SEC
+)
+
+
+def _semantic_cache_group(mode: str) -> tuple:
+    return (mode, "" if mode == "key_help" else _REPO_TREE_CACHE.get("sha", ""))
+
+
+def _get_semantic_answer(user_text: str, mode: str, message: discord.Message) -> Optional[str]:
+    if not AI_SEMANTIC_CACHE_ENABLED or AI_SEMANTIC_CACHE_SIZE <= 0:
+        return None
+    template = _SEMANTIC_ANSWER_CACHE.lookup(user_text, _semantic_cache_group(mode))
+    return _render_answer_template(template, message.author) if template else None
+
+
+def _store_semantic_answer(user_text: str, mode: str, answer: str, message: discord.Message):
+    if not AI_SEMANTIC_CACHE_ENABLED or AI_SEMANTIC_CACHE_SIZE <= 0:
+        return
+    template = _answer_template(answer, message.author)
+    if template is not None:
+        _SEMANTIC_ANSWER_CACHE.store(user_text, _semantic_cache_group(mode), template)
+
+
+def semantic_cache_stats() -> dict:
+    return _SEMANTIC_ANSWER_CACHE.snapshot()
+
+
+# ----------------------
+# AI 请求调度
+# ----------------------
+# 按频道类别（密钥引导 / 答疑 / 闲聊）分队列排队，空出并发槽位时按权重公平挑选下一类；
+# 答疑类最多占用 AI_SCHED_QA_MAX_INFLIGHT 个槽位，保证短回复在答疑高峰时仍能及时拿到槽位。
+AI_SCHED_CLASSES = ("key_help", "chat", "qa")
+
+
+class AISchedulerFull(Exception):
+    """队列已满，请求被丢弃"""
+
 
-        # 当模型因为 token 上限被截断时，自动续写，避免只返回前半段。
-        request_messages.append({"role": "assistant", "content": content})
-        request_messages.append({"role": "user", "content": "请从上次中断处继续输出，不要重复前文。"})
+def _parse_sched_weights(text: str) -> dict:
+    weights = {name: 1.0 for name in AI_SCHED_CLASSES}
+    for item in (text or "").split(","):
+        name, _, value = item.partition(":")
+        name = name.strip()
+        if name not in weights:
+            continue
+        try:
+            weights[name] = max(0.1, float(value))
+        except ValueError:
+            continue
+    return weights
+
+
+class AIRequestScheduler:
+    def __init__(self, capacity: int, weights: dict, max_queue: int, max_inflight: dict = None):
+        self.capacity = max(1, capacity)
+        self.weights = dict(weights)
+        self.max_queue = max_queue
+        self.max_inflight = dict(max_inflight or {})
+        self._queues = {name: deque() for name in self.weights}
+        self._pass = {name: 0.0 for name in self.weights}
+        self._vtime = 0.0
+        self._inflight = {name: 0 for name in self.weights}
+        self._stats = {
+            name: {"submitted": 0, "dispatched": 0, "shed": 0, "cancelled": 0,
+                   "wait_total": 0.0, "wait_max": 0.0, "waits": deque(maxlen=200)}
+            for name in self.weights
+        }
 
-    merged = "\n".join([s for s in segments if s]).strip()
-    if merged:
-        return merged, ""
-    return "", "空响应"
+    @property
+    def inflight(self) -> int:
+        return sum(self._inflight.values())
 
+    def _can_run(self, name: str) -> bool:
+        limit = self.max_inflight.get(name)
+        return not limit or self._inflight[name] < limit
 
-async def _call_openai_streaming(messages: list, model: str, on_delta=None) -> tuple:
-    url = f"{AI_API_BASE}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {AI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = _build_openai_payload(messages, model, stream=True)
-    timeout = aiohttp.ClientTimeout(total=60)
-    full_text = ""
-    try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, headers=headers, json=payload) as resp:
-                if resp.status != 200:
-                    raw = await resp.text()
-                    print(f"❌ AI 流式请求失败: {resp.status} | {raw[:300]}")
-                    return "", f"HTTP {resp.status}"
-                async for raw_line in resp.content:
-                    if not raw_line:
-                        continue
-                    try:
-                        line = raw_line.decode("utf-8", errors="ignore").strip()
-                    except Exception:
-                        continue
-                    if not line:
-                        continue
-                    for piece in line.splitlines():
-                        if not piece.startswith("data:"):
-                            continue
-                        data_str = piece[5:].strip()
-                        if not data_str:
-                            continue
-                        if data_str == "[DONE]":
-                            if on_delta:
-                                await on_delta(full_text, True)
-                            return full_text, ""
-                        try:
-                            data = json.loads(data_str)
-                        except Exception:
-                            continue
-                        delta = _extract_stream_delta(data)
-                        if delta:
-                            full_text += delta
-                            if on_delta:
-                                await on_delta(full_text, False)
-    except Exception as e:
-        print(f"❌ AI 流式请求异常: {e}")
-        return full_text, str(e)
+    def _dispatch(self):
+        while self.inflight < self.capacity:
+            candidates = [n for n, q in self._queues.items() if q and self._can_run(n)]
+            if not candidates:
+                return
+            # 步幅调度：pass 最小的类别先出队，出队后 pass 按 1/权重 前进
+            name = min(candidates, key=lambda n: (self._pass[n], -self.weights[n]))
+            future, enqueued_at = self._queues[name].popleft()
+            if future.done():
+                continue
+            self._vtime = self._pass[name]
+            self._pass[name] += 1.0 / self.weights[name]
+            self._inflight[name] += 1
+            wait = time.monotonic() - enqueued_at
+            stats = self._stats[name]
+            stats["dispatched"] += 1
+            stats["wait_total"] += wait
+            stats["wait_max"] = max(stats["wait_max"], wait)
+            stats["waits"].append(wait)
+            future.set_result(wait)
+
+    async def acquire(self, name: str) -> float:
+        """排队等待一个并发槽位，返回排队耗时；队列已满时抛出 AISchedulerFull"""
+        if name not in self._queues:
+            name = "qa"
+        stats = self._stats[name]
+        stats["submitted"] += 1
+        queue = self._queues[name]
+        if self.max_queue and len(queue) >= self.max_queue:
+            stats["shed"] += 1
+            raise AISchedulerFull(name)
+        if not queue and not self._inflight[name]:
+            # 空闲后重新进入的类别不累积欠账，避免一次性抢占全部槽位
+            self._pass[name] = max(self._pass[name], self._vtime)
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, time.monotonic())
+        queue.append(entry)
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分到槽位但调用方被取消，归还槽位
+                self.release(name)
+            else:
+                stats["cancelled"] += 1
+                try:
+                    queue.remove(entry)
+                except ValueError:
+                    pass
+            raise
 
-    if on_delta:
-        await on_delta(full_text, True)
-    return full_text, ""
+    def release(self, name: str):
+        if name not in self._inflight:
+            name = "qa"
+        self._inflight[name] = max(0, self._inflight[name] - 1)
+        self._dispatch()
 
+    @asynccontextmanager
+    async def slot(self, name: str):
+        await self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self) -> dict:
+        result = {"capacity": self.capacity, "inflight": self.inflight, "classes": {}}
+        for name, stats in self._stats.items():
+            waits = sorted(stats["waits"])
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+            dispatched = stats["dispatched"]
+            result["classes"][name] = {
+                "weight": self.weights[name],
+                "queued": len(self._queues[name]),
+                "inflight": self._inflight[name],
+                "submitted": stats["submitted"],
+                "dispatched": dispatched,
+                "shed": stats["shed"],
+                "cancelled": stats["cancelled"],
+                "wait_avg": stats["wait_total"] / dispatched if dispatched else 0.0,
+                "wait_p95": p95,
+                "wait_max": stats["wait_max"],
+            }
+        return result
 
-async def _call_openai_with_retry(messages: list, model: str, stream: bool = False, on_delta=None) -> tuple:
-    last_error = ""
-    attempts = AI_API_RETRY_MAX + 1
-    for attempt in range(attempts):
-        if stream:
-            text, error = await _call_openai_streaming(messages, model, on_delta=on_delta)
-        else:
-            text, error = await _call_openai_compatible(messages, model)
 
-        if stream and not text and not error:
-            text, error = await _call_openai_compatible(messages, model)
+_AI_SCHEDULER = AIRequestScheduler(
+    AI_MAX_CONCURRENCY,
+    _parse_sched_weights(AI_SCHED_WEIGHTS),
+    AI_SCHED_MAX_QUEUE,
+    {"qa": min(AI_SCHED_QA_MAX_INFLIGHT, AI_MAX_CONCURRENCY)}
+)
 
-        if text:
-            return text, error
 
-        last_error = error or "空响应"
-        if attempt < attempts - 1:
-            delay = AI_API_RETRY_BACKOFF_SEC * (attempt + 1)
-            await asyncio.sleep(delay)
+def ai_scheduler_stats() -> dict:
+    return _AI_SCHEDULER.stats()
 
-    return "", last_error
 
+# ----------------------
+# 相同请求合并（single-flight）
+# ----------------------
+# 同一时间多人问同一个问题、或消息被编辑重发时，合并为一次上游调用：先到的请求负责排队调用，
+# 后到的直接等待同一结果；流式增量会同时推送给所有等待者。
+# 指纹只取与提问者无关的部分（模型、系统提示词、归一化问题、仓库上下文摘要），
+# 只有不带身份 / 楼层 / 对话历史的共享提示词才参与合并，其余请求各自调用。
+_AI_INFLIGHT = {}
+_AI_SINGLE_FLIGHT_STATS = {"calls": 0, "joined": 0, "solo": 0}
 
-def _build_stream_updater(
-    base_message: Optional[discord.Message],
-    channel: discord.abc.Messageable,
-    limit: int = 1800
-):
-    state = {
-        "messages": [base_message] if base_message else [],
-        "last_ts": 0.0,
-        "last_len": 0
-    }
 
-    async def _update(full_text: str, final: bool = False):
-        text = (full_text or "").strip()
-        if not text:
-            return
-        now = time.time()
-        if not final:
-            if len(text) - state["last_len"] < AI_STREAMING_MIN_CHARS and now - state["last_ts"] < AI_STREAMING_UPDATE_INTERVAL_SEC:
-                return
-        state["last_ts"] = now
-        state["last_len"] = len(text)
+def _ai_prompt_fingerprint(model: str, system_prompt: str, question: str, repo_context: str, extra: list = None) -> str:
+    raw = json.dumps({
+        "model": model,
+        "system": system_prompt,
+        "question": _normalize_question(question),
+        "repo": hashlib.sha256((repo_context or "").encode("utf-8")).hexdigest(),
+        "extra": list(extra or []),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-        chunks = _split_discord_text(text, limit=limit)
-        if not chunks:
-            return
 
-        if state["messages"] and len(chunks) > len(state["messages"]):
-            try:
-                await state["messages"][-1].edit(content=chunks[len(state["messages"]) - 1])
-            except Exception:
-                return
+async def _call_ai_scheduled(messages: list, model: str, sched_class: str, on_delta=None) -> tuple:
+    async with _AI_SCHEDULER.slot(sched_class):
+        if AI_STREAMING_ENABLED:
+            return await _call_openai_with_retry(messages, model, stream=True, on_delta=on_delta)
+        return await _call_openai_with_retry(messages, model)
+
+
+async def _call_ai_single_flight(
+    messages: list,
+    model: str,
+    sched_class: str,
+    on_delta=None,
+    fingerprint: Optional[str] = None
+) -> tuple:
+    """fingerprint 为空（提示词带个人上下文）时不合并，直接排队调用"""
+    if not fingerprint:
+        _AI_SINGLE_FLIGHT_STATS["solo"] += 1
+        return await _call_ai_scheduled(messages, model, sched_class, on_delta)
+
+    flight = _AI_INFLIGHT.get(fingerprint)
+    if flight is None:
+        flight = {"subscribers": [], "task": None}
+
+        async def _fanout(full_text: str, final: bool = False):
+            for callback in list(flight["subscribers"]):
+                try:
+                    await callback(full_text, final)
+                except Exception as e:
+                    print(f"⚠️ 流式增量推送失败: {e}")
 
-        while len(state["messages"]) < len(chunks):
-            try:
-                new_msg = await channel.send(chunks[len(state["messages"])])
-            except Exception:
-                return
-            state["messages"].append(new_msg)
+        def _done(_task):
+            if _AI_INFLIGHT.get(fingerprint) is flight:
+                _AI_INFLIGHT.pop(fingerprint, None)
 
-        target = state["messages"][-1]
-        try:
-            await target.edit(content=chunks[-1])
-        except Exception:
-            return
+        flight["task"] = asyncio.create_task(_call_ai_scheduled(messages, model, sched_class, _fanout))
+        flight["task"].add_done_callback(_done)
+        _AI_INFLIGHT[fingerprint] = flight
+        _AI_SINGLE_FLIGHT_STATS["calls"] += 1
+    else:
+        _AI_SINGLE_FLIGHT_STATS["joined"] += 1
 
-    return _update, state
+    if on_delta:
+        flight["subscribers"].append(on_delta)
+    try:
+        # shield：某个等待者被取消时不影响共享的上游调用
+        return await asyncio.shield(flight["task"])
+    finally:
+        if on_delta in flight["subscribers"]:
+            flight["subscribers"].remove(on_delta)
 
 
-def _truncate_input(text: str) -> str:
-    if not text:
-        return ""
-    if len(text) <= AI_MAX_INPUT_CHARS:
-        return text
-    return text[:AI_MAX_INPUT_CHARS].rstrip() + "..."
+def ai_single_flight_stats() -> dict:
+    return {**_AI_SINGLE_FLIGHT_STATS, "inflight": len(_AI_INFLIGHT)}
 
 
 async def handle_ai_reply(message: discord.Message):
     global _AI_MISSING_KEY_LOGGED
+    coalescer = None
     try:
         if not AI_ENABLED:
             return
@@ -2619,61 +5084,122 @@ async def handle_ai_reply(message: discord.Message):
         chat_only = channel_id == AI_CHAT_CHANNEL_ID
         key_tips = _build_key_help_tips(user_text) if is_key_help else []
 
+        context_key = _build_context_key(message)
+        need_floor = bool(message.guild) and not is_key_help
+        should_repo = (
+            not is_key_help
+            and not chat_only
+            and (force_repo or _should_read_repo_code(user_text))
+        )
+
+        if is_key_help:
+            answer_mode = "key_help"
+        elif chat_only:
+            answer_mode = "chat"
+        else:
+            answer_mode = "qa_force_repo" if force_repo else "default"
+        answer_key = _answer_cache_key(message, user_text, image_urls, answer_mode)
+        if answer_key and _question_needs_context(user_text):
+            _ANSWER_CACHE_STATS["skipped"] += 1
+            answer_key = None
+        # 可缓存的常见问题用与提问者无关的提示词作答（不带身份、频道楼层和对话历史），
+        # 缓存的回答对任何人都成立，查缓存前也不用先等频道历史
+        shared_prompt = answer_key is not None
+
+        cached_answer = _get_cached_answer(answer_key, message) if answer_key else None
+        if answer_key and not cached_answer:
+            # 精确缓存未命中时再找近似问题（同频道模式、同仓库版本）
+            cached_answer = _get_semantic_answer(user_text, answer_mode, message)
+        if cached_answer:
+            # 命中缓存：不检索仓库、不占用调度槽位、不消耗上游额度
+            parts = _split_discord_text(cached_answer)
+            if parts:
+                await _send_or_edit_message(None, message.channel, parts[0], reply_to=message)
+                for extra in parts[1:]:
+                    await message.channel.send(extra)
+                _schedule_ai_history_write(context_key, user_text, cached_answer)
+            return
+
+        # 各路上下文并发收集，整体耗时取决于最慢的一路而不是全部相加
+        reply_task = asyncio.create_task(_gather_context(
+            _build_reply_context(message), AI_CONTEXT_GATHER_TIMEOUT_SEC, "", "引用消息"
+        ))
+        floor_task = asyncio.create_task(_gather_context(
+            _build_channel_floor_context(message, AI_CHANNEL_CONTEXT_MESSAGES)
+            if need_floor and not shared_prompt else _resolved_context(""),
+            AI_CONTEXT_GATHER_TIMEOUT_SEC, "", "频道楼层"
+        ))
+        history_task = asyncio.create_task(_gather_context(
+            _load_ai_history(context_key) if not shared_prompt else _resolved_context([]),
+            AI_CONTEXT_GATHER_TIMEOUT_SEC, [], "对话历史"
+        ))
+
+        async def _repo_extra_texts():
+            # shield：仓库检索超时被取消时不连带取消其它收集任务
+            reply_ctx, floor_ctx, hist = await asyncio.gather(
+                asyncio.shield(reply_task),
+                asyncio.shield(floor_task),
+                asyncio.shield(history_task)
+            )
+            texts = [t for t in (reply_ctx, floor_ctx) if t]
+            if hist:
+                history_text = " ".join([h.get("content", "") for h in hist[-2:]])
+                if history_text.strip():
+                    texts.append(history_text)
+            return texts
+
+        repo_task = None
+        if should_repo:
+            repo_task = asyncio.create_task(_gather_context(
+                _build_repo_context_iterative(
+                    user_text,
+                    force_read=force_repo,
+                    max_rounds=AI_QA_MAX_ITERATIONS,
+                    extra_texts_loader=_repo_extra_texts
+                ),
+                AI_REPO_CONTEXT_TIMEOUT_SEC, "", "仓库检索"
+            ))
+
         thinking_hint = "⏳ 正在思考..."
         if force_repo:
             thinking_hint = "🔎 正在检索仓库并思考..."
 
-        thinking_message = await _send_or_edit_message(
-            None,
-            message.channel,
-            thinking_hint,
-            reply_to=message
-        )
-
-        user_identity = _build_user_identity_prompt(message)
-        reply_context = await _build_reply_context(message)
-        floor_context = ""
-        if message.guild and not is_key_help:
-            floor_context = await _build_channel_floor_context(message, AI_CHANNEL_CONTEXT_MESSAGES)
+        try:
+            thinking_message = await _send_or_edit_message(
+                None,
+                message.channel,
+                thinking_hint,
+                reply_to=message
+            )
+        except BaseException:
+            for task in (reply_task, floor_task, history_task, repo_task):
+                if task:
+                    task.cancel()
+            raise
 
-        context_key = _build_context_key(message)
-        history = _load_ai_history(context_key)
+        user_identity = "" if shared_prompt else _build_user_identity_prompt(message)
         user_content = _build_user_content(user_text, image_urls)
         model = AI_VISION_MODEL if image_urls else AI_MODEL
 
         if is_key_help:
             command_catalog = ""
             system_prompt = _build_system_prompt(command_catalog=command_catalog, mode="key_help")
-            repo_context = ""
         elif chat_only:
             command_catalog = ""
             system_prompt = _build_system_prompt(command_catalog=command_catalog, mode="chat")
-            repo_context = ""
         else:
             command_catalog = _build_command_catalog_text() if _should_include_command_catalog(user_text) else ""
             system_prompt = _build_system_prompt(
                 command_catalog=command_catalog,
                 mode="qa_force_repo" if force_repo else "default"
             )
-            extra_repo_texts = []
-            if reply_context:
-                extra_repo_texts.append(reply_context)
-            if floor_context:
-                extra_repo_texts.append(floor_context)
-            if history:
-                history_text = " ".join([h.get("content", "") for h in history[-2:]])
-                if history_text.strip():
-                    extra_repo_texts.append(history_text)
-            should_repo = force_repo or _should_read_repo_code(user_text)
-            if should_repo:
-                repo_context = await _build_repo_context_iterative(
-                    user_text,
-                    force_read=force_repo,
-                    extra_texts=extra_repo_texts,
-                    max_rounds=AI_QA_MAX_ITERATIONS
-                )
-            else:
-                repo_context = ""
+
+        reply_context, floor_context, history, repo_context = await asyncio.gather(
+            reply_task,
+            floor_task,
+            history_task,
+            repo_task if repo_task else _resolved_context("")
+        )
 
         messages = [{"role": "system", "content": system_prompt}]
         if user_identity:
@@ -2692,31 +5218,47 @@ async def handle_ai_reply(message: discord.Message):
         messages.extend(history)
         messages.append({"role": "user", "content": user_content})
 
-        stream_updater = None
         if AI_STREAMING_ENABLED:
-            stream_updater, _ = _build_stream_updater(thinking_message, message.channel)
-
-        async with _AI_SEMAPHORE:
-            if AI_STREAMING_ENABLED and stream_updater:
-                reply_text, error = await _call_openai_with_retry(
-                    messages,
-                    model,
-                    stream=True,
-                    on_delta=stream_updater
-                )
-            else:
-                reply_text, error = await _call_openai_with_retry(messages, model)
+            coalescer = StreamEditCoalescer(thinking_message, message.channel, reply_to=message)
+
+        sched_class = "key_help" if is_key_help else ("chat" if chat_only else "qa")
+        fingerprint = None
+        if shared_prompt:
+            fingerprint = _ai_prompt_fingerprint(model, system_prompt, user_text, repo_context, key_tips)
+        try:
+            reply_text, error = await _call_ai_single_flight(
+                messages,
+                model,
+                sched_class,
+                on_delta=coalescer.update if coalescer else None,
+                fingerprint=fingerprint
+            )
+        except AISchedulerFull:
+            print(f"⚠️ AI 请求队列已满（{sched_class}），已丢弃")
+            await _send_or_edit_message(
+                thinking_message,
+                message.channel,
+                "⏳ 现在提问的人有点多，请稍后再试。",
+                reply_to=message
+            )
+            return
 
         if not reply_text:
             error_text = _build_ai_error_text(error)
-            await _send_or_edit_message(thinking_message, message.channel, error_text, reply_to=message)
+            if coalescer:
+                await coalescer.finish(error_text)
+            else:
+                await _send_or_edit_message(thinking_message, message.channel, error_text, reply_to=message)
             return
 
-        _append_ai_history(context_key, "user", user_text)
-        _append_ai_history(context_key, "assistant", reply_text)
+        _schedule_ai_history_write(context_key, user_text, reply_text)
+        if answer_key and not error:
+            _store_cached_answer(answer_key, reply_text, message)
+            _store_semantic_answer(user_text, answer_mode, reply_text, message)
 
-        if AI_STREAMING_ENABLED and stream_updater:
-            await stream_updater(reply_text, True)
+        if coalescer:
+            if not await coalescer.finish(reply_text):
+                print("⚠️ 流式回复未能完整显示")
         else:
             parts = _split_discord_text(reply_text)
             if not parts:
@@ -2739,11 +5281,15 @@ async def handle_ai_reply(message: discord.Message):
                 _build_ai_error_text("内部异常"),
                 reply_to=message
             )
+    finally:
+        # 任何提前返回 / 异常都要停掉流式刷新任务，避免泄漏或在结束后继续编辑消息
+        if coalescer:
+            coalescer.cancel()
 
 # ======================
 # 异常账号检测
 # ======================
-def detect_suspicious_account(uid: str) -> dict:
+async def detect_suspicious_account(uid: str) -> dict:
     """
     检测异常账号：基于密钥网站使用时的user_agent信息
 
@@ -2764,7 +5310,7 @@ def detect_suspicious_account(uid: str) -> dict:
     try:
         # 获取用户的密钥使用历史（网站验证时上报的数据）
         history_key = f"user:key_usage_history:{uid}"
-        history_data = redis.lrange(history_key, 0, -1) or []
+        history_data = await redis.lrange(history_key, 0, -1) or []
 
         if not history_data:
             return suspicious_info
@@ -2870,7 +5416,7 @@ def detect_suspicious_account(uid: str) -> dict:
 
         # 标记可疑账号到 Redis（30天内有效）
         if suspicious_info["is_suspicious"]:
-            redis.setex(
+            await redis.setex(
                 f"suspicious_account:{uid}",
                 2592000,  # 30天
                 json.dumps({
@@ -2880,7 +5426,7 @@ def detect_suspicious_account(uid: str) -> dict:
                 })
             )
             # 添加到可疑账号集合
-            redis.sadd("suspicious_accounts_set", uid)
+            await redis.sadd("suspicious_accounts_set", uid)
 
     except Exception as e:
         print(f"⚠️ 异常检测失败: {str(e)}")
@@ -2994,7 +5540,68 @@ async def notify_admins_of_suspicious(interaction, uid: str, suspicious_info: di
     except Exception as e:
         print(f"通知管理员失败: {e}")
 
-def record_claim_history(uid: str, key: str, user_agent: str = "", device_info: dict = None):
+KEY_USAGE_HISTORY_TTL_SEC = 2592000  # 30天
+KEY_USAGE_HISTORY_MAX = 20  # 每个用户保留的最近记录数
+# 有使用记录的 UID 索引（有序集合，score 为最近一次写入时间），避免扫描整个键空间
+KEY_USAGE_HISTORY_INDEX = "key_usage_history:uids"
+# 旧数据回填进度：保存 SCAN 游标，全部扫完后写入 done，只执行一次且可断点续扫
+KEY_USAGE_HISTORY_BACKFILL = "key_usage_history:uids:backfill"
+SUSPICIOUS_SCAN_PAGE_SIZE = max(10, int(os.getenv("SUSPICIOUS_SCAN_PAGE_SIZE", "500")))
+SUSPICIOUS_SCAN_MAX_SECONDS = float(os.getenv("SUSPICIOUS_SCAN_MAX_SECONDS", "10"))
+SUSPICIOUS_DETECT_CONCURRENCY = max(1, int(os.getenv("SUSPICIOUS_DETECT_CONCURRENCY", "8")))
+
+
+async def load_active_history_uids() -> list:
+    """读取30天内有密钥使用记录的 UID，并顺带清理索引中已过期的成员"""
+    cutoff = time.time() - KEY_USAGE_HISTORY_TTL_SEC
+    pipe = redis.pipeline()
+    pipe.zremrangebyscore(KEY_USAGE_HISTORY_INDEX, "-inf", cutoff)
+    pipe.zrange(KEY_USAGE_HISTORY_INDEX, 0, -1)
+    _, members = await pipe.exec()
+    return [uid for uid in (clean_key(m) for m in (members or [])) if uid]
+
+
+async def backfill_history_uid_index() -> int:
+    """
+    把索引建立之前写入的使用记录 UID 回填到索引（一次性迁移）。
+    每页 SCAN 后保存游标，超出时间预算时下次从断点继续；返回本次回填的 UID 数。
+    """
+    state = clean_key(await redis.get(KEY_USAGE_HISTORY_BACKFILL))
+    if state == "done":
+        return 0
+    try:
+        cursor = int(state or 0)
+    except ValueError:
+        cursor = 0
+
+    prefix = "user:key_usage_history:"
+    added = 0
+    async for cursor, keys in iter_scan_pages(
+        prefix + "*",
+        cursor=cursor,
+        count=SUSPICIOUS_SCAN_PAGE_SIZE,
+        time_budget=SUSPICIOUS_SCAN_MAX_SECONDS
+    ):
+        uids = []
+        for raw_key in keys:
+            key_text = clean_key(raw_key)
+            if key_text and key_text.startswith(prefix) and len(key_text) > len(prefix):
+                uids.append(key_text[len(prefix):])
+        pipe = redis.pipeline()
+        if uids:
+            # nx：不覆盖新写入时记录的真实时间
+            pipe.zadd(KEY_USAGE_HISTORY_INDEX, {uid: time.time() for uid in dict.fromkeys(uids)}, nx=True)
+            added += len(uids)
+        pipe.set(KEY_USAGE_HISTORY_BACKFILL, "done" if cursor == 0 else str(cursor))
+        await pipe.exec()
+    if cursor == 0:
+        print(f"✅ 使用记录 UID 索引回填完成（本次 {added} 个）")
+    else:
+        print(f"⚠️ 使用记录 UID 索引回填未完成，下次从游标 {cursor} 继续")
+    return added
+
+
+async def record_claim_history(uid: str, key: str, user_agent: str = "", device_info: dict = None):
     """
     记录用户的密钥使用历史（包含设备/浏览器/系统信息）
     用于异常检测
@@ -3006,23 +5613,16 @@ def record_claim_history(uid: str, key: str, user_agent: str = "", device_info:
     - device_info: 自定义的设备信息字典（若无则从user_agent解析）
     """
     try:
-        # 获取现有的使用历史
         history_key = f"user:key_usage_history:{uid}"
-        history = redis.lrange(history_key, 0, -1) or []
-
-        # 将bytes转为list
-        if history and isinstance(history[0], bytes):
-            history = [json.loads(h.decode('utf-8')) for h in history]
-        elif not isinstance(history, list):
-            history = []
 
         # 解析设备信息
         if device_info is None:
             device_info = parse_user_agent(user_agent)
 
         # 创建新的使用记录
+        now = time.time()
         usage_record = {
-            "timestamp": time.time(),
+            "timestamp": now,
             "key": key,
             "device": device_info.get("device", "未知"),
             "browser": device_info.get("browser", "未知"),
@@ -3030,28 +5630,193 @@ def record_claim_history(uid: str, key: str, user_agent: str = "", device_info:
             "user_agent": user_agent,  # 保存完整的user_agent便于后续分析
         }
 
-        # 添加到历史（保留最近20条以进行完整检测）
-        history.append(usage_record)
-        history = history[-20:]
-
-        # 保存到Redis（保留30天）
-        # 使用字符串列表存储
-        redis.delete(history_key)
-        for record in history:
-            redis.rpush(history_key, json.dumps(record))
-        redis.expire(history_key, 2592000)  # 30天过期
+        # 追加写入：一次事务内 RPUSH + LTRIM（保留最近20条）+ EXPIRE（30天），
+        # 不再读出整表重写，并发验证也不会互相覆盖
+        pipe = redis.multi()
+        pipe.rpush(history_key, json.dumps(usage_record))
+        pipe.ltrim(history_key, -KEY_USAGE_HISTORY_MAX, -1)
+        pipe.expire(history_key, KEY_USAGE_HISTORY_TTL_SEC)
+        pipe.zadd(KEY_USAGE_HISTORY_INDEX, {str(uid): now})
+        await pipe.exec()
 
         print(f"✅ 记录密钥使用: UID {uid} | 设备: {device_info.get('device', '未知')} | 浏览器: {device_info.get('browser', '未知')} | 系统: {device_info.get('os', '未知')}")
 
     except Exception as e:
         print(f"⚠️ 密钥使用历史记录失败: {str(e)}")
 
+
+async def process_key_usage_report(uid: str, key: str, user_agent: str) -> dict:
+    """处理网站上报的一次密钥验证：记录使用历史并检测可疑账号，返回检测结果"""
+    await record_claim_history(uid, key, user_agent)
+    suspicious = await detect_suspicious_account(uid)
+    if suspicious["is_suspicious"]:
+        print(f"🚨 可疑账号检测（网站密钥验证）: UID {uid}")
+        for reason in suspicious.get('reasons', []):
+            print(f"   → {reason}")
+    return suspicious
+
+# ======================
+# 密钥原子领取 / 归还
+# ======================
+KEY_CLAIM_COOLDOWN_SEC = 600
+KEY_CLAIM_MAX_ATTEMPTS = 50
+KEY_CLAIM_BATCH_SIZE = 5
+
+# 脚本访问的每个键都通过 KEYS 声明（Upstash / Redis Cluster 要求），因此候选密钥由调用方先
+# SRANDMEMBER 取出，连同各自的 key:used / key:owner 键一起传入；脚本内再 SREM 确认仍在库中。
+# KEYS: keys:valid, keys:issued, user:keys:{uid}, user:last_claim:{uid}, user:got_key:{uid},
+#       然后每个候选依次为 key:used:{候选}, key:owner:{候选}
+# ARGV: 当前时间戳, 冷却秒数, key:owner JSON, 候选密钥...
+# 返回: {"ok", 密钥, 跳过的已使用密钥数} / {"cooldown", 剩余秒数} / {"empty", 跳过数} / {"retry", 跳过数}
+_CLAIM_KEY_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cooldown = tonumber(ARGV[2])
+local last = tonumber(redis.call('GET', KEYS[4]) or '')
+if last and now - last < cooldown then
+  return {'cooldown', tostring(math.ceil(cooldown - (now - last)))}
+end
+local skipped = 0
+for i = 4, #ARGV do
+  local key = ARGV[i]
+  local used_key = KEYS[6 + (i - 4) * 2]
+  local owner_key = KEYS[7 + (i - 4) * 2]
+  if redis.call('SREM', KEYS[1], key) == 1 then
+    if redis.call('GET', used_key) == 'true' then
+      skipped = skipped + 1
+    else
+      redis.call('SADD', KEYS[2], key)
+      redis.call('LPUSH', KEYS[3], key)
+      redis.call('SET', owner_key, ARGV[3])
+      redis.call('SET', KEYS[4], ARGV[1], 'EX', cooldown)
+      return {'ok', key, tostring(skipped)}
+    end
+  end
+end
+if redis.call('SCARD', KEYS[1]) == 0 then
+  redis.call('DEL', KEYS[5])
+  return {'empty', tostring(skipped)}
+end
+return {'retry', tostring(skipped)}
+"""
+
+# KEYS: keys:valid, keys:issued, user:keys:{uid}, user:last_claim:{uid}, key:owner:{key}, user:got_key:{uid}
+# ARGV: 密钥
+# 仅当密钥仍处于“已发出”状态时归还，重复调用无副作用
+_RELEASE_KEY_SCRIPT = """
+if redis.call('SREM', KEYS[2], ARGV[1]) == 0 then
+  return 0
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('LREM', KEYS[3], 1, ARGV[1])
+redis.call('DEL', KEYS[4], KEYS[5], KEYS[6])
+return 1
+"""
+
+
+def _claim_key_memory(store, keys, args):
+    """_CLAIM_KEY_SCRIPT 在内存存储后端的等价实现"""
+    now, cooldown = float(args[0]), int(args[1])
+    last = store._cmd_get(keys[3])
+    if last is not None:
+        try:
+            elapsed = now - float(last)
+            if elapsed < cooldown:
+                return ["cooldown", str(math.ceil(cooldown - elapsed))]
+        except ValueError:
+            pass
+    skipped = 0
+    for offset, key in enumerate(args[3:]):
+        used_key, owner_key = keys[5 + offset * 2], keys[6 + offset * 2]
+        if store._cmd_srem(keys[0], key) == 0:
+            continue
+        if store._cmd_get(used_key) == "true":
+            skipped += 1
+            continue
+        store._cmd_sadd(keys[1], key)
+        store._cmd_lpush(keys[2], key)
+        store._cmd_set(owner_key, args[2])
+        store._cmd_set(keys[3], args[0], ex=cooldown)
+        return ["ok", key, str(skipped)]
+    if store._cmd_scard(keys[0]) == 0:
+        store._cmd_delete(keys[4])
+        return ["empty", str(skipped)]
+    return ["retry", str(skipped)]
+
+
+def _release_key_memory(store, keys, args):
+    """_RELEASE_KEY_SCRIPT 在内存存储后端的等价实现"""
+    if store._cmd_srem(keys[1], args[0]) == 0:
+        return 0
+    store._cmd_sadd(keys[0], args[0])
+    store._cmd_lrem(keys[2], 1, args[0])
+    store._cmd_delete(keys[3], keys[4], keys[5])
+    return 1
+
+
+MemoryRedis.register_script(_CLAIM_KEY_SCRIPT, _claim_key_memory)
+MemoryRedis.register_script(_RELEASE_KEY_SCRIPT, _release_key_memory)
+
+
+async def claim_key_atomic(uid: str, owner_info: dict) -> dict:
+    """
+    原子领取：冷却检查、弹出未使用密钥、记录发放、写入归属并设置10分钟冷却。
+    候选密钥被并发领走时（脚本返回 retry）重新取一批候选，最多检查 KEY_CLAIM_MAX_ATTEMPTS 个。
+    返回 {"status": "ok"/"cooldown"/"empty", "key": str, "remaining": int, "skipped": int}
+    """
+    claim = {"status": "empty", "key": None, "remaining": 0, "skipped": 0}
+    owner_json = json.dumps(owner_info)
+    checked = 0
+    while True:
+        candidates = await redis.srandmember("keys:valid", KEY_CLAIM_BATCH_SIZE) or []
+        candidates = [k for k in (clean_key(v) for v in candidates) if k]
+        keys = ["keys:valid", "keys:issued", f"user:keys:{uid}", f"user:last_claim:{uid}", f"user:got_key:{uid}"]
+        for candidate in candidates:
+            keys.extend([f"key:used:{candidate}", f"key:owner:{candidate}"])
+        result = await eval_script(
+            _CLAIM_KEY_SCRIPT,
+            keys=keys,
+            args=[str(time.time()), str(KEY_CLAIM_COOLDOWN_SEC), owner_json] + candidates
+        ) or []
+        result = [clean_key(v) for v in result]
+        status = result[0] if result else "empty"
+        try:
+            if status == "ok":
+                claim["key"] = result[1]
+                claim["skipped"] += int(result[2])
+            elif status == "cooldown":
+                claim["remaining"] = int(result[1])
+            else:
+                claim["skipped"] += int(result[1])
+        except (IndexError, TypeError, ValueError):
+            pass
+        checked += max(1, len(candidates))
+        if status != "retry" or checked >= KEY_CLAIM_MAX_ATTEMPTS:
+            claim["status"] = "empty" if status == "retry" else status
+            return claim
+
+
+async def release_claimed_key(uid: str, key: str) -> bool:
+    """私信失败时原子归还密钥：移出已发放、放回可领取库、撤销归属并清除冷却"""
+    released = await eval_script(
+        _RELEASE_KEY_SCRIPT,
+        keys=[
+            "keys:valid",
+            "keys:issued",
+            f"user:keys:{uid}",
+            f"user:last_claim:{uid}",
+            f"key:owner:{key}",
+            f"user:got_key:{uid}"
+        ],
+        args=[key]
+    )
+    return bool(released)
+
 # ======================
 # /领取密钥（限频道评论）
 # ======================
 @bot.tree.command(name="领取密钥", description="🔑领取密钥（需先评论'喵机1号'）")
 async def 领取密钥(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -3083,55 +5848,33 @@ async def 领取密钥(interaction: discord.Interaction):
             # 如果无法读取历史，允许继续（私信或无权限情况）
             pass
 
-    # 检查用户是否在10分钟内已领取过密钥
-    last_claim_time = redis.get(f"user:last_claim:{uid}")
-    if last_claim_time:
-        try:
-            last_time = float(last_claim_time)
-            current_time = time.time()
-            time_diff = current_time - last_time
-
-            if time_diff < 600:  # 10分钟 = 600秒
-                remaining_time = int(600 - time_diff)
-                minutes = remaining_time // 60
-                seconds = remaining_time % 60
-                await interaction.followup.send(
-                    f"❌ **领取过于频繁**\n"
-                    f"请在 {minutes} 分钟 {seconds} 秒后再试\n"
-                    f"💡 每个账号10分钟内只能领取一次密钥",
-                    ephemeral=True
-                )
-                return
-        except:
-            pass
-
-    # 更新最后领取时间
-    redis.set(f"user:last_claim:{uid}", str(time.time()), ex=600)
-
-    # 获取密钥，确保不是已使用过的
-    key = None
-    attempt_count = 0
-    max_attempts = 50  # 防止无限循环
-
-    while attempt_count < max_attempts:
-        attempt_count += 1
-        candidate = clean_key(redis.spop("keys:valid"))
-
-        if not candidate:
-            break  # 没有更多密钥了
-
-        # 检查是否已被使用过
-        is_used = redis.get(f"key:used:{candidate}")
-        if is_used == "true" or is_used is True or is_used == 1:
-            # 这个已使用过的密钥不应该在有效库中，记录日志并继续
-            print(f"⚠️ 警告：已使用的密钥 {candidate} 仍在 keys:valid 中，已移除")
-            continue
-
-        key = candidate
-        break
+    # 原子领取：冷却检查、弹出未使用密钥、记录发放与归属一次完成
+    claim = await claim_key_atomic(uid, {
+        "uid": uid,
+        "name": str(interaction.user),
+        "issuedAt": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "method": "自助领取（频道评论验证）",
+        "discordId": uid
+    })
+
+    if claim["skipped"]:
+        # 已使用过的密钥不应该在有效库中，脚本已将其移除
+        print(f"⚠️ 警告：keys:valid 中有 {claim['skipped']} 个已使用的密钥，已移除")
+
+    if claim["status"] == "cooldown":
+        remaining_time = max(0, claim["remaining"])
+        minutes = remaining_time // 60
+        seconds = remaining_time % 60
+        await interaction.followup.send(
+            f"❌ **领取过于频繁**\n"
+            f"请在 {minutes} 分钟 {seconds} 秒后再试\n"
+            f"💡 每个账号10分钟内只能领取一次密钥",
+            ephemeral=True
+        )
+        return
 
-    if not key:
-        redis.delete(f"user:got_key:{uid}")
+    key = claim["key"]
+    if claim["status"] != "ok" or not key:
         await interaction.followup.send(
             "❌ **暂无可用密钥**\n"
             "当前密钥已全部发完，请联系管理员补充。",
@@ -3140,16 +5883,6 @@ async def 领取密钥(interaction: discord.Interaction):
         return
 
     try:
-        redis.sadd("keys:issued", key)
-        redis.lpush(f"user:keys:{uid}", key)
-        redis.set(f"key:owner:{key}", json.dumps({
-            "uid": uid,
-            "name": str(interaction.user),
-            "issuedAt": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "method": "自助领取（频道评论验证）",
-            "discordId": uid
-        }))
-
         embed = discord.Embed(title="🎉 密钥领取成功", color=0x2ecc71)
         embed.add_field(name="� 使用步骤", value=(
             "1️⃣ 长按下方密钥消息复制\n"
@@ -3166,7 +5899,7 @@ async def 领取密钥(interaction: discord.Interaction):
 
         # 注：密钥使用的user_agent检测数据应由网站通过 /api/record_key_usage API上报
         # 检测异常账号（此时可能还无数据，等网站验证时才会有）
-        suspicious = detect_suspicious_account(uid)
+        suspicious = await detect_suspicious_account(uid)
         if suspicious["is_suspicious"]:
             print(f"🚨 可疑账号检测: {interaction.user} (ID: {uid})")
             for reason in suspicious.get('reasons', []):
@@ -3188,9 +5921,10 @@ async def 领取密钥(interaction: discord.Interaction):
         )
 
     except:
-        redis.srem("keys:issued", key)
-        redis.sadd("keys:valid", key)
-        redis.delete(f"user:got_key:{uid}")
+        try:
+            await release_claimed_key(uid, key)
+        except Exception as e:
+            print(f"❌ 归还密钥失败: {key} | {e}")
         await interaction.followup.send(
             "❌ **无法发送私信**\n"
             "请先开启私信权限：\n"
@@ -3204,13 +5938,78 @@ async def 领取密钥(interaction: discord.Interaction):
 # ======================
 @bot.tree.command(name="剩余密钥", description="📦 查看当前可领取的密钥数量")
 async def 剩余密钥(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
-    cnt = redis.scard("keys:valid")
+    cnt = await redis.scard("keys:valid")
     await interaction.followup.send(f"📦 当前可领取密钥：**{cnt}** 个", ephemeral=True)
 
+# ======================
+# /ai状态（管理员 - AI 调度与缓存指标）
+# ======================
+@bot.tree.command(name="ai状态", description="[管理员] 查看 AI 请求排队与缓存指标")
+@app_commands.default_permissions(administrator=True)
+async def ai状态(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ 无权限", ephemeral=True)
+        return
+    if not await acquire_cmd_lock(interaction.id):
+        return
+    await interaction.response.defer(ephemeral=True)
+
+    sched = ai_scheduler_stats()
+    embed = discord.Embed(title="🤖 AI 状态", color=0x5865f2)
+    flights = ai_single_flight_stats()
+    embed.add_field(
+        name="并发槽位",
+        value=(
+            f"使用中 {sched['inflight']} / {sched['capacity']}\n"
+            f"可合并调用 {flights['calls']} 次（合并相同请求 {flights['joined']} 次），"
+            f"个人上下文调用 {flights['solo']} 次"
+        ),
+        inline=False
+    )
+    labels = {"key_help": "密钥引导", "chat": "闲聊", "qa": "答疑"}
+    for name, item in sched["classes"].items():
+        embed.add_field(
+            name=f"{labels.get(name, name)}（权重 {item['weight']:g}）",
+            value=(
+                f"排队 {item['queued']} / 处理中 {item['inflight']}\n"
+                f"已处理 {item['dispatched']} / 丢弃 {item['shed']} / 取消 {item['cancelled']}\n"
+                f"等待 平均 {item['wait_avg']:.2f}s · p95 {item['wait_p95']:.2f}s · 最大 {item['wait_max']:.2f}s"
+            ),
+            inline=False
+        )
+    answer_cache = answer_cache_stats()
+    embed.add_field(
+        name="回答缓存",
+        value=(
+            f"缓存 {answer_cache['size']} 条，命中率 {answer_cache['hit_rate']:.0%}"
+            f"（命中 {answer_cache['hits']} / 未命中 {answer_cache['misses']} / 不可缓存 {answer_cache['skipped']}）"
+        ),
+        inline=False
+    )
+    semantic = semantic_cache_stats()
+    embed.add_field(
+        name="相似问题缓存",
+        value=(
+            f"缓存 {semantic['size']} 条，命中率 {semantic['hit_rate']:.0%}（{semantic['hits']} / {semantic['lookups']}）\n"
+            f"检索耗时 平均 {semantic['latency_avg_ms']:.2f}ms · p95 {semantic['latency_p95_ms']:.2f}ms（{semantic['backend']}）"
+        ),
+        inline=False
+    )
+    repo_cache = repo_context_cache_stats()
+    embed.add_field(
+        name="仓库上下文",
+        value=(
+            f"预热：{'✅ 已就绪' if repo_context_ready() else '⏳ 未就绪'}\n"
+            f"缓存 {repo_cache['size']} 条，命中率 {repo_cache['hit_rate']:.0%}"
+        ),
+        inline=False
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
 # ======================
 # /用户日志（管理员 - 增强版）
 # ======================
@@ -3221,13 +6020,13 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
-    keys = redis.lrange(f"user:keys:{member.id}", 0, -1)
+    records = await load_user_key_records(member.id)
 
-    if not keys:
+    if not records:
         await interaction.followup.send(f"📭 {member.mention} 没有任何密钥记录", ephemeral=True)
         return
 
@@ -3235,7 +6034,7 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
 
     # 检查是否为可疑账号
     uid = str(member.id)
-    suspicious_data = redis.get(f"suspicious_account:{uid}")
+    suspicious_data = await redis.get(f"suspicious_account:{uid}")
     if suspicious_data:
         try:
             if isinstance(suspicious_data, bytes):
@@ -3259,26 +6058,22 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
     # 收集所有密钥用于最后单独发送
     all_keys_text = []
 
-    for i, k in enumerate(keys, 1):
-        k = clean_key(k)
+    for i, record in enumerate(records, 1):
+        k = record["key"]
         all_keys_text.append(k)
-        is_used = redis.get(f"key:used:{k}")
-        info = redis.get(f"key:info:{k}")
-        owner = redis.get(f"key:owner:{k}")
+        owner = record["owner"]
 
         # 密钥信息（不含密钥本身，密钥单独发送）
         lines = []
 
         if owner:
-            try:
-                o = json.loads(owner) if isinstance(owner, str) else owner
-                lines.append(f"📤 发放：{o.get('issuedAt', '未知')} | {o.get('method', '未知')}")
-            except:
-                pass
+            lines.append(f"📤 发放：{owner.get('issuedAt', '未知')} | {owner.get('method', '未知')}")
 
-        if is_used == "true" or is_used is True or is_used == 1:
+        if record["used"]:
             try:
-                entry = json.loads(info) if isinstance(info, str) else (info or {})
+                if not record["info_ok"]:
+                    raise ValueError("key:info 解析失败")
+                entry = record["info"]
                 used_at = entry.get("usedAt", "未知")[:19]
                 ip = entry.get("ip", "未知")
                 ua = entry.get("userAgent", "未知")
@@ -3297,7 +6092,7 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
                 # 添加Discord账号验证
                 discord_id = entry.get("discordId", "")
                 if discord_id:
-                    owner_id = json.loads(owner).get("uid", "") if owner else ""
+                    owner_id = owner.get("uid", "") if owner else ""
                     if discord_id == owner_id:
                         lines.append(f"✅ Discord验证：通过 (ID: {discord_id[:8]}...)")
                     else:
@@ -3306,15 +6101,14 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
             except Exception as e:
                 lines.append("🔴 已使用（详情解析失败）")
         else:
-            in_issued = redis.sismember("keys:issued", k)
-            if in_issued:
+            if record["issued"]:
                 lines.append("🟡 已发出，等待用户验证使用")
             else:
                 lines.append("⚫ 状态未知")
 
         embed.add_field(name=f"密钥 #{i}", value="\n".join(lines) if lines else "无详细信息", inline=False)
 
-    embed.set_footer(text=f"共 {len(keys)} 个密钥 | 查询时间：{time.strftime('%Y-%m-%d %H:%M:%S')}")
+    embed.set_footer(text=f"共 {len(records)} 个密钥 | 查询时间：{time.strftime('%Y-%m-%d %H:%M:%S')}")
     await interaction.followup.send(embed=embed, ephemeral=True)
 
     # 单独发送纯密钥列表，方便手机长按复制
@@ -3326,14 +6120,14 @@ async def 用户日志(interaction: discord.Interaction, member: discord.Member)
 # ======================
 @bot.tree.command(name="我的密钥", description="📋 查看自己所有的密钥记录及使用信息")
 async def 我的密钥(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
     uid = str(interaction.user.id)
-    keys = redis.lrange(f"user:keys:{uid}", 0, -1)
+    records = await load_user_key_records(uid)
 
-    if not keys:
+    if not records:
         await interaction.followup.send(f"📭 你还没有任何密钥记录", ephemeral=True)
         return
 
@@ -3343,31 +6137,27 @@ async def 我的密钥(interaction: discord.Interaction):
     # 收集所有密钥用于最后单独发送
     my_keys_text = []
 
-    for i, k in enumerate(keys, 1):
-        k = clean_key(k)
+    for i, record in enumerate(records, 1):
+        k = record["key"]
         my_keys_text.append(k)
-        is_used = redis.get(f"key:used:{k}")
-        info = redis.get(f"key:info:{k}")
-        owner = redis.get(f"key:owner:{k}")
+        owner = record["owner"]
 
         # 密钥信息（不含密钥本身）
         lines = []
 
         if owner:
+            issued_at = owner.get('issuedAt', '未知')
+            method = owner.get('method', '未知')
+            lines.append(f"📤 **发放信息**")
+            lines.append(f"时间：{issued_at}")
+            lines.append(f"方式：{method}")
+            lines.append("")
+
+        if record["used"]:
             try:
-                o = json.loads(owner) if isinstance(owner, str) else owner
-                issued_at = o.get('issuedAt', '未知')
-                method = o.get('method', '未知')
-                lines.append(f"📤 **发放信息**")
-                lines.append(f"时间：{issued_at}")
-                lines.append(f"方式：{method}")
-                lines.append("")
-            except:
-                pass
-
-        if is_used == "true" or is_used is True or is_used == 1:
-            try:
-                entry = json.loads(info) if isinstance(info, str) else (info or {})
+                if not record["info_ok"]:
+                    raise ValueError("key:info 解析失败")
+                entry = record["info"]
                 used_at = entry.get("usedAt", "未知")[:19]
                 ip = entry.get("ip", "未知")
                 ua = entry.get("userAgent", "未知")
@@ -3388,7 +6178,7 @@ async def 我的密钥(interaction: discord.Interaction):
                 # 添加Discord账号验证
                 discord_id = entry.get("discordId", "")
                 if discord_id:
-                    owner_id = json.loads(owner).get("uid", "") if owner else ""
+                    owner_id = owner.get("uid", "") if owner else ""
                     if discord_id == owner_id:
                         lines.append(f"验证：✅ 通过")
                     else:
@@ -3398,15 +6188,14 @@ async def 我的密钥(interaction: discord.Interaction):
                 lines.append("🔴 **使用信息**")
                 lines.append("详情解析失败")
         else:
-            in_issued = redis.sismember("keys:issued", k)
-            if in_issued:
+            if record["issued"]:
                 lines.append("🟡 **状态：已发出，等待使用**")
             else:
                 lines.append("⚫ **状态：未知**")
 
         embed.add_field(name=f"密钥 #{i}", value="\n".join(lines) if lines else "无详细信息", inline=False)
 
-    embed.set_footer(text=f"共 {len(keys)} 个密钥 | 查询时间：{time.strftime('%Y-%m-%d %H:%M:%S')}")
+    embed.set_footer(text=f"共 {len(records)} 个密钥 | 查询时间：{time.strftime('%Y-%m-%d %H:%M:%S')}")
     await interaction.followup.send(embed=embed, ephemeral=True)
 
     # 单独发送纯密钥列表，方便手机长按复制
@@ -3427,7 +6216,7 @@ async def 工单面板(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
 
     embed = discord.Embed(
@@ -3457,7 +6246,7 @@ async def 关闭工单(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
 
     channel_name = interaction.channel.name
@@ -3475,7 +6264,7 @@ async def 关闭工单(interaction: discord.Interaction):
 # ======================
 @bot.tree.command(name="回顶", description="🔝 快速回到当前频道首楼")
 async def 回顶(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -3729,7 +6518,7 @@ async def 可疑账号(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 无权限", ephemeral=True)
         return
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -3748,43 +6537,41 @@ async def 可疑账号(interaction: discord.Interaction):
             return text[: limit - 3] + "..."
 
         # 1) 先取已有可疑集合
-        suspicious_uids = redis.smembers("suspicious_accounts_set") or []
+        suspicious_uids = await redis.smembers("suspicious_accounts_set") or []
         uid_set = set()
         for raw_uid in suspicious_uids:
             uid = _to_text(raw_uid)
             if uid:
                 uid_set.add(uid)
 
-        # 2) 兼容集合丢失的场景：从历史键重建一次检测
+        # 2) 有使用记录的 UID 索引；旧数据的一次性回填未完成时先继续回填
         try:
-            history_keys = redis.keys("user:key_usage_history:*") or []
-            for hk in history_keys:
-                hk_text = _to_text(hk)
-                if hk_text.startswith("user:key_usage_history:"):
-                    uid_set.add(hk_text.rsplit(":", 1)[-1])
+            await backfill_history_uid_index()
+            history_uids = await load_active_history_uids()
+            uid_set.update(history_uids)
         except Exception as e:
             print(f"⚠️ 可疑账号历史扫描失败: {e}")
 
         valid_accounts = []
         removed_count = 0
-
-        # 3) 对每个 UID 做实时重算，确保结果真实有效
-        for uid in uid_set:
-            if not uid:
-                continue
-
-            fresh = detect_suspicious_account(uid)
-            if not fresh.get("is_suspicious"):
-                redis.delete(f"suspicious_account:{uid}")
-                redis.srem("suspicious_accounts_set", uid)
-                removed_count += 1
-                continue
+        detect_semaphore = asyncio.Semaphore(SUSPICIOUS_DETECT_CONCURRENCY)
+
+        # 3) 对每个 UID 做实时重算，确保结果真实有效（并发执行，限制同时在途数量）
+        async def _recheck(uid):
+            async with detect_semaphore:
+                fresh = await detect_suspicious_account(uid)
+                if not fresh.get("is_suspicious"):
+                    pipe = redis.pipeline()
+                    pipe.delete(f"suspicious_account:{uid}")
+                    pipe.srem("suspicious_accounts_set", uid)
+                    await pipe.exec()
+                    return None
+                stored = await redis.get(f"suspicious_account:{uid}")
 
             detected_at = time.strftime("%Y-%m-%d %H:%M:%S")
             details = fresh.get("details", {})
             reasons = fresh.get("reasons", [])
 
-            stored = redis.get(f"suspicious_account:{uid}")
             if stored:
                 try:
                     if isinstance(stored, bytes):
@@ -3798,12 +6585,24 @@ async def 可疑账号(interaction: discord.Interaction):
                 except Exception:
                     pass
 
-            valid_accounts.append({
+            return {
                 "uid": uid,
                 "reasons": reasons if isinstance(reasons, list) else [str(reasons)],
                 "detected_at": str(detected_at),
                 "details": details if isinstance(details, dict) else {}
-            })
+            }
+
+        results = await asyncio.gather(
+            *[_recheck(uid) for uid in uid_set if uid],
+            return_exceptions=True
+        )
+        for item in results:
+            if isinstance(item, dict):
+                valid_accounts.append(item)
+            elif item is None:
+                removed_count += 1
+            else:
+                print(f"⚠️ 可疑账号重算失败: {item}")
 
         # 4) 按检测时间倒序
         def _parse_dt(dt_str):
@@ -3931,7 +6730,7 @@ async def 上传保护附件(
     附件8: discord.Attachment = None,
     名称8: str = None
 ):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -3956,7 +6755,7 @@ async def 上传保护附件(
         return
 
     # 检查是否已有附件
-    existing = ProtectedAttachmentManager.get_attachments(thread.id)
+    existing = await ProtectedAttachmentManager.get_attachments(thread.id)
     if existing:
         await interaction.followup.send(
             "❌ **此帖子已有保护附件**\n"
@@ -4103,7 +6902,7 @@ async def 修改保护附件(
     附件8: discord.Attachment = None,
     名称8: str = None
 ):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4126,7 +6925,7 @@ async def 修改保护附件(
         return
 
     # 检查是否有现有附件
-    existing = ProtectedAttachmentManager.get_attachments(thread.id)
+    existing = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not existing:
         await interaction.followup.send(
             "❌ **此帖子还没有保护附件**\n"
@@ -4219,7 +7018,7 @@ async def 修改保护附件(
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="领取保护附件", description="📥 下载保护附件（需先点赞+评论）")
 async def 领取保护附件(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4236,7 +7035,7 @@ async def 领取保护附件(interaction: discord.Interaction):
     uid = str(interaction.user.id)
 
     # 检查帖子是否有保护附件
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await interaction.followup.send(
             "❌ **此帖子没有保护附件**\n"
@@ -4276,7 +7075,7 @@ async def 领取保护附件(interaction: discord.Interaction):
         return
 
     # 检查用户是否已有访问权限（之前验证通过）
-    has_access = ProtectedAttachmentManager.has_user_access(thread.id, uid)
+    has_access = await ProtectedAttachmentManager.has_user_access(thread.id, uid)
 
     if not has_access:
         # 检查用户是否满足条件（点赞 + 评论）
@@ -4301,10 +7100,10 @@ async def 领取保护附件(interaction: discord.Interaction):
             return
 
         # 记录用户访问权限
-        ProtectedAttachmentManager.record_user_access(thread.id, uid)
+        await ProtectedAttachmentManager.record_user_access(thread.id, uid)
 
     # 增加下载计数
-    ProtectedAttachmentManager.increment_download_count(thread.id)
+    await ProtectedAttachmentManager.increment_download_count(thread.id)
 
     # 发送附件下载链接（私信方式更安全）
     try:
@@ -4357,7 +7156,7 @@ async def 领取保护附件(interaction: discord.Interaction):
 @bot.tree.command(name="查看保护附件", description="📊 [帖主] 查看当前帖子保护附件的状态和统计")
 async def 查看保护附件(interaction: discord.Interaction):
 
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4383,7 +7182,7 @@ async def 查看保护附件(interaction: discord.Interaction):
         return
 
     # 获取附件信息
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await interaction.followup.send(
             "❌ **此帖子没有保护附件**\n"
@@ -4439,7 +7238,7 @@ async def 查看保护附件(interaction: discord.Interaction):
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="保护附件置底", description="📌 [帖主/管理员] 让保护附件下载入口保持在帖子底部")
 async def 保护附件置底(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4452,7 +7251,7 @@ async def 保护附件置底(interaction: discord.Interaction):
         await interaction.followup.send("❌ 只有帖主或管理员可以设置该帖置底消息。", ephemeral=True)
         return
 
-    attachment_data = ProtectedAttachmentManager.get_attachments(thread.id)
+    attachment_data = await ProtectedAttachmentManager.get_attachments(thread.id)
     if not attachment_data:
         await interaction.followup.send(
             "❌ 此帖子还没有保护附件。\n请先使用 `/上传保护附件` 上传附件。",
@@ -4460,14 +7259,14 @@ async def 保护附件置底(interaction: discord.Interaction):
         )
         return
 
-    old_cfg = ThreadBottomManager.get_notice(thread.id, "attachment") or {}
+    old_cfg = await ThreadBottomManager.get_notice(thread.id, "attachment") or {}
     new_cfg = {
         "enabled": True,
         "message_id": old_cfg.get("message_id"),
         "updated_by": str(interaction.user.id),
         "updated_at": _now_text()
     }
-    ThreadBottomManager.set_notice(thread.id, "attachment", new_cfg)
+    await ThreadBottomManager.set_notice(thread.id, "attachment", new_cfg)
     await refresh_thread_bottom_notices(thread)
 
     await interaction.followup.send(
@@ -4482,7 +7281,7 @@ async def 保护附件置底(interaction: discord.Interaction):
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="删除保护附件置底", description="🗑️ [帖主/管理员] 删除保护附件下载置底消息")
 async def 删除保护附件置底(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4495,13 +7294,13 @@ async def 删除保护附件置底(interaction: discord.Interaction):
         await interaction.followup.send("❌ 只有帖主或管理员可以删除该帖置底消息。", ephemeral=True)
         return
 
-    cfg = ThreadBottomManager.get_notice(thread.id, "attachment")
+    cfg = await ThreadBottomManager.get_notice(thread.id, "attachment")
     if not cfg:
         await interaction.followup.send("ℹ️ 当前帖子未启用保护附件置底。", ephemeral=True)
         return
 
     await _delete_thread_message_if_exists(thread, cfg.get("message_id"))
-    ThreadBottomManager.delete_notice(thread.id, "attachment")
+    await ThreadBottomManager.delete_notice(thread.id, "attachment")
 
     await interaction.followup.send("✅ 已删除保护附件下载置底消息。", ephemeral=True)
 
@@ -4513,7 +7312,7 @@ async def 删除保护附件置底(interaction: discord.Interaction):
 @bot.tree.command(name="公告置底", description="📢 [管理员/帖主] 设置并保持公告在帖子或文字频道底部")
 @app_commands.describe(内容="公告内容（重复执行本命令可编辑）")
 async def 公告置底(interaction: discord.Interaction, 内容: str):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4534,7 +7333,7 @@ async def 公告置底(interaction: discord.Interaction, 内容: str):
         await interaction.followup.send("❌ 公告内容过长，请控制在 1800 字以内。", ephemeral=True)
         return
 
-    old_cfg = ThreadBottomManager.get_notice(channel.id, "announcement") or {}
+    old_cfg = await ThreadBottomManager.get_notice(channel.id, "announcement") or {}
     new_cfg = {
         "enabled": True,
         "content": content,
@@ -4542,7 +7341,7 @@ async def 公告置底(interaction: discord.Interaction, 内容: str):
         "updated_by": str(interaction.user.id),
         "updated_at": _now_text()
     }
-    ThreadBottomManager.set_notice(channel.id, "announcement", new_cfg)
+    await ThreadBottomManager.set_notice(channel.id, "announcement", new_cfg)
     await refresh_thread_bottom_notices(channel)
 
     await interaction.followup.send(
@@ -4557,7 +7356,7 @@ async def 公告置底(interaction: discord.Interaction, 内容: str):
 @app_commands.guilds(discord.Object(id=1472467068333850637))
 @bot.tree.command(name="删除公告置底", description="🗑️ [管理员/帖主] 删除帖子或文字频道公告置底消息")
 async def 删除公告置底(interaction: discord.Interaction):
-    if not acquire_cmd_lock(interaction.id):
+    if not await acquire_cmd_lock(interaction.id):
         return
     await interaction.response.defer(ephemeral=True)
 
@@ -4570,13 +7369,13 @@ async def 删除公告置底(interaction: discord.Interaction):
         await interaction.followup.send("❌ 只有管理员，或帖子内的帖主，才能删除公告置底。", ephemeral=True)
         return
 
-    cfg = ThreadBottomManager.get_notice(channel.id, "announcement")
+    cfg = await ThreadBottomManager.get_notice(channel.id, "announcement")
     if not cfg:
         await interaction.followup.send("ℹ️ 当前频道未启用公告置底。", ephemeral=True)
         return
 
     await _delete_thread_message_if_exists(channel, cfg.get("message_id"))
-    ThreadBottomManager.delete_notice(channel.id, "announcement")
+    await ThreadBottomManager.delete_notice(channel.id, "announcement")
 
     await interaction.followup.send("✅ 已删除公告置底消息。", ephemeral=True)
 
@@ -4600,6 +7399,10 @@ async def on_message(message: discord.Message):
 
 @bot.event
 async def on_ready():
+    bind_storage_loop(asyncio.get_running_loop())
+    await get_http_session()
+    start_repo_mirror_refresh()
+    start_repo_prewarm()
     bot.add_view(TicketView())
     bot.add_view(TicketControlView())  # 持久化注册工单按钮视图
     bot.add_view(FishQuizEntryView())  # 持久化注册答题按钮视图
@@ -4622,6 +7425,7 @@ async def on_ready():
     print(f"✅ 已登录：{bot.user} | PID: {os.getpid()} | 时间: {time.strftime('%H:%M:%S')}")
 
 if __name__ == "__main__":
+    start_repo_cpu_pool()
     keep_alive()
     hb = Thread(target=heartbeat)
     hb.daemon = True